@@ -1,22 +1,59 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, abort, send_file
 from flask_cors import CORS
 import sqlite3
 import os
 import json
+import time
 import uuid
 from datetime import datetime
 import bcrypt
+import hmac
+
+import audit
+import backup
+import capture
+import changes
+import compression
+import db
+import fingerprints
+import generator
+import honeytokens
+import idempotency
+import ids
+import jobs
+import listing_cache
+import metrics
+import password_history
+import profiling
+import serialization
+import sharing
+import slowlog
+import static_assets
+import tags
+import vault_health
+import vault_tree
+import walarchive
 
 app = Flask(__name__)
+app.json = serialization.JSONProvider(app)
+app.url_map.converters['id'] = ids.IdConverter
 CORS(app)
+metrics.init_app(app)
+compression.init_app(app)
+capture.init_app(app)
+audit.init_app(app)
 
-# Database setup
-DATABASE = 'agies.db'
+# Database setup; made absolute so background threads and exit hooks keep
+# using the same file if the working directory changes later
+DATABASE = os.path.abspath('agies.db')
 
 def init_db():
     conn = sqlite3.connect(DATABASE)
     c = conn.cursor()
     
+    # WAL mode when continuous archiving is enabled
+    walarchive.init_wal(c)
+    
     # Create users table
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -30,7 +67,7 @@ def init_db():
     # Create vaults table
     c.execute('''
         CREATE TABLE IF NOT EXISTS vaults (
-            id TEXT PRIMARY KEY,
+            id BLOB PRIMARY KEY,
             user_id TEXT NOT NULL,
             name TEXT NOT NULL,
             description TEXT,
@@ -44,8 +81,8 @@ def init_db():
     # Create passwords table
     c.execute('''
         CREATE TABLE IF NOT EXISTS passwords (
-            id TEXT PRIMARY KEY,
-            vault_id TEXT NOT NULL,
+            id BLOB PRIMARY KEY,
+            vault_id BLOB NOT NULL,
             title TEXT NOT NULL,
             username TEXT NOT NULL,
             password TEXT NOT NULL,
@@ -57,16 +94,74 @@ def init_db():
         )
     ''')
     
+    # Honeytoken registry and decoy markers
+    honeytokens.init_honeytoken_schema(c)
+    
+    # Keyed fingerprints for reuse detection, indexed by (user_id, fingerprint)
+    fingerprints.init_fingerprint_schema(c)
+    
+    # Strength scores and incrementally maintained health counters
+    vault_health.init_health_schema(c)
+    
+    # Item tags and categories, their inverted index and facet counts
+    tags.init_tags_schema(c)
+    
+    # Stored responses for retried POSTs carrying an Idempotency-Key
+    idempotency.init_idempotency_schema(c)
+    
+    # Background job queue
+    jobs.init_jobs_schema(c)
+    
+    # Per-user version for the vault and item listing cache
+    listing_cache.init_cache_schema(c)
+    
+    # Closure table for nested vaults
+    vault_tree.init_tree_schema(c)
+    
+    # Vault shares and the effective per-user permission index
+    sharing.init_sharing_schema(c)
+    
+    # Earlier versions of password items
+    password_history.init_history_schema(c)
+    
+    # Feed of vault and item changes pushed to connected clients
+    changes.init_changes_schema(c)
+    
+    # Vault and password ids written as TEXT by earlier versions become BLOBs
+    ids.migrate(c)
+    
     conn.commit()
     conn.close()
 
 def get_db():
-    conn = sqlite3.connect(DATABASE)
+    conn = db.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
 # Initialize database
 init_db()
+walarchive.start(DATABASE)
+honeytokens.start(DATABASE)
+idempotency.start(DATABASE)
+backup.start(DATABASE)
+static_assets.index.scan()
+slowlog.install()
+
+def admin_key_matches(value):
+    # Operator endpoints are disabled unless AGIES_ADMIN_KEY is set
+    admin_key = os.environ.get('AGIES_ADMIN_KEY')
+    if not admin_key:
+        return False
+    return hmac.compare_digest(value or '', admin_key)
+
+def is_admin():
+    return admin_key_matches(request.headers.get('X-Admin-Key', ''))
+
+profiling.init_app(app, is_admin)
+
+def trip_honeytoken(target_id, access_type, user_id):
+    return honeytokens.check(target_id, access_type, user_id,
+                             request.remote_addr, request.headers.get('User-Agent'))
 
 @app.route('/')
 def home():
@@ -82,6 +177,7 @@ def health():
 
 # User registration
 @app.route('/api/auth/register', methods=['POST'])
+@idempotency.idempotent
 def register():
     try:
         data = request.get_json()
@@ -92,7 +188,8 @@ def register():
             return jsonify({"error": "Email and password required"}), 400
         
         # Hash password
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+        with metrics.time_bcrypt('hash'):
+            password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
         
         # Create user
         user_id = str(uuid.uuid4())
@@ -110,12 +207,18 @@ def register():
                  (user_id, email, password_hash.decode('utf-8')))
         
         # Create default vault
-        vault_id = str(uuid.uuid4())
+        vault_id = ids.new_id()
         c.execute('INSERT INTO vaults (id, user_id, name, description, icon) VALUES (?, ?, ?, ?, ?)',
                  (vault_id, user_id, 'Personal Vault', 'Your personal passwords', '🔐'))
+        vault_tree.add_vault(c, vault_id)
+        sharing.add_owner(c, user_id, vault_id)
+        
+        # Seed decoy vault and honeytoken items
+        honeytokens.seed_user(c, user_id)
         
         conn.commit()
         conn.close()
+        audit.annotate(user_id=user_id)
         
         return jsonify({
             "message": "User registered successfully",
@@ -146,10 +249,14 @@ def login():
         conn.close()
         
         if not user:
+            audit.annotate(metadata={"email": email})
             return jsonify({"error": "Invalid credentials"}), 401
+        audit.annotate(user_id=user['id'])
         
         # Check password
-        if bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        with metrics.time_bcrypt('check'):
+            matches = bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8'))
+        if matches:
             return jsonify({
                 "message": "Login successful",
                 "user_id": user['id'],
@@ -189,7 +296,7 @@ def get_profile():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Get user vaults
+# Get vaults the user owns or has been shared; decoy vaults are left out
 @app.route('/api/vaults', methods=['GET'])
 def get_vaults():
     try:
@@ -200,29 +307,35 @@ def get_vaults():
         conn = get_db()
         c = conn.cursor()
         
-        c.execute('''
-            SELECT v.*, COUNT(p.id) as password_count 
-            FROM vaults v 
-            LEFT JOIN passwords p ON v.id = p.vault_id 
-            WHERE v.user_id = ? 
-            GROUP BY v.id
-        ''', (user_id,))
-        
-        vaults = []
-        for row in c.fetchall():
-            vault = dict(row)
-            vault['password_count'] = vault['password_count'] or 0
-            vaults.append(vault)
-        
+        version = listing_cache.user_version(c, user_id)
+        body = listing_cache.get(user_id, version, 'vaults')
+        if body is None:
+            c.row_factory = None
+            c.execute('''
+                SELECT v.id, v.user_id, v.parent_vault_id, v.name, v.description, v.icon, v.created_at,
+                       COUNT(p.id) as password_count,
+                       (SELECT SUM(d.password_count) FROM vault_tree t
+                        JOIN vaults d ON d.id = t.descendant_id
+                        WHERE t.ancestor_id = v.id) as total_password_count,
+                       a.is_owner, a.can_write, a.can_delete, a.can_share
+                FROM vault_acl a
+                JOIN vaults v ON v.id = a.vault_id
+                LEFT JOIN passwords p ON v.id = p.vault_id 
+                WHERE a.user_id = ? AND v.is_decoy = 0
+                GROUP BY v.id
+            ''', (user_id,))
+            body = serialization.encode_rows(c.description, c.fetchall())
+            listing_cache.put(user_id, version, 'vaults', body)
         conn.close()
         
-        return jsonify(vaults), 200
+        return serialization.body_response(app, body)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Create vault
 @app.route('/api/vaults', methods=['POST'])
+@idempotency.idempotent
 def create_vault():
     try:
         user_id = request.headers.get('X-User-ID')
@@ -233,24 +346,46 @@ def create_vault():
         name = data.get('name')
         description = data.get('description', '')
         icon = data.get('icon', '🔐')
+        parent_id = ids.parse(data.get('parent_vault_id'))
         
         if not name:
             return jsonify({"error": "Vault name required"}), 400
         
-        vault_id = str(uuid.uuid4())
+        vault_id = ids.new_id()
         conn = get_db()
         c = conn.cursor()
         
+        # Nested vaults belong to the owner of the tree they are created in
+        owner_id = user_id
+        if parent_id:
+            parent = sharing.access(c, user_id, parent_id)
+            if not parent:
+                conn.close()
+                return jsonify({"error": "Parent vault not found"}), 404
+            if not parent['can_write']:
+                conn.close()
+                return jsonify({"error": "Not allowed to change this vault"}), 403
+            if vault_tree.depth(c, parent_id) + 1 >= vault_tree.MAX_DEPTH:
+                conn.close()
+                return jsonify({"error": "Vaults cannot be nested deeper than %d levels" % vault_tree.MAX_DEPTH}), 400
+            owner_id = parent['owner_id']
+        
         c.execute('''
-            INSERT INTO vaults (id, user_id, name, description, icon) 
-            VALUES (?, ?, ?, ?, ?)
-        ''', (vault_id, user_id, name, description, icon))
+            INSERT INTO vaults (id, user_id, parent_vault_id, name, description, icon) 
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (vault_id, owner_id, parent_id, name, description, icon))
+        vault_tree.add_vault(c, vault_id, parent_id)
+        sharing.vault_added(c, owner_id, vault_id)
+        members = sharing.members(c, vault_id)
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.VAULT_CREATED, vault_id)
         
         conn.commit()
         conn.close()
         
         return jsonify({
             "id": vault_id,
+            "parent_vault_id": parent_id,
             "name": name,
             "description": description,
             "icon": icon,
@@ -262,35 +397,52 @@ def create_vault():
         return jsonify({"error": str(e)}), 500
 
 # Get vault passwords
-@app.route('/api/vaults/<vault_id>/passwords', methods=['GET'])
+@app.route('/api/vaults/<id:vault_id>/passwords', methods=['GET'])
 def get_passwords(vault_id):
     try:
         user_id = request.headers.get('X-User-ID')
         if not user_id:
             return jsonify({"error": "Authentication required"}), 401
         
+        # Decoy vaults answer normally; the tripwire only raises an alert
+        trip_honeytoken(vault_id, 'read', user_id)
+        
         conn = get_db()
         c = conn.cursor()
         
-        # Verify vault belongs to user
-        c.execute('SELECT id FROM vaults WHERE id = ? AND user_id = ?', (vault_id, user_id))
-        if not c.fetchone():
+        # A cached listing implies access: revoking or deleting bumps the version
+        version = listing_cache.user_version(c, user_id)
+        body = listing_cache.get(user_id, version, 'vault:' + vault_id.hex())
+        if body is not None:
+            conn.close()
+            return serialization.body_response(app, body)
+        
+        # Verify the user can see the vault
+        if not sharing.access(c, user_id, vault_id):
             conn.close()
             return jsonify({"error": "Vault not found"}), 404
         
         # Get passwords
-        c.execute('SELECT * FROM passwords WHERE vault_id = ? ORDER BY created_at DESC', (vault_id,))
-        passwords = [dict(row) for row in c.fetchall()]
+        c.execute('''
+            SELECT id, vault_id, title, username, password, url, notes, category,
+                   COALESCE(tags, '[]') as tags, strength_score,
+                   password_changed_at, created_at, updated_at
+            FROM passwords WHERE vault_id = ? ORDER BY created_at DESC
+        ''', (vault_id,))
+        c.row_factory = None
+        body = serialization.encode_rows(c.description, c.fetchall(), json_columns=('tags',))
+        listing_cache.put(user_id, version, 'vault:' + vault_id.hex(), body)
         
         conn.close()
         
-        return jsonify(passwords), 200
+        return serialization.body_response(app, body)
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Add password
-@app.route('/api/vaults/<vault_id>/passwords', methods=['POST'])
+@app.route('/api/vaults/<id:vault_id>/passwords', methods=['POST'])
+@idempotency.idempotent
 def add_password(vault_id):
     try:
         user_id = request.headers.get('X-User-ID')
@@ -307,25 +459,48 @@ def add_password(vault_id):
         if not title or not username or not password:
             return jsonify({"error": "Title, username, and password required"}), 400
         
+        try:
+            tag_list = tags.normalize_tags(data.get('tags'))
+            category = tags.normalize_category(data.get('category'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         conn = get_db()
         c = conn.cursor()
         
-        # Verify vault belongs to user
-        c.execute('SELECT id FROM vaults WHERE id = ? AND user_id = ?', (vault_id, user_id))
-        if not c.fetchone():
+        # Verify the user can add to the vault
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
             conn.close()
             return jsonify({"error": "Vault not found"}), 404
-        
-        # Add password
-        password_id = str(uuid.uuid4())
+        if not access['can_write']:
+            conn.close()
+            return jsonify({"error": "Not allowed to change this vault"}), 403
+        
+        # Items, fingerprints and health counters belong to the vault owner
+        owner_id = access['owner_id']
+        password_id = ids.new_id()
+        strength = vault_health.score_password(password)
+        changed_at = vault_health.utc_timestamp()
+        fingerprint = fingerprints.fingerprint(owner_id, password)
+        reused_in = fingerprints.reuse_count(c, owner_id, fingerprint) if access['is_owner'] else None
         c.execute('''
-            INSERT INTO passwords (id, vault_id, title, username, password, url, notes) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (password_id, vault_id, title, username, password, url, notes))
+            INSERT INTO passwords (id, vault_id, user_id, title, username, password, url, notes,
+                                   category, tags, strength_score, password_changed_at, fingerprint) 
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (password_id, vault_id, owner_id, title, username, password, url, notes,
+              category, tags.encode(tag_list), strength, changed_at, fingerprint))
         
         # Update vault password count
         c.execute('UPDATE vaults SET password_count = password_count + 1 WHERE id = ?', (vault_id,))
         
+        # Update health counters
+        vault_health.item_added(c, owner_id, vault_id, fingerprint, strength, changed_at)
+        tags.item_added(c, owner_id, password_id, tag_list, category)
+        members = sharing.members(c, vault_id)
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.ITEM_CREATED, vault_id, password_id)
+        
         conn.commit()
         conn.close()
         
@@ -335,6 +510,10 @@ def add_password(vault_id):
             "username": username,
             "url": url,
             "notes": notes,
+            "category": category,
+            "tags": tag_list,
+            "strength_score": strength,
+            "reused_in": reused_in,
             "created_at": datetime.now().isoformat()
         }), 201
         
@@ -342,7 +521,7 @@ def add_password(vault_id):
         return jsonify({"error": str(e)}), 500
 
 # Update password
-@app.route('/api/passwords/<password_id>', methods=['PUT'])
+@app.route('/api/passwords/<id:password_id>', methods=['PUT'])
 def update_password(password_id):
     try:
         user_id = request.headers.get('X-User-ID')
@@ -359,57 +538,178 @@ def update_password(password_id):
         if not title or not username or not password:
             return jsonify({"error": "Title, username, and password required"}), 400
         
+        # Tags and category are left alone unless the request sets them
+        try:
+            tag_list = tags.normalize_tags(data['tags']) if 'tags' in data else None
+            category = tags.normalize_category(data['category']) if 'category' in data else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Raises an alert for any caller; only those who can see the item get
+        # the decoy answer below, everyone else the same 404 as a real miss
+        tripped = trip_honeytoken(password_id, 'update', user_id)
+        
         conn = get_db()
         c = conn.cursor()
         
-        # Verify password belongs to user's vault
+        # Verify password is in a vault the user can see
         c.execute('''
-            SELECT p.id FROM passwords p 
-            JOIN vaults v ON p.vault_id = v.id 
-            WHERE p.id = ? AND v.user_id = ?
-        ''', (password_id, user_id))
-        
-        if not c.fetchone():
+            SELECT p.id, p.vault_id, p.title, p.username, p.password, p.url, p.notes,
+                   p.fingerprint, p.strength_score, p.password_changed_at,
+                   p.tags, p.category, a.owner_id, a.is_owner, a.can_write
+            FROM passwords p 
+            JOIN vault_acl a ON a.vault_id = p.vault_id AND a.user_id = ?
+            WHERE p.id = ?
+        ''', (user_id, password_id))
+        
+        existing = c.fetchone()
+        if not existing:
             conn.close()
             return jsonify({"error": "Password not found"}), 404
+        if not existing['can_write']:
+            conn.close()
+            return jsonify({"error": "Not allowed to change this vault"}), 403
+        
+        owner_id = existing['owner_id']
+        fingerprint = fingerprints.fingerprint(owner_id, password)
+        
+        # Honeytoken items answer like a real update without being changed
+        if tripped:
+            reused_in = None
+            if existing['is_owner']:
+                reused_in = fingerprints.reuse_count(c, owner_id, fingerprint, exclude_id=password_id)
+            conn.close()
+            return jsonify({
+                "message": "Password updated successfully",
+                "category": category if 'category' in data else existing['category'],
+                "tags": tag_list if tag_list is not None else tags.decode(existing['tags']),
+                "strength_score": vault_health.score_password(password),
+                "reused_in": reused_in
+            }), 200
+        
+        # Only a new secret resets its score and age
+        if existing['fingerprint'] == fingerprint:
+            strength = existing['strength_score']
+            changed_at = existing['password_changed_at']
+        else:
+            strength = vault_health.score_password(password)
+            changed_at = vault_health.utc_timestamp()
+        
+        old_tags = tags.decode(existing['tags'])
+        if tag_list is None:
+            tag_list = old_tags
+        if 'category' not in data:
+            category = existing['category']
         
         # Update password
         c.execute('''
             UPDATE passwords 
-            SET title = ?, username = ?, password = ?, url = ?, notes = ?, updated_at = CURRENT_TIMESTAMP 
+            SET title = ?, username = ?, password = ?, url = ?, notes = ?,
+                category = ?, tags = ?, strength_score = ?, password_changed_at = ?, fingerprint = ?,
+                updated_at = CURRENT_TIMESTAMP 
             WHERE id = ?
-        ''', (title, username, password, url, notes, password_id))
+        ''', (title, username, password, url, notes, category, tags.encode(tag_list),
+              strength, changed_at, fingerprint, password_id))
+        
+        # Keep the replaced values
+        password_history.record(c, password_id, user_id, existing, {
+            "title": title, "username": username, "password": password, "url": url,
+            "notes": notes, "category": category, "tags": tags.encode(tag_list)
+        })
+        
+        # Update health counters
+        vault_health.item_updated(c, owner_id, existing['vault_id'], existing, fingerprint, strength, changed_at)
+        tags.item_updated(c, owner_id, password_id, old_tags, existing['category'], tag_list, category)
+        members = sharing.members(c, existing['vault_id'])
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.ITEM_UPDATED, existing['vault_id'], password_id)
+        reused_in = None
+        if existing['is_owner']:
+            reused_in = fingerprints.reuse_count(c, owner_id, fingerprint, exclude_id=password_id)
         
         conn.commit()
         conn.close()
         
-        return jsonify({"message": "Password updated successfully"}), 200
+        return jsonify({
+            "message": "Password updated successfully",
+            "category": category,
+            "tags": tag_list,
+            "strength_score": strength,
+            "reused_in": reused_in
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Earlier versions of a password item, newest first
+@app.route('/api/passwords/<id:password_id>/history', methods=['GET'])
+def get_password_history(password_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        # Honeytoken items have no history, so they answer like any other item
+        trip_honeytoken(password_id, 'read', user_id)
+        
+        limit = request.args.get('limit', type=int)
+        conn = get_db()
+        c = conn.cursor()
+        
+        c.execute('''
+            SELECT p.title, p.username, p.password, p.url, p.notes, p.category, p.tags
+            FROM passwords p
+            JOIN vault_acl a ON a.vault_id = p.vault_id AND a.user_id = ?
+            WHERE p.id = ?
+        ''', (user_id, password_id))
+        current = c.fetchone()
+        if not current:
+            conn.close()
+            return jsonify({"error": "Password not found"}), 404
+        
+        revisions = password_history.revisions(c, password_id, current, limit)
+        conn.close()
+        
+        return jsonify({"password_id": password_id, "revisions": revisions}), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Delete password
-@app.route('/api/passwords/<password_id>', methods=['DELETE'])
+@app.route('/api/passwords/<id:password_id>', methods=['DELETE'])
 def delete_password(password_id):
     try:
         user_id = request.headers.get('X-User-ID')
         if not user_id:
             return jsonify({"error": "Authentication required"}), 401
         
+        # Raises an alert for any caller; see update_password
+        tripped = trip_honeytoken(password_id, 'delete', user_id)
+        
         conn = get_db()
         c = conn.cursor()
         
         # Get vault ID for this password
         c.execute('''
-            SELECT p.vault_id FROM passwords p 
-            JOIN vaults v ON p.vault_id = v.id 
-            WHERE p.id = ? AND v.user_id = ?
-        ''', (password_id, user_id))
+            SELECT p.id, p.vault_id, p.fingerprint, p.strength_score, p.password_changed_at,
+                   p.tags, p.category, a.owner_id, a.can_delete
+            FROM passwords p 
+            JOIN vault_acl a ON a.vault_id = p.vault_id AND a.user_id = ?
+            WHERE p.id = ?
+        ''', (user_id, password_id))
         
         result = c.fetchone()
         if not result:
             conn.close()
             return jsonify({"error": "Password not found"}), 404
+        if not result['can_delete']:
+            conn.close()
+            return jsonify({"error": "Not allowed to delete from this vault"}), 403
+        
+        # Honeytoken items report success without being removed
+        if tripped:
+            conn.close()
+            return jsonify({"message": "Password deleted successfully"}), 200
         
         vault_id = result['vault_id']
         
@@ -419,6 +719,15 @@ def delete_password(password_id):
         # Update vault password count
         c.execute('UPDATE vaults SET password_count = password_count - 1 WHERE id = ?', (vault_id,))
         
+        # Update health counters
+        vault_health.item_removed(c, result['owner_id'], vault_id, result['fingerprint'],
+                                  result['strength_score'], result['password_changed_at'])
+        tags.items_removed(c, result['owner_id'], [result])
+        password_history.items_removed(c, [password_id])
+        members = sharing.members(c, vault_id)
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.ITEM_DELETED, vault_id, password_id)
+        
         conn.commit()
         conn.close()
         
@@ -428,7 +737,7 @@ def delete_password(password_id):
         return jsonify({"error": str(e)}), 500
 
 # Update vault
-@app.route('/api/vaults/<vault_id>', methods=['PUT'])
+@app.route('/api/vaults/<id:vault_id>', methods=['PUT'])
 def update_vault(vault_id):
     try:
         user_id = request.headers.get('X-User-ID')
@@ -446,11 +755,14 @@ def update_vault(vault_id):
         conn = get_db()
         c = conn.cursor()
         
-        # Verify vault belongs to user
-        c.execute('SELECT id FROM vaults WHERE id = ? AND user_id = ?', (vault_id, user_id))
-        if not c.fetchone():
+        # Verify the user can change the vault
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
             conn.close()
             return jsonify({"error": "Vault not found"}), 404
+        if not access['can_write']:
+            conn.close()
+            return jsonify({"error": "Not allowed to change this vault"}), 403
         
         # Update vault
         c.execute('''
@@ -458,17 +770,118 @@ def update_vault(vault_id):
             SET name = ?, description = ?, icon = ? 
             WHERE id = ?
         ''', (name, description, icon, vault_id))
+        members = sharing.members(c, vault_id)
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.VAULT_UPDATED, vault_id)
         
         conn.commit()
         conn.close()
         
         return jsonify({"message": "Vault updated successfully"}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# A vault and every vault nested below it, with recursive item counts
+@app.route('/api/vaults/<id:vault_id>/tree', methods=['GET'])
+def get_vault_tree(vault_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
         
+        # Access to a vault covers its subtree, so a cached tree implies access
+        version = listing_cache.user_version(c, user_id)
+        body = listing_cache.get(user_id, version, 'tree:' + vault_id.hex())
+        if body is not None:
+            conn.close()
+            return serialization.body_response(app, body)
+        
+        if not sharing.access(c, user_id, vault_id):
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        
+        c.row_factory = None
+        c.execute('''
+            SELECT v.id, v.parent_vault_id, v.name, v.description, v.icon, v.created_at,
+                   t.depth, v.password_count,
+                   (SELECT SUM(d.password_count) FROM vault_tree s
+                    JOIN vaults d ON d.id = s.descendant_id
+                    WHERE s.ancestor_id = v.id) as total_password_count
+            FROM vault_tree t
+            JOIN vaults v ON v.id = t.descendant_id
+            WHERE t.ancestor_id = ?
+            ORDER BY t.depth, v.name
+        ''', (vault_id,))
+        body = serialization.encode_rows(c.description, c.fetchall())
+        listing_cache.put(user_id, version, 'tree:' + vault_id.hex(), body)
+        conn.close()
+        
+        return serialization.body_response(app, body)
+
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Move a vault (and everything below it) under another vault, or to the top level
+@app.route('/api/vaults/<id:vault_id>/move', methods=['POST'])
+def move_vault(vault_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        data = request.get_json()
+        parent_id = ids.parse(data.get('parent_vault_id'))
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        # Only the owner can move a vault, and only within their own trees
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        if not access['is_owner']:
+            conn.close()
+            return jsonify({"error": "Only the owner can move this vault"}), 403
+        
+        if parent_id:
+            parent = sharing.access(c, user_id, parent_id)
+            if not parent or not parent['is_owner']:
+                conn.close()
+                return jsonify({"error": "Parent vault not found"}), 404
+            if vault_tree.is_descendant(c, parent_id, vault_id):
+                conn.close()
+                return jsonify({"error": "A vault cannot be moved inside itself"}), 400
+            if vault_tree.depth(c, parent_id) + 1 + vault_tree.height(c, vault_id) >= vault_tree.MAX_DEPTH:
+                conn.close()
+                return jsonify({"error": "Vaults cannot be nested deeper than %d levels" % vault_tree.MAX_DEPTH}), 400
+        
+        # Members of the old and the new ancestors both see the change
+        members_before = sharing.subtree_members(c, vault_id)
+        vault_tree.move(c, vault_id, parent_id)
+        sharing.refresh(c, vault_id)
+        members = set(members_before + sharing.subtree_members(c, vault_id))
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.VAULT_MOVED, vault_id)
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"message": "Vault moved successfully", "parent_vault_id": parent_id}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Vaults with more items than this are deleted by a background job
+VAULT_DELETE_INLINE_LIMIT = int(os.environ.get('AGIES_VAULT_DELETE_INLINE_LIMIT', 2000))
+VAULT_DELETE_BATCH = 1000
+
 # Delete vault
-@app.route('/api/vaults/<vault_id>', methods=['DELETE'])
+@app.route('/api/vaults/<id:vault_id>', methods=['DELETE'])
 def delete_vault(vault_id):
     try:
         user_id = request.headers.get('X-User-ID')
@@ -478,17 +891,51 @@ def delete_vault(vault_id):
         conn = get_db()
         c = conn.cursor()
         
-        # Verify vault belongs to user
-        c.execute('SELECT id FROM vaults WHERE id = ? AND user_id = ?', (vault_id, user_id))
-        if not c.fetchone():
+        # Only the owner can delete a vault
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
             conn.close()
             return jsonify({"error": "Vault not found"}), 404
+        if not access['is_owner']:
+            conn.close()
+            return jsonify({"error": "Only the owner can delete this vault"}), 403
         
-        # Delete all passwords in vault
-        c.execute('DELETE FROM passwords WHERE vault_id = ?', (vault_id,))
+        # Nested vaults go with their parent, deepest first
+        vault_ids = vault_tree.subtree(c, vault_id)
         
-        # Delete vault
-        c.execute('DELETE FROM vaults WHERE id = ?', (vault_id,))
+        # Deleting a decoy vault is allowed but still raises an alert
+        for subtree_id in vault_ids:
+            if trip_honeytoken(subtree_id, 'delete', user_id):
+                honeytokens.forget_vault(c, subtree_id)
+        
+        if vault_tree.total_items(c, vault_id) > VAULT_DELETE_INLINE_LIMIT:
+            job_id = jobs.enqueue(c, 'delete_vault', {"vault_id": ids.to_str(vault_id)}, user_id, priority=5)
+            conn.commit()
+            conn.close()
+            return jsonify({"message": "Vault deletion scheduled", "job_id": job_id}), 202
+        
+        members = sharing.subtree_members(c, vault_id)
+        for subtree_id in vault_ids:
+            # Capture what the health counters need before the rows go away
+            c.execute('''
+                SELECT id, fingerprint, strength_score, password_changed_at, tags, category
+                FROM passwords WHERE vault_id = ? AND is_honeytoken = 0
+            ''', (subtree_id,))
+            items = c.fetchall()
+            
+            # Delete all passwords in vault
+            c.execute('DELETE FROM passwords WHERE vault_id = ?', (subtree_id,))
+            
+            # Delete vault
+            c.execute('DELETE FROM vaults WHERE id = ?', (subtree_id,))
+            
+            # Update health counters, shares and the tree
+            vault_health.vault_removed(c, user_id, subtree_id, items)
+            tags.items_removed(c, user_id, items)
+            password_history.items_removed(c, [item['id'] for item in items])
+            changes.publish(c, sharing.vault_removed(c, subtree_id), changes.VAULT_DELETED, subtree_id)
+            vault_tree.remove_vault(c, subtree_id)
+        listing_cache.bump(c, *members)
         
         conn.commit()
         conn.close()
@@ -498,12 +945,720 @@ def delete_vault(vault_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@jobs.handler('delete_vault')
+def delete_vault_job(job, conn):
+    # Deletes the items in batches, committing after each one so other
+    # writers are never blocked for long; nested vaults go first, and
+    # vaults already removed by an earlier attempt drop out of the subtree
+    vault_id = ids.parse(job.payload['vault_id'])
+    c = conn.cursor()
+    vault_ids = vault_tree.subtree(c, vault_id)
+    total = vault_tree.total_items(c, vault_id)
+    deleted = 0
+    
+    for subtree_id in vault_ids:
+        while True:
+            c.execute('''
+                SELECT id, fingerprint, strength_score, password_changed_at, is_honeytoken,
+                       tags, category
+                FROM passwords WHERE vault_id = ? LIMIT ?
+            ''', (subtree_id, VAULT_DELETE_BATCH))
+            batch = c.fetchall()
+            if not batch:
+                break
+            c.executemany('DELETE FROM passwords WHERE id = ?', [(row['id'],) for row in batch])
+            vault_health.vault_removed(c, job.user_id, subtree_id,
+                                       [row for row in batch if not row['is_honeytoken']])
+            tags.items_removed(c, job.user_id, batch)
+            password_history.items_removed(c, [row['id'] for row in batch])
+            members = sharing.members(c, subtree_id)
+            listing_cache.bump(c, *members)
+            changes.publish(c, members, changes.ITEM_DELETED, subtree_id)
+            conn.commit()
+            deleted += len(batch)
+            job.progress(float(deleted) / max(total, 1), '%d of %d items deleted' % (deleted, total))
+        
+        c.execute('DELETE FROM vaults WHERE id = ? AND user_id = ?', (subtree_id, job.user_id))
+        members = sharing.vault_removed(c, subtree_id)
+        listing_cache.bump(c, *members)
+        changes.publish(c, members, changes.VAULT_DELETED, subtree_id)
+        vault_tree.remove_vault(c, subtree_id)
+        conn.commit()
+    return {"vault_id": ids.to_str(vault_id), "deleted_vaults": len(vault_ids), "deleted_items": deleted}
+
+# Users a vault is shared with
+@app.route('/api/vaults/<id:vault_id>/shares', methods=['GET'])
+def get_vault_shares(vault_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        if not access['can_share']:
+            conn.close()
+            return jsonify({"error": "Not allowed to share this vault"}), 403
+        
+        shares = sharing.list_shares(c, vault_id)
+        conn.close()
+        
+        return jsonify({"owner_id": access['owner_id'], "shares": shares}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Share a vault with another user, or change what they can do in it
+@app.route('/api/vaults/<id:vault_id>/shares', methods=['POST'])
+def share_vault(vault_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        data = request.get_json()
+        email = data.get('email')
+        permissions = dict((name, bool(data.get(name))) for name in sharing.PERMISSIONS)
+        
+        if not email:
+            return jsonify({"error": "Email required"}), 400
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        if not access['can_share']:
+            conn.close()
+            return jsonify({"error": "Not allowed to share this vault"}), 403
+        
+        # Members can pass on at most what they hold themselves
+        if any(granted and not access[name] for name, granted in permissions.items()):
+            conn.close()
+            return jsonify({"error": "Cannot grant permissions you do not have"}), 403
+        
+        c.execute('SELECT id FROM users WHERE email = ?', (email,))
+        target = c.fetchone()
+        if not target:
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        if target['id'] in (user_id, access['owner_id']):
+            conn.close()
+            return jsonify({"error": "Vault is already accessible to this user"}), 400
+        
+        created = sharing.grant(c, vault_id, target['id'], user_id, permissions)
+        listing_cache.bump(c, target['id'])
+        changes.publish(c, [target['id']], changes.VAULT_SHARED, vault_id)
+        
+        conn.commit()
+        conn.close()
+        
+        share = {"vault_id": vault_id, "user_id": target['id'], "email": email, "granted_by": user_id}
+        share.update(permissions)
+        return jsonify(share), 201 if created else 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Stop sharing a vault with a user; members can also remove themselves
+@app.route('/api/vaults/<id:vault_id>/shares/<member_id>', methods=['DELETE'])
+def revoke_vault_share(vault_id, member_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        access = sharing.access(c, user_id, vault_id)
+        if not access:
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        
+        granted_by = sharing.granted_by(c, vault_id, member_id)
+        if granted_by is None:
+            conn.close()
+            return jsonify({"error": "Share not found"}), 404
+        
+        # Owners revoke anyone, sharers revoke what they granted
+        if not (member_id == user_id or access['is_owner']
+                or (access['can_share'] and granted_by == user_id)):
+            conn.close()
+            return jsonify({"error": "Not allowed to revoke this share"}), 403
+        
+        sharing.revoke(c, vault_id, member_id)
+        listing_cache.bump(c, member_id)
+        changes.publish(c, [member_id], changes.VAULT_UNSHARED, vault_id)
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"message": "Share revoked"}), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def build_export(c, user_id, vault_ids):
+    # Without explicit vault_ids every real vault is exported
+    if vault_ids:
+        placeholders = ', '.join('?' * len(vault_ids))
+        c.execute('''
+            SELECT id, name, description, icon, created_at FROM vaults
+            WHERE user_id = ? AND id IN (%s)
+        ''' % placeholders, [user_id] + vault_ids)
+    else:
+        c.execute('''
+            SELECT id, name, description, icon, created_at FROM vaults
+            WHERE user_id = ? AND is_decoy = 0
+        ''', (user_id,))
+    vaults = [dict(row) for row in c.fetchall()]
+    
+    for vault in vaults:
+        c.execute('''
+            SELECT id, title, username, password, url, notes, category, tags, created_at, updated_at
+            FROM passwords WHERE vault_id = ? ORDER BY created_at
+        ''', (vault['id'],))
+        vault['passwords'] = [dict(row) for row in c.fetchall()]
+        for item in vault['passwords']:
+            item['tags'] = tags.decode(item['tags'])
+    
+    return {
+        "exported_at": datetime.now().isoformat(),
+        "vaults": vaults
+    }
+
+# Export vaults with their passwords; ?async=1 runs it as a background job
+@app.route('/api/export', methods=['GET'])
+def export_vaults():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        vault_ids = [ids.parse(vault_id) for vault_id in request.args.getlist('vault_id')]
+        for vault_id in vault_ids:
+            trip_honeytoken(vault_id, 'export', user_id)
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        if request.args.get('async') in ('1', 'true'):
+            job_id = jobs.enqueue(c, 'export', {"vault_ids": request.args.getlist('vault_id')},
+                                  user_id, priority=10)
+            conn.commit()
+            conn.close()
+            return jsonify({"message": "Export scheduled", "job_id": job_id}), 202
+        
+        export = build_export(c, user_id, vault_ids)
+        conn.close()
+        
+        return jsonify(export), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@jobs.handler('export')
+def export_job(job, conn):
+    vault_ids = [ids.parse(vault_id) for vault_id in job.payload.get('vault_ids', [])]
+    export = build_export(conn.cursor(), job.user_id, vault_ids)
+    # Exports hold plaintext secrets: owner-only file, removed with the job
+    fd = os.open(jobs.result_path(job.id), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(serialization.dumps(export))
+    return {
+        "vaults": len(export['vaults']),
+        "passwords": sum(len(vault['passwords']) for vault in export['vaults'])
+    }
+
+@jobs.handler('reconcile_health')
+def reconcile_health_job(job, conn):
+    c = conn.cursor()
+    vault_health.rebuild_health(c)
+    tags.rebuild_tags(c)
+    vault_tree.rebuild_tree(c)
+    sharing.rebuild_acl(c)
+    # Backfilled strength scores show up in item listings
+    listing_cache.bump_all(c)
+    changes.publish_all(c)
+    return {"reconciled": True}
+
+@jobs.handler('backup')
+def backup_job(job, conn):
+    # No progress reports: writing them to the database would restart the
+    # copy; the lease heartbeat writes once every jobs.HEARTBEAT seconds only
+    manifest = backup.create_backup(DATABASE)
+    return {"name": manifest['name'], "backup_bytes": manifest['backup_bytes']}
+
+@jobs.periodic(changes.PRUNE_INTERVAL)
+def prune_change_events(conn):
+    changes.prune(conn)
+
+@jobs.handler('rotate_fingerprint_key')
+def rotate_fingerprint_key_job(job, conn):
+    # A retry keeps the key installed by the first attempt
+    if job.attempts == 1:
+        fingerprints.rotate_key()
+    
+    # Other workers keep fingerprinting with the old key until they recheck
+    # the key file; rescan only once none of them can still be using it, so
+    # every row written before that is recomputed below
+    job.progress(0.0, 'Waiting for workers to load the new key')
+    time.sleep(fingerprints.KEY_SWITCH_DELAY)
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM passwords WHERE is_honeytoken = 0')
+    total = c.fetchone()[0]
+    done = 0
+    last_rowid = 0
+    
+    while True:
+        c.execute('''
+            SELECT p.rowid, p.id, v.user_id, p.password FROM passwords p
+            JOIN vaults v ON p.vault_id = v.id
+            WHERE p.is_honeytoken = 0 AND p.rowid > ?
+            ORDER BY p.rowid LIMIT 1000
+        ''', (last_rowid,))
+        batch = c.fetchall()
+        if not batch:
+            break
+        c.executemany('UPDATE passwords SET user_id = ?, fingerprint = ? WHERE id = ?',
+                      [(row['user_id'], fingerprints.fingerprint(row['user_id'], row['password']), row['id'])
+                       for row in batch])
+        conn.commit()
+        last_rowid = batch[-1]['rowid']
+        done += len(batch)
+        job.progress(0.9 * done / max(total, 1), '%d of %d fingerprints recomputed' % (done, total))
+    
+    # Writes that raced with the rotation may have left reuse counters off
+    vault_health.rebuild_health(c)
+    return {"fingerprints": done}
+
+# Seed a decoy vault for users created before honeytokens existed
+@app.route('/api/honeytokens/seed', methods=['POST'])
+def seed_honeytokens():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        c.execute('SELECT id FROM users WHERE id = ?', (user_id,))
+        if not c.fetchone():
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        
+        # Decoys stay out of listings and the change feed
+        decoy_vault_id = honeytokens.seed_user(c, user_id)
+        
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"decoy_vault_id": decoy_vault_id}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Honeytoken alerts raised against the user's decoys
+@app.route('/api/honeytokens/alerts', methods=['GET'])
+def get_honeytoken_alerts():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        alerts = honeytokens.get_alerts(c, user_id)
+        conn.close()
+        
+        return jsonify(alerts), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Groups of items across the user's vaults that share the same password
+@app.route('/api/passwords/reuse', methods=['GET'])
+def get_reuse_report():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        groups = fingerprints.reuse_report(c, user_id)
+        conn.close()
+        
+        return jsonify({"groups": groups}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Check how many items already use a password before saving it
+@app.route('/api/passwords/reuse-check', methods=['POST'])
+def check_reuse():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        data = request.get_json()
+        password = data.get('password')
+        
+        if not password:
+            return jsonify({"error": "Password required"}), 400
+        
+        conn = get_db()
+        c = conn.cursor()
+        count = fingerprints.reuse_count(c, user_id, fingerprints.fingerprint(user_id, password),
+                                         exclude_id=ids.parse(data.get('exclude_id')))
+        conn.close()
+        
+        return jsonify({"reused_in": count}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Tag and category counts across the user's items
+@app.route('/api/tags', methods=['GET'])
+def get_tags():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        result = tags.facets(c, user_id)
+        conn.close()
+        
+        return jsonify(result), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Items carrying every given ?tag= (and in ?category=), across the user's vaults
+@app.route('/api/passwords', methods=['GET'])
+def filter_passwords():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        try:
+            tag_list = tags.normalize_tags(request.args.getlist('tag'))
+            category = tags.normalize_category(request.args.get('category'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        if not tag_list and not category:
+            return jsonify({"error": "Tag or category required"}), 400
+        
+        conn = get_db()
+        c = conn.cursor()
+        c.row_factory = None
+        if tags.filter_items(c, user_id, tag_list, category):
+            body = serialization.encode_rows(c.description, c.fetchall(), json_columns=('tags',))
+        else:
+            body = b'[]'
+        conn.close()
+        
+        return serialization.body_response(app, body)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Generator policies available to clients
+@app.route('/api/generator/policies', methods=['GET'])
+def get_generator_policies():
+    return jsonify(generator.POLICIES), 200
+
+# Generate a batch of passwords or passphrases from a named policy
+@app.route('/api/generator', methods=['POST'])
+def generate_passwords():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data, dict):
+            return jsonify({"error": "Request body must be a JSON object"}), 400
+        policy_name = data.get('policy', 'default')
+        
+        try:
+            count = int(data.get('count', 1))
+            results, bits, policy = generator.generate(policy_name, count, data)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        
+        return jsonify({
+            "policy": policy_name,
+            "settings": policy,
+            "entropy_bits": round(bits, 1),
+            "passwords": results
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Password health report across all of the user's vaults
+@app.route('/api/vault-health', methods=['GET'])
+def get_user_health():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        report = vault_health.health_report(c, 'user', user_id)
+        conn.close()
+        
+        return jsonify(report), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Password health report for a single vault
+@app.route('/api/vaults/<id:vault_id>/health', methods=['GET'])
+def get_vault_health(vault_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        c = conn.cursor()
+        
+        # Verify the user can see the vault
+        if not sharing.access(c, user_id, vault_id):
+            conn.close()
+            return jsonify({"error": "Vault not found"}), 404
+        
+        report = vault_health.health_report(c, 'vault', vault_id)
+        conn.close()
+        
+        report['vault_id'] = vault_id
+        return jsonify(report), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Fingerprinted URLs for every file in public/
+@app.route('/api/assets/manifest', methods=['GET'])
+def get_asset_manifest():
+    return jsonify(static_assets.index.manifest()), 200
+
+# Prometheus scrape endpoint, merged across all workers
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if metrics.TOKEN and request.headers.get('Authorization') != 'Bearer ' + metrics.TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+    body = metrics.render(metrics.collect())
+    return app.response_class(body, mimetype='text/plain; version=0.0.4')
+
+# Security events of the calling user, newest first
+@app.route('/api/audit', methods=['GET'])
+def get_audit_events():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        return audit_response(user_id)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Security events of every user, or of one with ?user_id=
+@app.route('/api/admin/audit', methods=['GET'])
+def get_admin_audit_events():
+    try:
+        if not is_admin():
+            return jsonify({"error": "Admin key required"}), 403
+        
+        return audit_response(request.args.get('user_id') or None)
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def audit_response(user_id):
+    try:
+        since = audit.parse_time(request.args.get('since'))
+        until = audit.parse_time(request.args.get('until'))
+    except ValueError:
+        return jsonify({"error": "since and until must be epoch seconds or ISO 8601 timestamps"}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    events = audit.query(user_id, since, until, request.args.get('type'), limit)
+    return jsonify({"events": events, "count": len(events)}), 200
+
+# Vault and item changes after ?since=<id>, for clients that poll
+@app.route('/api/changes', methods=['GET'])
+def get_changes():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        events, last_id, resync = changes.pending(conn.cursor(), user_id,
+                                                  changes.parse_last_id(request.args.get('since')))
+        conn.close()
+        
+        return jsonify({"events": events, "last_event_id": last_id, "resync": resync}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Server-Sent Events; asgi.py keeps the stream open, here it sends what is
+# pending and the client reconnects with Last-Event-ID after the retry delay
+@app.route('/api/changes/stream', methods=['GET'])
+def stream_changes():
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        last_id = changes.parse_last_id(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+        conn = get_db()
+        body = changes.backlog(*changes.pending(conn.cursor(), user_id, last_id))
+        conn.close()
+        
+        response = app.response_class(body, mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Statements slower than AGIES_SLOW_QUERY_MS, worst total time first
+@app.route('/api/admin/slow-queries', methods=['GET'])
+def get_slow_queries():
+    try:
+        if not is_admin():
+            return jsonify({"error": "Admin key required"}), 403
+        
+        top = min(request.args.get('top', 20, type=int), 200)
+        return jsonify({
+            "threshold_ms": slowlog.THRESHOLD_MS,
+            "queries": slowlog.summarize(top=top)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Status and progress of a background job
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id and not is_admin():
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        job = jobs.get_job(conn.cursor(), job_id)
+        conn.close()
+        
+        if not job or (job['user_id'] != user_id and not is_admin()):
+            return jsonify({"error": "Job not found"}), 404
+        
+        return jsonify(job), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Download the file produced by a finished export job
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    try:
+        user_id = request.headers.get('X-User-ID')
+        if not user_id:
+            return jsonify({"error": "Authentication required"}), 401
+        
+        conn = get_db()
+        job = jobs.get_job(conn.cursor(), job_id)
+        conn.close()
+        
+        if not job or job['user_id'] != user_id or job['job_type'] != 'export':
+            return jsonify({"error": "Job not found"}), 404
+        if job['status'] != 'succeeded':
+            return jsonify({"error": "Export is not ready", "status": job['status']}), 409
+        
+        path = os.path.abspath(jobs.result_path(job_id))
+        if not os.path.exists(path):
+            return jsonify({"error": "Export has expired"}), 410
+        return send_file(path, mimetype='application/json', as_attachment=True,
+                         download_name='agies-export.json')
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Listing cache backend, hit ratio and evictions for this worker
+@app.route('/api/admin/cache', methods=['GET'])
+def get_cache_stats():
+    if not is_admin():
+        return jsonify({"error": "Admin key required"}), 403
+    return jsonify(listing_cache.stats()), 200
+
+# Backups in AGIES_BACKUP_DIR, newest first
+@app.route('/api/admin/backups', methods=['GET'])
+def get_backups():
+    try:
+        if not is_admin():
+            return jsonify({"error": "Admin key required"}), 403
+        
+        backups = backup.list_backups()
+        for manifest in backups:
+            del manifest['path']
+        return jsonify({"backups": backups, "keep": backup.KEEP, "interval": backup.INTERVAL}), 200
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Queue a maintenance job (reconcile_health, rotate_fingerprint_key, backup)
+@app.route('/api/admin/jobs', methods=['POST'])
+def create_admin_job():
+    try:
+        if not is_admin():
+            return jsonify({"error": "Admin key required"}), 403
+        
+        data = request.get_json() or {}
+        job_type = data.get('type')
+        if job_type not in ('reconcile_health', 'rotate_fingerprint_key', 'backup'):
+            return jsonify({"error": "Unknown job type"}), 400
+        
+        conn = get_db()
+        job_id = jobs.enqueue(conn.cursor(), job_type)
+        conn.commit()
+        conn.close()
+        
+        return jsonify({"message": "Job scheduled", "job_id": job_id}), 202
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # Serve static files for frontend
 @app.route('/<path:path>')
 def serve_frontend(path):
     if path == '' or path == 'index.html':
-        return send_from_directory('../public', 'index-simple.html')
-    return send_from_directory('../public', path)
+        path = 'index-simple.html'
+    response = static_assets.serve(app, path)
+    if response is None:
+        abort(404)
+    return response
+
+# Workers start once every job handler above is registered
+jobs.start(DATABASE)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
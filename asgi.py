@@ -0,0 +1,725 @@
+"""ASGI entry point serving the same API from an event loop.
+
+Run with an ASGI server, for example:
+
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker
+
+The routes that clients poll or that are dominated by bcrypt (health, login,
+profile, vault and password listings) are served natively: SQLite is accessed
+through a small pool of aiosqlite connections and bcrypt runs on a CPU thread
+pool, so thousands of idle or polling connections cost one coroutine each
+instead of one worker each.  Every other route is handed to the Flask app
+from app.py on a thread pool, so behaviour, status codes and response bodies
+are identical to the WSGI deployment.
+
+Native routes keep the Flask app's instrumentation: their pooled connections
+are opened with db.connect(), so statements feed the slow-query log and the
+per-request database stats in /metrics, and requests are captured (capture.py)
+and audited like their Flask twins.  Requests picked for profiling
+(profiling.py) are handed to the Flask app together with the chosen modes,
+except on the change feed, which always stays native.
+
+The change feed (GET /api/changes/stream) is only truly streamed here: each
+open stream is a coroutine waiting on a queue, and one watcher task per
+process reads new change_events rows and hands them to the queues of the
+users they belong to (see changes.py).
+"""
+import asyncio
+import contextvars
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import aiosqlite
+import bcrypt
+from werkzeug.wsgi import ClosingIterator
+
+import audit
+import capture
+import changes
+import compression
+import db
+import honeytokens
+import ids
+import listing_cache
+import metrics
+import profiling
+import serialization
+import static_assets
+from app import DATABASE, admin_key_matches, app as flask_app
+
+DB_POOL_SIZE = int(os.environ.get('AGIES_ASGI_DB_POOL', 4))
+ITER_CHUNK_SIZE = 64
+WSGI_THREADS = int(os.environ.get('AGIES_ASGI_THREADS', 32))
+
+logger = logging.getLogger('agies.asgi')
+
+_cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='asgi-bcrypt')
+_wsgi_pool = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix='asgi-wsgi')
+
+
+class ConnectionPool:
+    # aiosqlite runs each connection on its own thread, so connections are
+    # opened once and shared between requests rather than per request
+    def __init__(self, database, size):
+        self.database = database
+        self.size = size
+        self.idle = None
+        self.connections = []
+
+    async def _open(self):
+        self.idle = asyncio.Queue()
+        for _ in range(self.size):
+            opened = []
+
+            def connect():
+                # Runs on the connection's thread; same setup as get_db()
+                conn = db.connect(self.database)
+                conn.row_factory = sqlite3.Row
+                opened.append(conn)
+                return conn
+
+            conn = await aiosqlite.Connection(connect, ITER_CHUNK_SIZE)
+            conn.instrumented = opened[0]
+            self.connections.append(conn)
+            self.idle.put_nowait(conn)
+
+    async def acquire(self):
+        if self.idle is None:
+            await self._open()
+        conn = await self.idle.get()
+        # Statements run on the connection's thread, which cannot see the
+        # request's context; count them against this request explicitly
+        conn.instrumented.request_stats = db.current_stats()
+        return conn
+
+    def release(self, conn):
+        conn.instrumented.request_stats = None
+        self.idle.put_nowait(conn)
+
+    async def close(self):
+        for conn in self.connections:
+            await conn.close()
+        self.connections = []
+        self.idle = None
+
+
+_db = ConnectionPool(DATABASE, DB_POOL_SIZE)
+
+
+class Request:
+    def __init__(self, scope, body, receive=None):
+        self.scope = scope
+        self.body = body
+        self.receive = receive
+        self.headers = {}
+        self.data = None
+        # What _send_json() sent, for capture
+        self.response_data = None
+        self.response_length = None
+        # Fields for the audit event, like flask.g.audit
+        self.audit = {}
+        for name, value in scope['headers']:
+            self.headers[name.decode('latin-1').lower()] = value.decode('latin-1')
+
+    def parse_json(self):
+        # Returns False when Flask would reject the body, so the request can
+        # be handed over to Flask and fail in exactly the same way
+        mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        if mimetype != 'application/json' and not (
+                mimetype.startswith('application/') and mimetype.endswith('+json')):
+            return False
+        try:
+            self.data = json.loads(self.body)
+        except ValueError:
+            return False
+        return isinstance(self.data, dict)
+
+    @property
+    def args(self):
+        query = parse_qs(self.scope.get('query_string', b'').decode('latin-1'))
+        return dict((name, values[0]) for name, values in query.items())
+
+    @property
+    def remote_addr(self):
+        client = self.scope.get('client')
+        return client[0] if client else None
+
+
+def _cors_headers(request):
+    # Same headers Flask-CORS adds with its default configuration
+    origin = request.headers.get('origin')
+    if origin:
+        return [(b'access-control-allow-origin', origin.encode('latin-1')), (b'vary', b'Origin')]
+    return [(b'access-control-allow-origin', b'*')]
+
+
+async def _send_json(send, request, obj, status=200, encoded=None):
+    # Same encoder, trailing newline and compression rules as the Flask app
+    body = (encoded if encoded is not None else serialization.dumps(obj)) + b'\n'
+    request.response_data = obj
+    request.response_length = len(body)
+    headers = [(b'content-type', b'application/json')]
+    encoding = compression.negotiate(request.headers.get('accept-encoding'))
+    if encoding and len(body) >= compression.MIN_SIZE and not compression.saturated():
+        loop = asyncio.get_running_loop()
+        body = await loop.run_in_executor(_cpu_pool, compression.compress, body, encoding)
+        headers.append((b'content-encoding', encoding.encode('latin-1')))
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+    headers.extend(_cors_headers(request))
+    headers.append((b'vary', b'Accept-Encoding'))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _in_pool(pool, fn, *args):
+    # run_in_executor() in the request's context, so database and bcrypt
+    # time are counted against the request
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(pool, context.run, fn, *args)
+
+
+async def health(request, send):
+    await _send_json(send, request, {"status": "healthy", "timestamp": datetime.now().isoformat()})
+
+
+def _checkpw(password, password_hash):
+    with metrics.time_bcrypt('check'):
+        return bcrypt.checkpw(password, password_hash)
+
+
+async def login(request, send):
+    try:
+        data = request.data
+        email = data.get('email')
+        password = data.get('password')
+
+        if not email or not password:
+            return await _send_json(send, request, {"error": "Email and password required"}, 400)
+
+        conn = await _db.acquire()
+        try:
+            async with conn.execute('SELECT id, password_hash FROM users WHERE email = ?', (email,)) as c:
+                user = await c.fetchone()
+        finally:
+            _db.release(conn)
+
+        if not user:
+            request.audit['metadata'] = {"email": email}
+            return await _send_json(send, request, {"error": "Invalid credentials"}, 401)
+        request.audit['user_id'] = user['id']
+
+        matches = await _in_pool(_cpu_pool, _checkpw, password.encode('utf-8'),
+                                 user['password_hash'].encode('utf-8'))
+        if matches:
+            return await _send_json(send, request, {
+                "message": "Login successful",
+                "user_id": user['id'],
+                "token": str(uuid.uuid4())
+            }, 200)
+        return await _send_json(send, request, {"error": "Invalid credentials"}, 401)
+
+    except Exception as e:
+        return await _send_json(send, request, {"error": str(e)}, 500)
+
+
+async def get_profile(request, send):
+    try:
+        user_id = request.headers.get('x-user-id')
+        if not user_id:
+            return await _send_json(send, request, {"error": "Authentication required"}, 401)
+
+        conn = await _db.acquire()
+        try:
+            async with conn.execute('SELECT id, email, created_at FROM users WHERE id = ?', (user_id,)) as c:
+                user = await c.fetchone()
+        finally:
+            _db.release(conn)
+
+        if not user:
+            return await _send_json(send, request, {"error": "User not found"}, 404)
+
+        return await _send_json(send, request, {
+            "id": user['id'],
+            "email": user['email'],
+            "created_at": user['created_at']
+        }, 200)
+
+    except Exception as e:
+        return await _send_json(send, request, {"error": str(e)}, 500)
+
+
+async def _cache_version(conn, user_id):
+    async with conn.execute('SELECT cache_version FROM users WHERE id = ?', (user_id,)) as c:
+        row = await c.fetchone()
+    return row[0] if row else None
+
+
+async def _cache_call(fn, *args):
+    # Network backends must not block the event loop
+    if listing_cache.backend is not None and listing_cache.backend.blocking:
+        return await asyncio.get_running_loop().run_in_executor(_wsgi_pool, fn, *args)
+    return fn(*args)
+
+
+async def get_vaults(request, send):
+    try:
+        user_id = request.headers.get('x-user-id')
+        if not user_id:
+            return await _send_json(send, request, {"error": "Authentication required"}, 401)
+
+        conn = await _db.acquire()
+        try:
+            version = await _cache_version(conn, user_id)
+            body = await _cache_call(listing_cache.get, user_id, version, 'vaults')
+            if body is None:
+                async with conn.execute('''
+                    SELECT v.id, v.user_id, v.parent_vault_id, v.name, v.description, v.icon,
+                           v.created_at, COUNT(p.id) as password_count,
+                           (SELECT SUM(d.password_count) FROM vault_tree t
+                            JOIN vaults d ON d.id = t.descendant_id
+                            WHERE t.ancestor_id = v.id) as total_password_count,
+                           a.is_owner, a.can_write, a.can_delete, a.can_share
+                    FROM vault_acl a
+                    JOIN vaults v ON v.id = a.vault_id
+                    LEFT JOIN passwords p ON v.id = p.vault_id
+                    WHERE a.user_id = ? AND v.is_decoy = 0
+                    GROUP BY v.id
+                ''', (user_id,)) as c:
+                    body = serialization.encode_rows(c.description, await c.fetchall())
+                await _cache_call(listing_cache.put, user_id, version, 'vaults', body)
+        finally:
+            _db.release(conn)
+
+        return await _send_json(send, request, None, 200, encoded=body)
+
+    except Exception as e:
+        return await _send_json(send, request, {"error": str(e)}, 500)
+
+
+async def get_passwords(request, send, vault_id):
+    try:
+        user_id = request.headers.get('x-user-id')
+        if not user_id:
+            return await _send_json(send, request, {"error": "Authentication required"}, 401)
+
+        honeytokens.check(vault_id, 'read', user_id, request.remote_addr, request.headers.get('user-agent'))
+
+        conn = await _db.acquire()
+        try:
+            version = await _cache_version(conn, user_id)
+            body = await _cache_call(listing_cache.get, user_id, version, 'vault:' + vault_id.hex())
+            if body is None:
+                async with conn.execute('SELECT 1 FROM vault_acl WHERE user_id = ? AND vault_id = ?',
+                                        (user_id, vault_id)) as c:
+                    visible = await c.fetchone()
+                if not visible:
+                    return await _send_json(send, request, {"error": "Vault not found"}, 404)
+
+                async with conn.execute('''
+                    SELECT id, vault_id, title, username, password, url, notes, category,
+                           COALESCE(tags, '[]') as tags, strength_score,
+                           password_changed_at, created_at, updated_at
+                    FROM passwords WHERE vault_id = ? ORDER BY created_at DESC
+                ''', (vault_id,)) as c:
+                    body = serialization.encode_rows(c.description, await c.fetchall(),
+                                                     json_columns=('tags',))
+                await _cache_call(listing_cache.put, user_id, version, 'vault:' + vault_id.hex(), body)
+        finally:
+            _db.release(conn)
+
+        return await _send_json(send, request, None, 200, encoded=body)
+
+    except Exception as e:
+        return await _send_json(send, request, {"error": str(e)}, 500)
+
+
+class ChangeHub:
+    # Fans change_events rows out to the open streams of their users; the
+    # watcher only runs while someone is subscribed
+    def __init__(self):
+        self.subscribers = {}
+        self.position = None
+        self.task = None
+        self.lock = None
+
+    async def subscribe(self, user_id):
+        # Events after the current position go to the returned queue, so a
+        # backlog read afterwards overlaps it rather than leaving a gap
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.task is None:
+                conn = await _db.acquire()
+                try:
+                    async with conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'") as c:
+                        row = await c.fetchone()
+                finally:
+                    _db.release(conn)
+                self.position = row[0] if row else 0
+                # In a fresh context, so the watcher's queries are not
+                # counted against the request that happened to start it
+                loop = asyncio.get_running_loop()
+                self.task = contextvars.Context().run(loop.create_task, self._watch())
+            queue = asyncio.Queue(changes.BACKLOG_LIMIT)
+            self.subscribers.setdefault(user_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id, set())
+        queues.discard(queue)
+        if not queues:
+            self.subscribers.pop(user_id, None)
+
+    def _dispatch(self, row):
+        queues = self.subscribers.get(row[1])
+        if not queues:
+            return
+        event = changes.as_dict(row)
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client cannot keep up; replace what it missed with a resync
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait({"id": event['id'], "event": changes.RESYNC})
+
+    async def _poll(self):
+        conn = await _db.acquire()
+        try:
+            while True:
+                async with conn.execute('''
+                    SELECT %s FROM change_events WHERE id > ? ORDER BY id LIMIT ?
+                ''' % ', '.join(changes.COLUMNS), (self.position, changes.BACKLOG_LIMIT)) as c:
+                    rows = await c.fetchall()
+                for row in rows:
+                    self._dispatch(row)
+                if rows:
+                    self.position = rows[-1][0]
+                if len(rows) < changes.BACKLOG_LIMIT:
+                    break
+        finally:
+            _db.release(conn)
+
+    async def _watch(self):
+        try:
+            while self.subscribers:
+                try:
+                    await self._poll()
+                except Exception:
+                    logger.exception('Failed to read change events')
+                await asyncio.sleep(changes.POLL_INTERVAL)
+        finally:
+            self.task = None
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.subscribers = {}
+
+
+_changes = ChangeHub()
+
+
+def _pending_changes(user_id, last_id):
+    conn = db.connect(DATABASE)
+    try:
+        return changes.pending(conn.cursor(), user_id, last_id)
+    finally:
+        conn.close()
+
+
+async def _wait_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_changes(request, send):
+    try:
+        user_id = request.headers.get('x-user-id')
+        if not user_id:
+            return await _send_json(send, request, {"error": "Authentication required"}, 401)
+
+        last_id = changes.parse_last_id(request.headers.get('last-event-id') or request.args.get('last_event_id'))
+        queue = await _changes.subscribe(user_id)
+    except Exception as e:
+        return await _send_json(send, request, {"error": str(e)}, 500)
+
+    loop = asyncio.get_running_loop()
+    disconnected = loop.create_task(_wait_disconnect(request.receive))
+    metrics.inc('agies_change_stream_events_total', event='opened')
+    try:
+        events, last_id, resync = await _in_pool(_wsgi_pool, _pending_changes, user_id, last_id)
+        headers = [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                   (b'x-accel-buffering', b'no')]
+        headers.extend(_cors_headers(request))
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': changes.backlog(events, last_id, resync),
+                    'more_body': True})
+
+        while not disconnected.done():
+            getter = loop.create_task(queue.get())
+            done, _ = await asyncio.wait({getter, disconnected}, timeout=changes.KEEPALIVE,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if getter not in done:
+                getter.cancel()
+                if not disconnected.done():
+                    await send({'type': 'http.response.body', 'body': b': ping\n\n', 'more_body': True})
+                continue
+
+            # Send everything that is waiting in one write
+            batch = [getter.result()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            chunks = []
+            for event in batch:
+                # The backlog may already have covered the first few
+                if event['id'] <= last_id:
+                    continue
+                last_id = event['id']
+                chunks.append(changes.format_event(event['id'], event['event'], event))
+                if event['event'] == changes.RESYNC:
+                    metrics.inc('agies_change_stream_events_total', event='resync')
+            if chunks:
+                metrics.inc('agies_change_stream_events_total', len(chunks), event='sent')
+                await send({'type': 'http.response.body', 'body': b''.join(chunks), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        _changes.unsubscribe(user_id, queue)
+        metrics.inc('agies_change_stream_events_total', event='closed')
+
+
+# (method, path, handler, expects a JSON object body)
+ROUTES = [
+    ('GET', re.compile(r'^/api/health$'), health, False),
+    ('POST', re.compile(r'^/api/auth/login$'), login, True),
+    ('GET', re.compile(r'^/api/auth/profile$'), get_profile, False),
+    ('GET', re.compile(r'^/api/vaults$'), get_vaults, False),
+    ('GET', re.compile(r'^/api/vaults/(?P<vault_id>[^/]+)/passwords$'), get_passwords, False),
+    ('GET', re.compile(r'^/api/changes/stream$'), stream_changes, False),
+]
+
+# Route templates of the Flask twins, for capture records
+RULES = dict((rule.endpoint, rule.rule) for rule in flask_app.url_map.iter_rules())
+
+
+def _wsgi_environ(scope, body):
+    path = scope.get('root_path', '') + scope['path']
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+        'RAW_URI': path,
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'] = server[0]
+    environ['SERVER_PORT'] = str(server[1])
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+        environ['REMOTE_PORT'] = str(client[1])
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE' or name == 'CONTENT_LENGTH':
+            key = name
+        else:
+            key = 'HTTP_' + name
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+async def _call_wsgi(scope, body, send, extra_environ=None):
+    loop = asyncio.get_running_loop()
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]
+
+    def run_app():
+        # Ordinary Flask responses (a ClosingIterator with a Content-Length)
+        # are read to the end on the same thread; only real streams, i.e.
+        # generators without a length and direct_passthrough files, are
+        # returned to be pulled chunk by chunk
+        result = flask_app(environ, start_response)
+        buffered = isinstance(result, (list, tuple)) or (
+            isinstance(result, ClosingIterator)
+            and any(name == b'content-length' for name, _ in response['headers']))
+        if not buffered:
+            return result, None
+        try:
+            return None, b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    environ = _wsgi_environ(scope, body)
+    if extra_environ:
+        environ.update(extra_environ)
+    result, content = await loop.run_in_executor(_wsgi_pool, run_app)
+    if result is None:
+        await send({'type': 'http.response.start', 'status': response['status'],
+                    'headers': response['headers']})
+        await send({'type': 'http.response.body', 'body': content})
+        return
+
+    try:
+        # Streamed responses: pull chunks off the iterator on the pool
+        iterator = iter(result)
+        started = False
+        while True:
+            chunk = await loop.run_in_executor(_wsgi_pool, next, iterator, None)
+            if not started:
+                await send({'type': 'http.response.start', 'status': response['status'],
+                            'headers': response['headers']})
+                started = True
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(result, 'close'):
+            await loop.run_in_executor(_wsgi_pool, result.close)
+
+
+async def _serve_static(scope, send):
+    # Answers from the in-memory asset index without touching a thread;
+    # returns False for unknown paths and files that live on disk only
+    path = scope['path'].lstrip('/')
+    if path == '' or path == 'index.html':
+        path = 'index-simple.html'
+    asset, fingerprinted = static_assets.index.lookup(path)
+    if asset is None:
+        return False
+
+    request = Request(scope, b'')
+    status, headers, body = static_assets.plan(asset, fingerprinted, scope['method'],
+                                               request.headers.get('if-none-match'),
+                                               request.headers.get('accept-encoding'))
+    if body is None:
+        return False
+
+    raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+    raw_headers.extend(_cors_headers(request))
+    await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': body})
+    return True
+
+
+async def _metered(handler, request, send, kwargs):
+    # Native routes report under the same endpoint names as their Flask twins
+    endpoint = handler.__name__
+    start = time.perf_counter()
+    stats, token = db.begin_request(endpoint)
+    captured = capture.sampled(request.scope['path'])
+    sent = {'status': 500, 'bytes': 0}
+
+    async def metered_send(message):
+        if message['type'] == 'http.response.start':
+            sent['status'] = message['status']
+        else:
+            sent['bytes'] += len(message.get('body', b''))
+        await send(message)
+
+    try:
+        return await handler(request, metered_send, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        db.end_request(token)
+        metrics.record_request(endpoint, request.scope['method'], sent['status'], elapsed, stats,
+                               response_bytes=sent['bytes'])
+        if captured:
+            capture.record(request.scope['method'], endpoint, RULES[endpoint], sent['status'],
+                           elapsed, request.response_length, view_args=kwargs,
+                           user_id=request.headers.get('x-user-id'), args=request.args,
+                           body=request.data, response_data=request.response_data)
+        audit.request_event(endpoint, sent['status'],
+                            request.audit.get('user_id') or request.headers.get('x-user-id'),
+                            kwargs.get('vault_id'), kwargs.get('vault_id'), request.remote_addr,
+                            request.headers.get('user-agent'), request.audit.get('metadata'))
+
+
+def _profile_modes(request):
+    # The decision Flask's profiling hook would make, taken once here
+    header = request.headers.get('x-agies-profile')
+    return profiling.select_modes(header, request.headers.get('x-user-id'),
+                                  bool(header) and admin_key_matches(request.headers.get('x-admin-key')))
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await _changes.close()
+            await _db.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    body = await _read_body(receive)
+    if scope['method'] in ('GET', 'HEAD') and not scope['path'].startswith('/api/'):
+        if await _serve_static(scope, send):
+            return
+
+    request = Request(scope, body, receive)
+    for method, pattern, handler, expects_json in ROUTES:
+        if scope['method'] != method:
+            continue
+        match = pattern.match(scope['path'])
+        if not match:
+            continue
+        if expects_json and not request.parse_json():
+            break
+        if handler is not stream_changes:
+            modes = _profile_modes(request)
+            if modes:
+                return await _call_wsgi(scope, body, send, {profiling.ENVIRON_KEY: modes})
+        # Path ids go through the same conversion as Flask's id converter
+        kwargs = dict((name, ids.parse(value)) for name, value in match.groupdict().items())
+        return await _metered(handler, request, send, kwargs)
+
+    await _call_wsgi(scope, body, send)
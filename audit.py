@@ -0,0 +1,354 @@
+"""Append-only security event log with a batched background writer.
+
+Requests never write audit rows themselves.  The after_request hook (and
+record() for events outside a request) puts a tuple on an in-memory queue;
+a writer thread drains it every AGIES_AUDIT_FLUSH seconds, or as soon as
+AGIES_AUDIT_BATCH events are waiting, and inserts each batch in a single
+transaction.  Events are partitioned by month into separate SQLite files:
+
+    <AGIES_AUDIT_DIR>/audit-YYYYMM.db    table security_events
+
+so audit writes never take the main database's write lock, and retention is
+a file delete: partitions whose month ended more than
+AGIES_AUDIT_RETENTION_DAYS ago are removed by the writer.  Rows cannot be
+updated or deleted (triggers abort the statement).  Per-user range queries
+walk the partitions that overlap the range, newest first, on the
+(user_id, created_at) index and stop as soon as the limit is reached.
+
+AGIES_AUDIT_DIR is made absolute at import, so the flush at exit still finds
+it after a chdir.  Events still in the queue are not visible to queries yet.
+If the queue is full (AGIES_AUDIT_QUEUE_MAX) new events are dropped and
+counted in agies_audit_events_total{event="dropped"} rather than blocking
+requests.
+"""
+import atexit
+import calendar
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+from flask import g, request
+
+import ids
+import metrics
+
+ENABLED = os.environ.get('AGIES_AUDIT', '1') not in ('0', 'false', 'off')
+AUDIT_DIR = os.path.abspath(os.environ.get('AGIES_AUDIT_DIR', 'audit'))
+FLUSH_INTERVAL = float(os.environ.get('AGIES_AUDIT_FLUSH', 0.5))
+BATCH_SIZE = int(os.environ.get('AGIES_AUDIT_BATCH', 500))
+QUEUE_MAX = int(os.environ.get('AGIES_AUDIT_QUEUE_MAX', 100000))
+RETENTION_DAYS = int(os.environ.get('AGIES_AUDIT_RETENTION_DAYS', 365))
+PRUNE_INTERVAL = 3600
+
+# Flask endpoint -> event type; other endpoints are not audited
+EVENTS = {
+    'register': 'auth.register',
+    'login': 'auth.login',
+    'get_passwords': 'vault.read',
+    'filter_passwords': 'item.search',
+    'add_password': 'item.create',
+    'update_password': 'item.update',
+    'delete_password': 'item.delete',
+    'get_password_history': 'item.history',
+    'create_vault': 'vault.create',
+    'update_vault': 'vault.update',
+    'delete_vault': 'vault.delete',
+    'move_vault': 'vault.move',
+    'share_vault': 'vault.share',
+    'revoke_vault_share': 'vault.unshare',
+    'export_vaults': 'vault.export',
+}
+
+COLUMNS = ('created_at', 'user_id', 'event_type', 'severity', 'status', 'target_id',
+           'vault_id', 'ip_address', 'user_agent', 'metadata')
+
+logger = logging.getLogger('agies.audit')
+
+_events = queue.Queue(QUEUE_MAX)
+_started = False
+_last_prune = 0.0
+
+
+def partition_name(timestamp):
+    return 'audit-%s.db' % time.strftime('%Y%m', time.gmtime(timestamp))
+
+
+def _month_bounds(year, month):
+    start = calendar.timegm((year, month, 1, 0, 0, 0))
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return start, calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def partitions(since=None, until=None):
+    # Existing partition files overlapping [since, until), newest first
+    try:
+        names = os.listdir(AUDIT_DIR)
+    except OSError:
+        return []
+    found = []
+    for name in names:
+        if not (name.startswith('audit-') and name.endswith('.db') and len(name) == 15):
+            continue
+        try:
+            start, end = _month_bounds(int(name[6:10]), int(name[10:12]))
+        except ValueError:
+            continue
+        if (since is not None and end <= since) or (until is not None and start >= until):
+            continue
+        found.append((start, end, os.path.join(AUDIT_DIR, name)))
+    found.sort(reverse=True)
+    return found
+
+
+def _open_partition(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS security_events (
+            id INTEGER PRIMARY KEY,
+            created_at REAL NOT NULL,
+            user_id TEXT,
+            event_type TEXT NOT NULL,
+            severity TEXT NOT NULL,
+            status INTEGER,
+            target_id TEXT,
+            vault_id TEXT,
+            ip_address TEXT,
+            user_agent TEXT,
+            metadata TEXT
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_security_events_user ON security_events (user_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_security_events_time ON security_events (created_at)')
+    for action in ('UPDATE', 'DELETE'):
+        conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS security_events_no_%s BEFORE %s ON security_events
+            BEGIN SELECT RAISE(ABORT, 'security_events is append-only'); END
+        ''' % (action.lower(), action))
+    conn.commit()
+    return conn
+
+
+def record(event_type, user_id=None, status=None, severity='info', target_id=None, vault_id=None,
+           ip_address=None, user_agent=None, metadata=None):
+    # Never blocks; the event is written by the background writer
+    if not ENABLED:
+        return
+    event = (time.time(), user_id, event_type, severity, status, target_id, vault_id,
+             ip_address, user_agent, json.dumps(metadata) if metadata else None)
+    try:
+        _events.put_nowait(event)
+    except queue.Full:
+        metrics.inc('agies_audit_events_total', event='dropped')
+
+
+def annotate(**fields):
+    # Lets a handler fill in what the hook cannot see (e.g. the user of a login)
+    g.setdefault('audit', {}).update(fields)
+
+
+def request_event(endpoint, status, user_id=None, target_id=None, vault_id=None,
+                  ip_address=None, user_agent=None, metadata=None):
+    # Records the outcome of an audited endpoint; shared with asgi.py
+    event_type = EVENTS.get(endpoint)
+    if event_type is None:
+        return
+    # The log stores ids as the API shows them
+    if isinstance(target_id, bytes):
+        target_id = ids.to_str(target_id)
+    if isinstance(vault_id, bytes):
+        vault_id = ids.to_str(vault_id)
+    if status in (401, 403):
+        severity = 'warning'
+    elif status >= 500:
+        severity = 'error'
+    else:
+        severity = 'info'
+    record(event_type, user_id, status, severity, target_id, vault_id, ip_address, user_agent, metadata)
+
+
+def _after_request(response):
+    if request.endpoint not in EVENTS:
+        return response
+    fields = g.pop('audit', {})
+    view_args = request.view_args or {}
+
+    # Creates report the new object, everything else the object in the path
+    target_id = fields.get('target_id')
+    if target_id is None and response.status_code == 201 and not response.is_streamed:
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            target_id = data.get('id') or data.get('user_id')
+    target_id = target_id or view_args.get('password_id') or view_args.get('vault_id')
+
+    request_event(request.endpoint, response.status_code,
+                  fields.get('user_id') or request.headers.get('X-User-ID'), target_id,
+                  view_args.get('vault_id'), request.remote_addr, request.headers.get('User-Agent'),
+                  fields.get('metadata'))
+    return response
+
+
+def _prune(now):
+    global _last_prune
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    cutoff = now - RETENTION_DAYS * 86400
+    for start, end, path in partitions(until=cutoff):
+        if end > cutoff:
+            continue
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(path + suffix)
+            except OSError:
+                pass
+        logger.info('Removed audit partition %s', path)
+
+
+def _write(connections, batch):
+    by_partition = {}
+    for event in batch:
+        by_partition.setdefault(partition_name(event[0]), []).append(event)
+    for name, events in by_partition.items():
+        conn = connections.get(name)
+        if conn is None:
+            conn = connections[name] = _open_partition(os.path.join(AUDIT_DIR, name))
+        with conn:
+            conn.executemany('''
+                INSERT INTO security_events (%s) VALUES (%s)
+            ''' % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))), events)
+    metrics.inc('agies_audit_events_total', len(batch), event='written')
+
+    # Only the current month's partition keeps receiving events
+    current = partition_name(time.time())
+    for name in [name for name in connections if name != current]:
+        connections.pop(name).close()
+
+
+def _drain(limit):
+    batch = []
+    while len(batch) < limit:
+        try:
+            batch.append(_events.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def flush(connections=None):
+    # Writes everything queued so far; used at exit and by tests.  With its
+    # own connections it logs failures instead of raising, so an exit hook
+    # never dies with a traceback; the writer loop handles its own errors
+    own = connections is None
+    connections = {} if own else connections
+    batch = []
+    try:
+        while True:
+            batch = _drain(BATCH_SIZE)
+            if not batch:
+                break
+            _write(connections, batch)
+    except Exception:
+        if not own:
+            raise
+        logger.exception('Failed to write %d audit events', len(batch) + _events.qsize())
+    finally:
+        if own:
+            for conn in connections.values():
+                conn.close()
+
+
+def _writer_loop():
+    connections = {}
+    while True:
+        try:
+            first = _events.get(timeout=PRUNE_INTERVAL)
+        except queue.Empty:
+            _prune(time.time())
+            continue
+        # Let a batch build up unless one is already waiting
+        if _events.qsize() < BATCH_SIZE:
+            time.sleep(FLUSH_INTERVAL)
+        batch = [first] + _drain(BATCH_SIZE - 1)
+        try:
+            _write(connections, batch)
+            flush(connections)
+        except Exception:
+            logger.exception('Failed to write %d audit events', len(batch))
+            for conn in connections.values():
+                conn.close()
+            connections.clear()
+        _prune(time.time())
+
+
+def parse_time(value):
+    # Epoch seconds or an ISO 8601 timestamp (UTC unless it has an offset)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def query(user_id=None, since=None, until=None, event_type=None, limit=100):
+    # Newest first; since/until are epoch seconds, until is exclusive
+    conditions, params = [], []
+    if user_id is not None:
+        conditions.append('user_id = ?')
+        params.append(user_id)
+    if since is not None:
+        conditions.append('created_at >= ?')
+        params.append(since)
+    if until is not None:
+        conditions.append('created_at < ?')
+        params.append(until)
+    if event_type:
+        conditions.append('event_type = ?')
+        params.append(event_type)
+    where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
+
+    events = []
+    for start, end, path in partitions(since, until):
+        if len(events) >= limit:
+            break
+        conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True, timeout=30)
+        try:
+            rows = conn.execute('''
+                SELECT %s FROM security_events %s
+                ORDER BY created_at DESC LIMIT ?
+            ''' % (', '.join(COLUMNS), where), params + [limit - len(events)]).fetchall()
+        except sqlite3.OperationalError:
+            # Partition created but its table not committed yet
+            rows = []
+        finally:
+            conn.close()
+        for row in rows:
+            event = dict(zip(COLUMNS, row))
+            event['created_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(event['created_at']))
+            event['metadata'] = json.loads(event['metadata']) if event['metadata'] else None
+            events.append(event)
+    return events
+
+
+def init_app(app):
+    # Register after compression so created ids can be read from the body
+    global _started
+    if not ENABLED:
+        return
+    os.makedirs(AUDIT_DIR, exist_ok=True)
+    app.after_request(_after_request)
+    if not _started:
+        _started = True
+        threading.Thread(target=_writer_loop, name='audit-writer', daemon=True).start()
+        atexit.register(flush)
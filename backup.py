@@ -0,0 +1,486 @@
+"""Online backups of the SQLite database through the backup API.
+
+create_backup() copies the live database with sqlite3's backup API,
+AGIES_BACKUP_PAGES pages per step with a short pause between steps, so
+requests keep reading and writing while the copy runs.  A write from another
+connection restarts the copy; after AGIES_BACKUP_MAX_RESTARTS restarts the
+rest is copied in a single step, which holds a read lock for the duration of
+the copy.  The copy is checked with PRAGMA integrity_check before it is
+packaged into AGIES_BACKUP_DIR as
+
+    agies-YYYYMMDDTHHMMSSZ.bak        zlib-compressed unless AGIES_BACKUP_COMPRESS=0,
+                                      AES-256-GCM encrypted when AGIES_BACKUP_KEY is set
+    agies-YYYYMMDDTHHMMSSZ.bak.json   manifest: sizes, page count, sha256 of the .bak
+
+Encryption needs the cryptography package and a 64 hex character key.  The
+packaged file is a sequence of length-prefixed chunks, each encrypted with
+its own nonce and authenticated together with its position and the header,
+so a reordered or truncated backup fails to decrypt.  Only the newest
+AGIES_BACKUP_KEEP backups are kept.
+
+Backups run from the CLI, as a 'backup' job, or every AGIES_BACKUP_INTERVAL
+seconds from the app process (0 disables the schedule).  A lock file makes
+concurrent backups from several workers wait for each other, and a scheduled
+backup is skipped while a recent enough one exists:
+
+    python backup.py create [--database agies.db]
+    python backup.py list
+    python backup.py verify BACKUP
+    python backup.py restore BACKUP [--database agies.db]
+
+restore copies the backup into the target database through the backup API,
+so connections that are open keep working and see the restored contents.
+The restored listing cache versions and change feed ids would repeat ones
+already handed out, so they are moved past the old values: cached listings
+(listing_cache.py) are never served for restored data, and every user gets a
+resync event on the change feed.  The current contents are backed up first
+unless --no-safety-backup is given.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import changes
+from migrations import column_names, table_exists
+
+BACKUP_DIR = os.environ.get('AGIES_BACKUP_DIR', 'backups')
+PAGES_PER_STEP = int(os.environ.get('AGIES_BACKUP_PAGES', 256))
+STEP_PAUSE = float(os.environ.get('AGIES_BACKUP_PAUSE', 0.005))
+MAX_RESTARTS = int(os.environ.get('AGIES_BACKUP_MAX_RESTARTS', 3))
+KEEP = int(os.environ.get('AGIES_BACKUP_KEEP', 7))
+COMPRESS = os.environ.get('AGIES_BACKUP_COMPRESS', '1') not in ('0', 'false', 'off')
+INTERVAL = int(os.environ.get('AGIES_BACKUP_INTERVAL', 0))
+
+MAGIC = b'AGBK'
+VERSION = 1
+FLAG_ZLIB = 1
+FLAG_AESGCM = 2
+FINAL = 0x80000000
+CHUNK_SIZE = 1024 * 1024
+
+logger = logging.getLogger('agies.backup')
+
+_started = False
+
+
+class BackupError(Exception):
+    pass
+
+
+class _Restarted(Exception):
+    pass
+
+
+def encryption_key():
+    key = os.environ.get('AGIES_BACKUP_KEY')
+    if not key:
+        return None
+    key = bytes.fromhex(key)
+    if len(key) != 32:
+        raise BackupError('AGIES_BACKUP_KEY must be 32 bytes (64 hex characters)')
+    return key
+
+
+def _cipher(key):
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise BackupError('Encrypted backups need the cryptography package')
+    return AESGCM(key)
+
+
+def _lock():
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    f = open(os.path.join(BACKUP_DIR, '.lock'), 'w')
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def _copy(database, target, progress=None):
+    # Page-stepped copy of the live database; returns the page count.
+    # progress(fraction) must not write to the database being copied
+    source = sqlite3.connect(database, timeout=30)
+    dest = sqlite3.connect(target)
+    state = {'remaining': None, 'restarts': 0}
+
+    def step(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > MAX_RESTARTS:
+                raise _Restarted()
+        state['remaining'] = remaining
+        if progress:
+            progress(float(total - remaining) / max(total, 1))
+        time.sleep(STEP_PAUSE)
+
+    try:
+        try:
+            source.backup(dest, pages=PAGES_PER_STEP, progress=step)
+        except _Restarted:
+            logger.info('Backup restarted %d times; copying the rest in one step', state['restarts'])
+            source.backup(dest, pages=-1)
+        return dest.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        dest.close()
+        source.close()
+
+
+def _integrity(path):
+    conn = sqlite3.connect('file:%s?mode=ro' % path, uri=True)
+    try:
+        result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        pages = conn.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        conn.close()
+    return result == ['ok'], result, pages
+
+
+def pack(source, out, compress, key):
+    # Writes the readable binary file source to out in the backup format
+    flags = (FLAG_ZLIB if compress else 0) | (FLAG_AESGCM if key else 0)
+    prefix = os.urandom(8) if key else b''
+    header = MAGIC + bytes([VERSION, flags]) + prefix
+    out.write(header)
+    cipher = _cipher(key) if key else None
+    compressor = zlib.compressobj(6) if compress else None
+    counter = [0]
+
+    def emit(data, final):
+        if cipher:
+            aad = header + struct.pack('>IB', counter[0], final)
+            data = cipher.encrypt(prefix + struct.pack('>I', counter[0]), data, aad)
+        counter[0] += 1
+        out.write(struct.pack('>I', len(data) | (FINAL if final else 0)))
+        out.write(data)
+
+    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            emit(chunk, False)
+    emit(compressor.flush() if compressor else b'', True)
+
+
+def unpack(path, out):
+    with open(path, 'rb') as f:
+        header = f.read(6)
+        if len(header) < 6 or header[:4] != MAGIC or header[4] != VERSION:
+            raise BackupError('%s is not a backup file' % path)
+        flags = header[5]
+        cipher = None
+        if flags & FLAG_AESGCM:
+            key = encryption_key()
+            if key is None:
+                raise BackupError('%s is encrypted; set AGIES_BACKUP_KEY' % path)
+            cipher = _cipher(key)
+            header += f.read(8)
+        prefix = header[6:]
+        decompressor = zlib.decompressobj() if flags & FLAG_ZLIB else None
+        counter = 0
+        while True:
+            length = f.read(4)
+            if len(length) < 4:
+                raise BackupError('%s is truncated' % path)
+            length = struct.unpack('>I', length)[0]
+            final = 1 if length & FINAL else 0
+            data = f.read(length & ~FINAL)
+            if cipher:
+                aad = header + struct.pack('>IB', counter, final)
+                try:
+                    data = cipher.decrypt(prefix + struct.pack('>I', counter), data, aad)
+                except Exception:
+                    raise BackupError('%s cannot be decrypted with this key or is damaged' % path)
+            counter += 1
+            try:
+                if decompressor:
+                    data = decompressor.decompress(data)
+                    if final:
+                        data += decompressor.flush()
+            except zlib.error:
+                raise BackupError('%s is damaged' % path)
+            out.write(data)
+            if final:
+                break
+        if f.read(1):
+            raise BackupError('%s has data after its last chunk' % path)
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def list_backups():
+    # Newest first; a backup counts once its manifest is written
+    try:
+        names = os.listdir(BACKUP_DIR)
+    except OSError:
+        return []
+    backups = []
+    for name in sorted(names, reverse=True):
+        if not name.endswith('.bak.json'):
+            continue
+        try:
+            with open(os.path.join(BACKUP_DIR, name)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        manifest['path'] = os.path.join(BACKUP_DIR, name[:-5])
+        backups.append(manifest)
+    return backups
+
+
+def _rotate():
+    for manifest in list_backups()[KEEP:]:
+        for path in (manifest['path'], manifest['path'] + '.json'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        logger.info('Removed old backup %s', manifest['path'])
+
+
+def create_backup(database, progress=None, min_age=None):
+    # Returns the manifest of the new backup, or None when min_age is given
+    # and a backup younger than min_age seconds exists
+    key = encryption_key()
+    lock = _lock()
+    try:
+        if min_age is not None:
+            age = _newest_age()
+            if age is not None and age < min_age:
+                return None
+        started = time.time()
+        name = 'agies-%s.bak' % time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started))
+        path = os.path.join(BACKUP_DIR, name)
+        if os.path.exists(path + '.json'):
+            name = name[:-4] + '-%d.bak' % os.getpid()
+            path = os.path.join(BACKUP_DIR, name)
+
+        fd, copy_path = tempfile.mkstemp(prefix='.copy-', dir=BACKUP_DIR)
+        os.close(fd)
+        try:
+            _copy(database, copy_path, progress)
+            ok, result, pages = _integrity(copy_path)
+            if not ok:
+                raise BackupError('Integrity check failed on the copy: %s' % '; '.join(result[:5]))
+            database_bytes = os.path.getsize(copy_path)
+
+            partial = path + '.partial'
+            fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as out:
+                with open(copy_path, 'rb') as source:
+                    pack(source, out, COMPRESS, key)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(partial, path)
+        finally:
+            os.remove(copy_path)
+
+        manifest = {
+            "name": name,
+            "created_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(started)),
+            "duration_seconds": round(time.time() - started, 3),
+            "page_count": pages,
+            "database_bytes": database_bytes,
+            "backup_bytes": os.path.getsize(path),
+            "compressed": COMPRESS,
+            "encrypted": key is not None,
+            "sha256": _sha256(path)
+        }
+        with open(path + '.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
+        _rotate()
+        manifest['path'] = path
+        return manifest
+    finally:
+        lock.close()
+
+
+def _read_manifest(path):
+    try:
+        with open(path + '.json') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _restore_to_temp(path):
+    fd, target = tempfile.mkstemp(prefix='.restore-', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            unpack(path, out)
+    except Exception:
+        os.remove(target)
+        raise
+    return target
+
+
+def verify_backup(path):
+    # Checks the file against its manifest and the database it contains
+    manifest = _read_manifest(path)
+    problems = []
+    if manifest is None:
+        problems.append('manifest missing')
+    elif _sha256(path) != manifest['sha256']:
+        problems.append('sha256 does not match the manifest')
+
+    pages = None
+    try:
+        target = _restore_to_temp(path)
+    except BackupError as e:
+        problems.append(str(e))
+    else:
+        try:
+            ok, result, pages = _integrity(target)
+            if not ok:
+                problems.append('integrity check failed: %s' % '; '.join(result[:5]))
+            elif manifest is not None and pages != manifest['page_count']:
+                problems.append('page count %d does not match the manifest (%d)' % (
+                    pages, manifest['page_count']))
+        finally:
+            os.remove(target)
+    return {"path": path, "ok": not problems, "page_count": pages, "problems": problems}
+
+
+def _positions(conn):
+    # Highest listing cache version and change event id handed out so far
+    c = conn.cursor()
+    version = seq = 0
+    if table_exists(c, 'users') and 'cache_version' in column_names(c, 'users'):
+        version = c.execute('SELECT MAX(cache_version) FROM users').fetchone()[0] or 0
+    if table_exists(c, 'sqlite_sequence'):
+        row = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'").fetchone()
+        seq = row[0] if row else 0
+    return version, seq
+
+
+def _move_past(conn, version, seq):
+    # Every restored cache version ends up above every pre-restore one, and
+    # new change events above every id clients may have seen
+    c = conn.cursor()
+    with conn:
+        if 'cache_version' in column_names(c, 'users'):
+            c.execute('UPDATE users SET cache_version = cache_version + ?', (version + 1,))
+        if table_exists(c, 'change_events'):
+            row = c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'").fetchone()
+            if row is None:
+                c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_events', ?)", (seq,))
+            elif row[0] < seq:
+                c.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'change_events'", (seq,))
+            changes.publish_all(c)
+
+
+def restore_backup(path, database, safety_backup=True):
+    # Replaces the contents of database with the backup; returns the
+    # manifest of the safety backup taken first, if any
+    target = _restore_to_temp(path)
+    try:
+        ok, result, pages = _integrity(target)
+        if not ok:
+            raise BackupError('Integrity check failed on %s: %s' % (path, '; '.join(result[:5])))
+        safety = None
+        if safety_backup and os.path.exists(database):
+            safety = create_backup(database)
+        source = sqlite3.connect(target)
+        dest = sqlite3.connect(database, timeout=30)
+        try:
+            version, seq = _positions(dest)
+            source.backup(dest)
+            _move_past(dest, version, seq)
+        finally:
+            dest.close()
+            source.close()
+        return safety
+    finally:
+        os.remove(target)
+
+
+def _newest_age():
+    backups = list_backups()
+    if not backups:
+        return None
+    return time.time() - os.path.getmtime(backups[0]['path'])
+
+
+def _schedule_loop(database):
+    while True:
+        age = _newest_age()
+        if age is not None and age < INTERVAL:
+            time.sleep(INTERVAL - age)
+            continue
+        try:
+            # Skipped if another worker finished one while this one waited for the lock
+            manifest = create_backup(database, min_age=INTERVAL)
+            if manifest:
+                logger.info('Backup %s written in %.1fs', manifest['path'], manifest['duration_seconds'])
+        except Exception:
+            logger.exception('Scheduled backup failed')
+            time.sleep(min(INTERVAL, 300))
+
+
+def start(database):
+    global _started
+    if INTERVAL <= 0 or _started:
+        return
+    _started = True
+    threading.Thread(target=_schedule_loop, args=(database,), name='backup-scheduler',
+                     daemon=True).start()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Online backups of the Agies database.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help='back up the live database')
+    create.add_argument('--database', default='agies.db')
+    commands.add_parser('list', help='list backups, newest first')
+    verify = commands.add_parser('verify', help='check a backup against its manifest')
+    verify.add_argument('backup')
+    restore = commands.add_parser('restore', help='replace the database with a backup')
+    restore.add_argument('backup')
+    restore.add_argument('--database', default='agies.db')
+    restore.add_argument('--no-safety-backup', action='store_true')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'create':
+            manifest = create_backup(args.database)
+            print('%s  %d pages  %d -> %d bytes  %.1fs' % (
+                manifest['path'], manifest['page_count'], manifest['database_bytes'],
+                manifest['backup_bytes'], manifest['duration_seconds']))
+        elif args.command == 'list':
+            for manifest in list_backups():
+                print('%s  %s  %d bytes%s%s' % (
+                    manifest['path'], manifest['created_at'], manifest['backup_bytes'],
+                    '  compressed' if manifest['compressed'] else '',
+                    '  encrypted' if manifest['encrypted'] else ''))
+        elif args.command == 'verify':
+            report = verify_backup(args.backup)
+            print('%s: %s' % (args.backup, 'ok' if report['ok'] else '; '.join(report['problems'])))
+            return 0 if report['ok'] else 1
+        else:
+            safety = restore_backup(args.backup, args.database, not args.no_safety_backup)
+            if safety:
+                print('Previous contents saved to %s' % safety['path'])
+            print('Restored %s from %s' % (args.database, args.backup))
+    except BackupError as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
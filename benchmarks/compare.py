@@ -0,0 +1,83 @@
+"""Compare two benchmark result files.
+
+    python -m benchmarks.compare baseline.json candidate.json [--threshold 10]
+
+Prints throughput and p50/p95/p99 changes for every scenario and operation
+present in both files.  Exits with status 1 when any of them regressed by
+more than --threshold percent, so the command can gate CI jobs.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ('p50_ms', 'p95_ms', 'p99_ms')
+
+
+def change(old, new):
+    if not old or new is None:
+        return None
+    return (new - old) * 100.0 / old
+
+
+def compare(baseline, candidate, threshold):
+    rows, regressions = [], []
+    for size, old in sorted(baseline['scenarios'].items(), key=lambda item: int(item[0])):
+        new = candidate['scenarios'].get(size)
+        if new is None:
+            continue
+        # Throughput regresses when it drops
+        delta = change(old['throughput_rps'], new['throughput_rps'])
+        rows.append((size, '(throughput)', 'req/s', old['throughput_rps'], new['throughput_rps'], delta))
+        if delta is not None and -delta > threshold:
+            regressions.append((size, 'throughput', delta))
+
+        for name, old_op in sorted(old['ops'].items()):
+            new_op = new['ops'].get(name)
+            if new_op is None:
+                continue
+            for metric in METRICS:
+                delta = change(old_op[metric], new_op[metric])
+                rows.append((size, name, metric, old_op[metric], new_op[metric], delta))
+                if delta is not None and delta > threshold:
+                    regressions.append((size, '%s %s' % (name, metric), delta))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help='allowed slowdown in percent (default 10)')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for label, data in (('baseline', baseline), ('candidate', candidate)):
+        meta = data['meta']
+        print('%-9s %s  %s  mode=%s concurrency=%s requests=%s' % (
+            label, meta.get('commit'), meta.get('timestamp'), meta.get('mode'),
+            meta.get('concurrency'), meta.get('requests')))
+    if baseline['meta'].get('mode') != candidate['meta'].get('mode'):
+        print('warning: results were taken in different modes')
+    print()
+
+    rows, regressions = compare(baseline, candidate, args.threshold)
+    for size, name, metric, old, new, delta in rows:
+        print('%-7s %-16s %-6s %10s -> %-10s %s' % (
+            size, name, metric.replace('_ms', ''), old, new,
+            '' if delta is None else '%+6.1f%%' % delta))
+
+    if regressions:
+        print('\n%d regression(s) above %.1f%%:' % (len(regressions), args.threshold))
+        for size, what, delta in regressions:
+            print('    size %s %s %+.1f%%' % (size, what, delta))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
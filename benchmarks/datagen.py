@@ -0,0 +1,127 @@
+"""Synthetic datasets for the benchmark suite.
+
+populate() creates one user per requested size, bench-<size>@bench.local,
+whose items are spread over vaults of at most ITEMS_PER_VAULT items.  A
+share of the secrets is weak or reused so the health and reuse paths do
+real work.  Rows are written directly with every derived column (owner,
+fingerprint, strength score) filled in, then the health counters, vault
+tree, ACL and tag index are rebuilt, so the database looks exactly as if the
+API had created it.
+"""
+import math
+import random
+import sqlite3
+import uuid
+
+import bcrypt
+
+import fingerprints
+import honeytokens
+import ids
+import sharing
+import tags
+import vault_health
+import vault_tree
+
+PASSWORD = 'bench-password-1'
+ITEMS_PER_VAULT = 1000
+SIZES = (1, 100, 10000, 100000)
+
+WEAK = ['password', '123456', 'qwerty', 'letmein', 'dragon', 'monkey']
+SITES = ['github.com', 'mail.example.com', 'bank.example.com', 'shop.example.com',
+         'news.example.com', 'intranet.example.com', 'cloud.example.com']
+
+
+def email_for(size):
+    return 'bench-%d@bench.local' % size
+
+
+def _secret(rng, shared):
+    roll = rng.random()
+    if roll < 0.1:
+        return rng.choice(WEAK)
+    if roll < 0.25:
+        return rng.choice(shared)
+    return ''.join(rng.choice('abcdefghijkmnpqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ23456789!@#%')
+                   for _ in range(rng.randint(12, 24)))
+
+
+def existing_users(database):
+    conn = sqlite3.connect(database)
+    try:
+        rows = conn.execute("SELECT email FROM users WHERE email LIKE 'bench-%@bench.local'").fetchall()
+    finally:
+        conn.close()
+    return set(email for (email,) in rows)
+
+
+def populate(database, sizes=SIZES, items_per_vault=ITEMS_PER_VAULT, seed=1):
+    # Expects the app schema to exist; skips sizes that are already seeded
+    rng = random.Random(seed)
+    have = existing_users(database)
+    password_hash = bcrypt.hashpw(PASSWORD.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    shared = ['Shared-%d-Secret!' % i for i in range(20)]
+
+    conn = sqlite3.connect(database)
+    c = conn.cursor()
+    created = []
+    for size in sizes:
+        if email_for(size) in have:
+            continue
+        user_id = str(uuid.uuid4())
+        c.execute('INSERT INTO users (id, email, password_hash) VALUES (?, ?, ?)',
+                  (user_id, email_for(size), password_hash))
+        honeytokens.seed_user(c, user_id)
+
+        vault_count = max(1, int(math.ceil(size / float(items_per_vault))))
+        vault_ids = [ids.new_id() for _ in range(vault_count)]
+        c.executemany('INSERT INTO vaults (id, user_id, name, description, icon) VALUES (?, ?, ?, ?, ?)',
+                      [(vault_id, user_id, 'Vault %d' % i, 'Benchmark data', '🔐')
+                       for i, vault_id in enumerate(vault_ids)])
+
+        now = vault_health.utc_timestamp()
+        rows = []
+        for i in range(size):
+            secret = _secret(rng, shared)
+            site = rng.choice(SITES)
+            rows.append((ids.new_id(), vault_ids[i % vault_count], '%s #%d' % (site, i),
+                         'user%d@example.com' % i, secret, 'https://' + site, 'Benchmark item',
+                         user_id, fingerprints.fingerprint(user_id, secret),
+                         vault_health.score_password(secret), now))
+        c.executemany('''
+            INSERT INTO passwords (id, vault_id, title, username, password, url, notes,
+                                   user_id, fingerprint, strength_score, password_changed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        created.append(size)
+
+    if created:
+        vault_health.rebuild_health(c)
+        vault_tree.rebuild_tree(c)
+        sharing.rebuild_acl(c)
+        tags.rebuild_tags(c)
+    conn.commit()
+    conn.close()
+    return created
+
+
+def load_users(database, sizes):
+    # size -> {'user_id', 'email', 'vault_ids', 'item_ids'}
+    conn = sqlite3.connect(database)
+    users = {}
+    try:
+        for size in sizes:
+            row = conn.execute('SELECT id FROM users WHERE email = ?', (email_for(size),)).fetchone()
+            if row is None:
+                raise LookupError('dataset for size %d is missing' % size)
+            user_id = row[0]
+            vault_ids = [ids.to_str(r[0]) for r in conn.execute(
+                'SELECT id FROM vaults WHERE user_id = ? AND is_decoy = 0 ORDER BY created_at, id',
+                (user_id,))]
+            item_ids = [ids.to_str(r[0]) for r in conn.execute(
+                'SELECT id FROM passwords WHERE user_id = ? AND is_honeytoken = 0', (user_id,))]
+            users[size] = {'user_id': user_id, 'email': email_for(size),
+                           'vault_ids': vault_ids, 'item_ids': item_ids}
+    finally:
+        conn.close()
+    return users
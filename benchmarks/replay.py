@@ -0,0 +1,276 @@
+"""Replay captured API traffic against a local instance of the app.
+
+    python -m benchmarks.replay /path/to/capture-dir              # in-process, 1x
+    python -m benchmarks.replay capture-123.jsonl.gz --speed 10
+    python -m benchmarks.replay capture-dir --speed max --concurrency 16 \\
+        --url http://127.0.0.1:8000 --output replay.json
+
+Captures come from AGIES_CAPTURE_DIR (see capture.py).  Every user, vault
+and item the capture refers to is first recreated on the target under fresh
+ids, then the requests are re-issued with their original spacing divided by
+--speed (or back to back with --speed max).  The report compares replayed
+latency per endpoint with the latency recorded at capture time and counts
+requests whose status differs.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+from benchmarks import run as bench_run
+from benchmarks import workload
+
+PASSWORD = 'replay-password-1'
+
+
+def load(paths):
+    records = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                           if name.startswith('capture-') and name.endswith('.jsonl.gz'))
+        else:
+            files = [path]
+        for name in files:
+            opener = gzip.open if name.endswith('.gz') else open
+            with opener(name, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # The last line of a capture still being written
+                        continue
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+class World:
+    # Maps anonymized ids from the capture to entities created on the target
+    def __init__(self, client):
+        self.client = client
+        self.users = {}     # anon user -> {'id', 'email', 'default_vault'}
+        self.vaults = {}    # anon vault -> real vault id
+        self.items = {}     # anon item -> real item id
+
+    def _call(self, method, path, body=None, headers=None):
+        status, data = self.client.request(method, path, body, headers or {})
+        if status >= 300:
+            raise RuntimeError('setup %s %s failed with %d: %s' % (method, path, status, data[:200]))
+        return json.loads(data)
+
+    def prepare(self, records):
+        owners, item_vaults, default_vaults = {}, {}, {}
+        for record in records:
+            args, created, user = record.get('a', {}), record.get('c', {}), record.get('u')
+            if record['e'] == 'register' and 'user_id' in created:
+                user = created['user_id']
+                if 'default_vault_id' in created:
+                    default_vaults[created['default_vault_id']] = user
+            if record['e'] == 'login' and 'user_id' in created:
+                user = created['user_id']
+            if user:
+                owners.setdefault(('user', user), user)
+            if 'vault_id' in args and user:
+                owners.setdefault(('vault', args['vault_id']), user)
+            if record['e'] == 'create_vault' and 'id' in created and user:
+                owners.setdefault(('vault', created['id']), user)
+            if 'password_id' in args and user:
+                owners.setdefault(('item', args['password_id']), user)
+            if record['e'] == 'add_password' and 'id' in created and user:
+                owners.setdefault(('item', created['id']), user)
+                item_vaults[created['id']] = args.get('vault_id')
+
+        for (kind, anon), user in owners.items():
+            if kind == 'user':
+                self.user(anon)
+        for (kind, anon), user in owners.items():
+            if kind == 'vault':
+                if default_vaults.get(anon) == user:
+                    self.vaults[anon] = self.users[user]['default_vault']
+                else:
+                    self.vaults[anon] = self._call('POST', '/api/vaults', {'name': 'Replay vault'},
+                                                   {'X-User-ID': self.users[user]['id']})['id']
+        for (kind, anon), user in owners.items():
+            if kind == 'item':
+                vault = self.vaults.get(item_vaults.get(anon)) or self.users[user]['default_vault']
+                body = {'title': 'Replay item', 'username': 'replay@example.com',
+                        'password': 'Replay-%s!' % uuid.uuid4().hex[:12]}
+                self.items[anon] = self._call('POST', '/api/vaults/%s/passwords' % vault, body,
+                                              {'X-User-ID': self.users[user]['id']})['id']
+
+    def user(self, anon):
+        if anon not in self.users:
+            email = 'replay-%s-%s@replay.local' % (anon, uuid.uuid4().hex[:6])
+            data = self._call('POST', '/api/auth/register', {'email': email, 'password': PASSWORD})
+            self.users[anon] = {'id': data['user_id'], 'email': email,
+                                'default_vault': data['default_vault_id']}
+        return self.users[anon]
+
+
+def _text(rng, length):
+    return ''.join(rng.choice(string.ascii_letters + string.digits) for _ in range(length or 0))
+
+
+def build_request(world, record, rng):
+    # Returns (method, path, body, headers) with real ids and synthetic values
+    path = record['r']
+    for key, anon in record.get('a', {}).items():
+        real = world.vaults.get(anon) or world.items.get(anon) or anon
+        # Rule placeholders: <key>, or with a converter, <id:key>, <string:key>
+        path = re.sub(r'<(?:\w+:)?%s>' % re.escape(key), lambda match: real, path)
+    if record.get('q'):
+        path += '?' + '&'.join('%s=%s' % (key, _text(rng, length)) for key, length in record['q'].items())
+
+    headers = {}
+    user = world.users.get(record.get('u'))
+    if user:
+        headers['X-User-ID'] = user['id']
+
+    body = None
+    if record.get('b') is not None:
+        body = dict((key, _text(rng, length) if length is not None else None)
+                    for key, length in record['b'].items())
+    if record['e'] == 'register':
+        body = {'email': 'replay-%s@replay.local' % uuid.uuid4().hex, 'password': PASSWORD}
+    elif record['e'] == 'login':
+        target = world.users.get(record.get('c', {}).get('user_id'))
+        if target is None and world.users:
+            target = rng.choice(list(world.users.values()))
+        if target is not None:
+            # Failed logins in the capture stay failed in the replay
+            failed = record['s'] >= 400
+            body = {'email': target['email'], 'password': PASSWORD + ('x' if failed else '')}
+    return record['m'], path, body, headers
+
+
+def replay(records, make_client, speed, concurrency, seed=1):
+    local = threading.local()
+    lock = threading.Lock()
+    results = []
+
+    def client():
+        if not hasattr(local, 'client'):
+            local.client = make_client()
+        return local.client
+
+    def issue(record, request, scheduled):
+        lag = time.perf_counter() - scheduled if scheduled is not None else 0.0
+        method, path, body, headers = request
+        start = time.perf_counter()
+        try:
+            status, _ = client().request(method, path, body, headers)
+        except Exception:
+            status = None
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            results.append((record, status, elapsed, lag * 1000))
+
+    rng = random.Random(seed)
+    world = World(make_client())
+    world.prepare(records)
+
+    requests = [build_request(world, record, rng) for record in records]
+    origin = records[0]['t'] if records else 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record, request in zip(records, requests):
+            scheduled = None
+            if speed is not None:
+                scheduled = start + (record['t'] - origin) / speed
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(issue, record, request, scheduled)
+    return results, time.perf_counter() - start
+
+
+def report(results, duration):
+    by_endpoint = {}
+    for record, status, elapsed, lag in results:
+        entry = by_endpoint.setdefault(record['e'], {'captured': [], 'replayed': [], 'mismatches': 0})
+        entry['captured'].append(record['d'])
+        entry['replayed'].append(elapsed)
+        if status != record['s']:
+            entry['mismatches'] += 1
+
+    endpoints = {}
+    for name, entry in sorted(by_endpoint.items()):
+        captured, replayed = sorted(entry['captured']), sorted(entry['replayed'])
+        stats = {'count': len(replayed), 'status_mismatches': entry['mismatches']}
+        for p in (50, 95, 99):
+            old = workload.percentile(captured, p)
+            new = workload.percentile(replayed, p)
+            stats['p%d_captured_ms' % p] = round(old, 3)
+            stats['p%d_replayed_ms' % p] = round(new, 3)
+            stats['p%d_ratio' % p] = round(new / old, 3) if old else None
+        endpoints[name] = stats
+
+    lags = sorted(lag for _, _, _, lag in results)
+    return {
+        'requests': len(results),
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(results) / duration, 2) if duration else None,
+        'schedule_lag_p99_ms': round(workload.percentile(lags, 99) or 0, 3),
+        'endpoints': endpoints,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured API traffic.')
+    parser.add_argument('captures', nargs='+', help='capture files or directories')
+    parser.add_argument('--speed', default='1', help='time compression factor, or "max"')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--url', help='target a running server instead of an in-process app')
+    parser.add_argument('--workdir', help='scratch directory for the in-process app')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the report as JSON')
+    args = parser.parse_args(argv)
+
+    records = load(args.captures)
+    if not records:
+        print('no captured requests found')
+        return 1
+    speed = None if args.speed == 'max' else float(args.speed)
+
+    if args.url:
+        target = urlsplit(args.url)
+        make_client = lambda: workload.HTTPClient(target.hostname, target.port or 80)
+    else:
+        workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='agies-replay-'))
+        app = bench_run.load_app(workdir)
+        make_client = lambda: workload.InProcessClient(app.app)
+
+    results, duration = replay(records, make_client, speed, args.concurrency, args.seed)
+    summary = report(results, duration)
+
+    print('%d requests in %.1fs (%.1f req/s), schedule lag p99 %.1f ms' % (
+        summary['requests'], summary['duration_s'], summary['throughput_rps'] or 0,
+        summary['schedule_lag_p99_ms']))
+    for name, stats in summary['endpoints'].items():
+        print('    %-22s n=%-5d p50 %8.2f -> %8.2f  p95 %8.2f -> %8.2f  p99 x%-6s mismatched=%d' % (
+            name, stats['count'], stats['p50_captured_ms'], stats['p50_replayed_ms'],
+            stats['p95_captured_ms'], stats['p95_replayed_ms'], stats['p99_ratio'],
+            stats['status_mismatches']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""Run the benchmark suite and save the results as JSON.
+
+    python -m benchmarks.run                          # in-process, sizes 1,100,10000
+    python -m benchmarks.run --sizes 1,100,10000,100000 --requests 2000
+    python -m benchmarks.run --mode gunicorn --workers 4 --concurrency 16
+    python -m benchmarks.compare old.json new.json
+
+The app runs in a scratch directory (--workdir, a fresh temp dir by default
+that is removed on exit) so the benchmark database never touches agies.db.
+Seeded datasets are reused when the same --workdir is passed again.
+"""
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+from benchmarks import datagen, workload
+
+RESULTS_DIR = os.path.join(REPO, 'benchmarks', 'results')
+
+# Settings that point the app at files, relative to the workdir
+WORKDIR_PATHS = (
+    ('AGIES_METRICS_DIR', 'metrics'),
+    ('AGIES_AUDIT_DIR', 'audit'),
+    ('AGIES_BACKUP_DIR', 'backups'),
+    ('AGIES_WAL_ARCHIVE_DIR', 'wal-archive'),
+    ('AGIES_JOB_DIR', 'jobs'),
+    ('AGIES_PROFILE_DIR', 'profiles'),
+    ('AGIES_SLOW_QUERY_LOG', 'agies.slow.log'),
+    ('AGIES_FINGERPRINT_KEY_FILE', 'agies.fingerprint.key'),
+)
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=REPO,
+                                stderr=subprocess.DEVNULL) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def load_app(workdir):
+    # app.py opens agies.db relative to the working directory at import
+    # time; every other file the app writes gets an absolute path under the
+    # workdir, so nothing lands next to the caller's files after main()
+    # changes back
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    for name, path in WORKDIR_PATHS:
+        os.environ.setdefault(name, os.path.join(workdir, path))
+    import app
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workdir, workers, port):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO + os.pathsep + env.get('PYTHONPATH', '')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', 'app:app', '--chdir', workdir,
+         '--bind', '127.0.0.1:%d' % port, '--workers', str(workers), '--log-level', 'warning'],
+        env=env, cwd=workdir)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited with status %d' % process.returncode)
+        try:
+            urllib.request.urlopen('http://127.0.0.1:%d/api/health' % port, timeout=1).read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('gunicorn did not become ready')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('inprocess', 'gunicorn'), default='inprocess')
+    parser.add_argument('--sizes', default='1,100,10000',
+                        help='comma separated item counts, one scenario each')
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help='client threads (default 1 in-process, 8 against gunicorn)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--items-per-vault', type=int, default=datagen.ITEMS_PER_VAULT)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', help='scratch directory to keep and reuse')
+    parser.add_argument('--output', help='result file (default benchmarks/results/<time>-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    concurrency = args.concurrency or (1 if args.mode == 'inprocess' else 8)
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='agies-bench-')
+    cwd = os.getcwd()
+    if not args.workdir:
+        # Registered before the app loads so it runs after the app's own
+        # exit hooks (audit and capture flushes) are done with the workdir
+        atexit.register(shutil.rmtree, workdir, True)
+
+    try:
+        app = load_app(workdir)
+        database = os.path.join(workdir, app.DATABASE)
+        start = time.perf_counter()
+        created = datagen.populate(database, sizes, args.items_per_vault, args.seed)
+        if created:
+            print('seeded sizes %s in %.1fs' % (created, time.perf_counter() - start))
+        users = datagen.load_users(database, sizes)
+
+        server = None
+        if args.mode == 'gunicorn':
+            port = free_port()
+            server = start_gunicorn(workdir, args.workers, port)
+            make_client = lambda: workload.HTTPClient('127.0.0.1', port)
+        else:
+            make_client = lambda: workload.InProcessClient(app.app)
+
+        scenarios = {}
+        try:
+            for size in sizes:
+                scenario = workload.Scenario(users[size], seed=args.seed)
+                result = workload.run(scenario, make_client, args.requests, concurrency, args.warmup)
+                scenarios[str(size)] = result
+                print('size %-7d %8.1f req/s' % (size, result['throughput_rps'] or 0))
+                for name, op in sorted(result['ops'].items()):
+                    print('    %-16s n=%-5d err=%-3d p50=%8.2f p95=%8.2f p99=%8.2f ms' % (
+                        name, op['count'], op['errors'], op['p50_ms'] or 0,
+                        op['p95_ms'] or 0, op['p99_ms'] or 0))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+    finally:
+        os.chdir(cwd)
+
+    revision = git_revision()
+    results = {
+        'meta': {
+            'commit': revision,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'mode': args.mode,
+            'workers': args.workers if args.mode == 'gunicorn' else None,
+            'concurrency': concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'items_per_vault': args.items_per_vault,
+            'seed': args.seed,
+            'mix': workload.MIX,
+        },
+        'scenarios': scenarios,
+    }
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, '%s-%s-%s.json' % (
+            time.strftime('%Y%m%dT%H%M%S'), revision or 'nogit', args.mode))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('results written to %s' % output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Workload mix, clients and latency statistics for the benchmark suite.
+
+Each operation picks its target from the shared dataset of the scenario's
+user and returns (name, method, path, body, headers).  Writes keep the item
+pool up to date so updates and deletes always hit live rows.
+"""
+import http.client
+import json
+import random
+import threading
+import time
+import uuid
+
+from benchmarks import datagen
+
+# name -> relative weight
+MIX = {
+    'get_passwords': 35,
+    'get_vaults': 25,
+    'add_password': 12,
+    'update_password': 12,
+    'delete_password': 8,
+    'login': 6,
+    'register': 2,
+}
+
+
+class Scenario:
+    def __init__(self, user, mix=MIX, seed=1):
+        self.user = user
+        self.headers = {'X-User-ID': user['user_id']}
+        self.items = list(user['item_ids'])
+        self.lock = threading.Lock()
+        self.names = list(mix)
+        self.weights = [mix[name] for name in self.names]
+        self.seed = seed
+
+    def rng(self, worker):
+        return random.Random('%s-%d' % (self.seed, worker))
+
+    def next_request(self, rng):
+        name = rng.choices(self.names, self.weights)[0]
+        return getattr(self, name)(rng)
+
+    def get_vaults(self, rng):
+        return 'get_vaults', 'GET', '/api/vaults', None, self.headers
+
+    def get_passwords(self, rng):
+        vault_id = rng.choice(self.user['vault_ids'])
+        return 'get_passwords', 'GET', '/api/vaults/%s/passwords' % vault_id, None, self.headers
+
+    def add_password(self, rng):
+        vault_id = rng.choice(self.user['vault_ids'])
+        body = {'title': 'bench %d' % rng.randint(0, 1 << 30), 'username': 'bench@example.com',
+                'password': 'Bench-%08x!' % rng.getrandbits(32), 'url': 'https://bench.example.com'}
+        return 'add_password', 'POST', '/api/vaults/%s/passwords' % vault_id, body, self.headers
+
+    def update_password(self, rng):
+        with self.lock:
+            if not self.items:
+                return self.add_password(rng)
+            item_id = rng.choice(self.items)
+        body = {'title': 'updated', 'username': 'bench@example.com',
+                'password': 'Upd-%08x!' % rng.getrandbits(32)}
+        return 'update_password', 'PUT', '/api/passwords/%s' % item_id, body, self.headers
+
+    def delete_password(self, rng):
+        with self.lock:
+            if not self.items:
+                return self.add_password(rng)
+            item_id = self.items.pop(rng.randrange(len(self.items)))
+        return 'delete_password', 'DELETE', '/api/passwords/%s' % item_id, None, self.headers
+
+    def login(self, rng):
+        body = {'email': self.user['email'], 'password': datagen.PASSWORD}
+        return 'login', 'POST', '/api/auth/login', body, {}
+
+    def register(self, rng):
+        body = {'email': 'reg-%s@bench.local' % uuid.uuid4().hex, 'password': datagen.PASSWORD}
+        return 'register', 'POST', '/api/auth/register', body, {}
+
+    def record(self, name, status, body):
+        if name == 'add_password' and status == 201:
+            try:
+                item_id = json.loads(body)['id']
+            except (ValueError, KeyError):
+                return
+            with self.lock:
+                self.items.append(item_id)
+
+
+class InProcessClient:
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, headers):
+        response = self.client.open(path, method=method, json=body, headers=headers)
+        return response.status_code, response.get_data()
+
+    def close(self):
+        pass
+
+
+class HTTPClient:
+    # One persistent keep-alive connection per worker thread
+    def __init__(self, host, port, timeout=60):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.conn = None
+
+    def request(self, method, path, body, headers):
+        headers = dict(headers)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, payload, headers)
+                response = self.conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(p / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(samples, errors, duration):
+    ops = {}
+    total = 0
+    for name in sorted(set(samples) | set(errors)):
+        values = sorted(samples.get(name, []))
+        total += len(values)
+        ops[name] = {
+            'count': len(values),
+            'errors': errors.get(name, 0),
+            'mean_ms': round(sum(values) / len(values), 3) if values else None,
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+            'max_ms': values[-1] if values else None,
+        }
+    return {
+        'duration_s': round(duration, 3),
+        'requests': total,
+        'throughput_rps': round(total / duration, 2) if duration else None,
+        'ops': ops,
+    }
+
+
+def run(scenario, make_client, requests, concurrency=1, warmup=0):
+    # Issues `requests` operations from `concurrency` threads; warmup
+    # requests are sent first and not measured
+    samples, errors = {}, {}
+    lock = threading.Lock()
+    counter = {'left': requests, 'warmup': warmup}
+
+    def take():
+        with lock:
+            if counter['warmup']:
+                counter['warmup'] -= 1
+                return 'warmup'
+            if counter['left']:
+                counter['left'] -= 1
+                return 'measure'
+            return None
+
+    def worker(index):
+        rng = scenario.rng(index)
+        client = make_client()
+        try:
+            while True:
+                phase = take()
+                if phase is None:
+                    return
+                name, method, path, body, headers = scenario.next_request(rng)
+                start = time.perf_counter()
+                try:
+                    status, data = client.request(method, path, body, headers)
+                except Exception:
+                    status, data = None, b''
+                elapsed = (time.perf_counter() - start) * 1000
+                scenario.record(name, status, data)
+                if phase == 'warmup':
+                    continue
+                with lock:
+                    if status is None or status >= 400:
+                        errors[name] = errors.get(name, 0) + 1
+                    else:
+                        samples.setdefault(name, []).append(round(elapsed, 3))
+        finally:
+            client.close()
+
+    # Warmup runs single-threaded so it finishes before the clock starts
+    if warmup:
+        counter['left'], left = 0, counter['left']
+        worker(-1)
+        counter['left'] = left
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, errors, time.perf_counter() - start)
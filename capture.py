@@ -0,0 +1,190 @@
+"""Opt-in capture of API traffic for replay.
+
+Set AGIES_CAPTURE_DIR to record every /api/ request (or a share of them,
+AGIES_CAPTURE_RATE) to capture-<pid>.jsonl.gz in that directory, one file
+per worker.  Records keep the shape of the traffic, not its content:
+
+    t  wall-clock time          m  method          e  endpoint
+    r  route template           a  route args      u  user
+    q  query keys -> lengths    b  body keys -> value lengths
+    s  status                   d  duration (ms)   n  response bytes
+    c  ids created or returned by the request (id, user_id, vault_id, ...)
+
+Ids are replaced by a keyed hash that is stable across workers (the key is
+AGIES_CAPTURE_SALT or a salt file created in the capture directory), so a
+replay can tell which requests touched the same user, vault or item without
+the log revealing them.  Secrets, titles and other values are never written,
+only their lengths.
+
+Records are handed to a writer thread; the request path only builds a small
+dict.  Replay a capture with python -m benchmarks.replay.
+"""
+import atexit
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import threading
+import time
+
+from flask import g, request
+
+import ids
+
+CAPTURE_DIR = os.environ.get('AGIES_CAPTURE_DIR', '')
+CAPTURE_RATE = float(os.environ.get('AGIES_CAPTURE_RATE', 1.0))
+FLUSH_INTERVAL = float(os.environ.get('AGIES_CAPTURE_FLUSH', 1.0))
+
+# Response fields that identify something the request created or resolved
+ID_FIELDS = ('id', 'user_id', 'vault_id', 'default_vault_id')
+MAX_PARSED_RESPONSE = 4096
+
+logger = logging.getLogger('agies.capture')
+
+_records = queue.Queue()
+_salt = None
+_started = False
+
+
+def _load_salt():
+    env_salt = os.environ.get('AGIES_CAPTURE_SALT')
+    if env_salt:
+        return env_salt.encode('utf-8')
+    path = os.path.join(CAPTURE_DIR, 'salt')
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path) as f:
+            return f.read().strip().encode('utf-8')
+    salt = secrets.token_hex(16)
+    with os.fdopen(fd, 'w') as f:
+        f.write(salt)
+    return salt.encode('utf-8')
+
+
+def anonymize(value):
+    # Binary ids hash like the strings clients send and receive
+    if isinstance(value, bytes):
+        value = ids.to_str(value)
+    return hmac.new(_salt, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+
+
+def shape(mapping):
+    # Keys with the length of each value (None for non-string values)
+    if not isinstance(mapping, dict):
+        return None
+    return dict((key, len(value) if isinstance(value, str) else None)
+                for key, value in mapping.items())
+
+
+def sampled(path):
+    # Whether a request to path is recorded; decided when it starts
+    if _salt is None or not path.startswith('/api/'):
+        return False
+    return CAPTURE_RATE >= 1.0 or random.random() < CAPTURE_RATE
+
+
+def record(method, endpoint, rule, status, duration, response_bytes, view_args=None,
+           user_id=None, args=None, body=None, response_data=None):
+    # Queues one record; body and response_data are parsed JSON (or None).
+    # Also called by asgi.py for the routes it serves without Flask
+    entry = {
+        't': round(time.time(), 4),
+        'm': method,
+        'e': endpoint,
+        'r': rule,
+        's': status,
+        'd': round(duration * 1000, 3),
+        'n': response_bytes,
+    }
+    if view_args:
+        entry['a'] = dict((key, anonymize(value)) for key, value in view_args.items())
+    if user_id:
+        entry['u'] = anonymize(user_id)
+    if args:
+        entry['q'] = shape(args)
+    if body is not None:
+        entry['b'] = shape(body)
+
+    if method == 'POST' and status < 300 and isinstance(response_data, dict):
+        created = dict((key, anonymize(response_data[key])) for key in ID_FIELDS
+                       if response_data.get(key))
+        if created:
+            entry['c'] = created
+
+    _records.put(entry)
+
+
+def _before_request():
+    if sampled(request.path):
+        g.capture_start = time.perf_counter()
+
+
+def _after_request(response):
+    start = g.pop('capture_start', None)
+    if start is None:
+        return response
+
+    response_data = None
+    if (request.method == 'POST' and response.status_code < 300 and not response.is_streamed
+            and (response.content_length or 0) <= MAX_PARSED_RESPONSE):
+        response_data = response.get_json(silent=True)
+
+    record(request.method, request.endpoint or 'unmatched',
+           request.url_rule.rule if request.url_rule else request.path,
+           response.status_code, time.perf_counter() - start, response.content_length,
+           view_args=request.view_args, user_id=request.headers.get('X-User-ID'),
+           args=request.args.to_dict(), body=request.get_json(silent=True) if request.is_json else None,
+           response_data=response_data)
+    return response
+
+
+def _drain(out, lock):
+    batch = []
+    while True:
+        try:
+            batch.append(_records.get_nowait())
+        except queue.Empty:
+            break
+    if not batch:
+        return
+    with lock:
+        try:
+            out.write(''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in batch))
+            out.flush()
+        except Exception:
+            logger.exception('Failed to write %d captured requests', len(batch))
+
+
+def _write_loop(path):
+    out = gzip.open(path, 'at', encoding='utf-8')
+    lock = threading.Lock()
+
+    def close():
+        _drain(out, lock)
+        out.close()
+
+    atexit.register(close)
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        _drain(out, lock)
+
+
+def init_app(app):
+    # Register after compression so the JSON body is still readable
+    global _salt, _started
+    if not CAPTURE_DIR:
+        return
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    _salt = _load_salt()
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    if not _started:
+        _started = True
+        path = os.path.join(CAPTURE_DIR, 'capture-%d.jsonl.gz' % os.getpid())
+        threading.Thread(target=_write_loop, args=(path,), name='capture-writer', daemon=True).start()
@@ -0,0 +1,174 @@
+"""Per-user feed of vault and item changes.
+
+Every endpoint that changes what a user can see publishes an event in the
+same transaction, next to listing_cache.bump(), so an event exists exactly
+when its change is committed:
+
+    change_events (id, user_id, event, vault_id, password_id, created_at)
+
+ids come from AUTOINCREMENT, increase in commit order and are never reused,
+so a client resumes by sending the last id it saw.  Clients subscribe to
+
+    GET /api/changes/stream    Server-Sent Events, honours Last-Event-ID
+    GET /api/changes?since=N   the same events as a JSON list
+
+Under asgi.py the stream stays open and costs one coroutine: a single watcher
+per process polls for new rows every AGIES_CHANGES_POLL seconds and fans them
+out to the connected users, so the database sees one query per interval
+however many clients are listening.  Under plain WSGI the stream sends what
+is pending and ends with a retry hint, and EventSource reconnects with its
+Last-Event-ID, which degrades to polling without client changes.
+
+Events are kept for AGIES_CHANGES_RETENTION seconds.  The job workers run
+prune() every PRUNE_INTERVAL seconds (jobs.periodic), which deletes expired
+events PRUNE_BATCH rows per transaction, so publishing never pays for the
+cleanup.  A client resuming from an id that has been pruned, or that is too
+far behind, is sent a 'resync' event and should reload its listings.
+"""
+import os
+import time
+
+import serialization
+
+RETENTION = int(os.environ.get('AGIES_CHANGES_RETENTION', 86400))
+POLL_INTERVAL = float(os.environ.get('AGIES_CHANGES_POLL', 0.5))
+KEEPALIVE = float(os.environ.get('AGIES_CHANGES_KEEPALIVE', 15))
+# Reconnect delay suggested to EventSource clients, in milliseconds
+RETRY_MS = int(os.environ.get('AGIES_CHANGES_RETRY_MS', 3000))
+# Longest backlog sent on resume before asking the client to resync
+BACKLOG_LIMIT = int(os.environ.get('AGIES_CHANGES_BACKLOG', 1000))
+PRUNE_INTERVAL = 600
+# Expired events deleted per transaction by prune()
+PRUNE_BATCH = 1000
+
+# Event types
+VAULT_CREATED = 'vault.created'
+VAULT_UPDATED = 'vault.updated'
+VAULT_MOVED = 'vault.moved'
+VAULT_DELETED = 'vault.deleted'
+VAULT_SHARED = 'vault.shared'
+VAULT_UNSHARED = 'vault.unshared'
+ITEM_CREATED = 'item.created'
+ITEM_UPDATED = 'item.updated'
+ITEM_DELETED = 'item.deleted'
+RESYNC = 'resync'
+
+COLUMNS = ('id', 'user_id', 'event', 'vault_id', 'password_id', 'created_at')
+
+
+def init_changes_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS change_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            vault_id BLOB,
+            password_id BLOB,
+            created_at REAL NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_change_events_user ON change_events (user_id, id)')
+
+
+def publish(c, user_ids, event, vault_id=None, password_id=None):
+    # Call inside the transaction that makes the change
+    now = time.time()
+    c.executemany('''
+        INSERT INTO change_events (user_id, event, vault_id, password_id, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(user_id, event, vault_id, password_id, now) for user_id in sorted(set(user_ids))])
+
+
+def publish_all(c, event=RESYNC):
+    # For changes that touch every user, e.g. a rebuild of derived data
+    now = time.time()
+    c.execute('''
+        INSERT INTO change_events (user_id, event, created_at)
+        SELECT id, ?, ? FROM users
+    ''', (event, now))
+
+
+def prune(conn):
+    # conn must be in autocommit mode so every batch is its own short write
+    # transaction.  ids follow created_at, so expired events are the oldest
+    # ones and each batch is a range on the primary key
+    cutoff = time.time() - RETENTION
+    removed = 0
+    while True:
+        row = conn.execute('SELECT id, created_at FROM change_events ORDER BY id LIMIT 1').fetchone()
+        if row is None or row[1] >= cutoff:
+            return removed
+        removed += conn.execute('DELETE FROM change_events WHERE id < ? AND created_at < ?',
+                                (row[0] + PRUNE_BATCH, cutoff)).rowcount
+
+
+def latest_id(c):
+    # Highest id ever handed out, including pruned events
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_events'")
+    row = c.fetchone()
+    return row[0] if row else 0
+
+
+def oldest_id(c):
+    c.execute('SELECT MIN(id) FROM change_events')
+    return c.fetchone()[0]
+
+
+def is_expired(last_id, oldest, latest):
+    # True when events after last_id may already have been pruned
+    if oldest is None:
+        return last_id < latest
+    return last_id + 1 < oldest
+
+
+def as_dict(row):
+    event = dict(zip(COLUMNS, row))
+    del event['user_id']
+    event['created_at'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(event['created_at']))
+    return event
+
+
+def parse_last_id(value):
+    # Last-Event-ID header or ?since=; returns None when absent or invalid
+    try:
+        last_id = int(value)
+    except (TypeError, ValueError):
+        return None
+    return last_id if last_id >= 0 else None
+
+
+def pending(c, user_id, last_id, limit=BACKLOG_LIMIT):
+    # Returns (events, last_id, resync): the user's events after last_id, the
+    # id to resume from and whether the client has to reload instead
+    latest = latest_id(c)
+    if last_id is None:
+        return [], latest, False
+    if last_id > latest or is_expired(last_id, oldest_id(c), latest):
+        return [], latest, True
+
+    c.execute('''
+        SELECT %s FROM change_events
+        WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?
+    ''' % ', '.join(COLUMNS), (user_id, last_id, limit + 1))
+    rows = c.fetchall()
+    if len(rows) > limit:
+        return [], latest, True
+    return [as_dict(row) for row in rows], max([latest] + [row[0] for row in rows]), False
+
+
+def format_event(event_id, event, data):
+    # One Server-Sent Event; compact JSON never contains a newline
+    return b'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, event.encode('ascii'), serialization.dumps(data))
+
+
+def backlog(events, last_id, resync):
+    # Opening frames of a stream: the reconnect delay, then either a resync
+    # or the pending events, then the id to resume from (a bare id: field
+    # moves the client's Last-Event-ID without dispatching an event)
+    chunks = [b'retry: %d\n\n' % RETRY_MS]
+    if resync:
+        chunks.append(format_event(last_id, RESYNC, {"id": last_id, "event": RESYNC}))
+    else:
+        chunks.extend(format_event(event['id'], event['event'], event) for event in events)
+        chunks.append(b'id: %d\n\n' % last_id)
+    return b''.join(chunks)
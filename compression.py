@@ -0,0 +1,177 @@
+"""Negotiated gzip/brotli compression for API and static responses.
+
+Responses are compressed when the client accepts an encoding we support, the
+body is at least AGIES_COMPRESS_MIN_SIZE bytes and the content type is
+compressible.  Buffered bodies are compressed in one call; streamed bodies
+(file responses above the buffering limit, generators) are wrapped in an
+incremental compressor that flushes after every chunk so chunked responses
+keep flowing.
+
+Compression is skipped while the process is saturated: when more than
+AGIES_COMPRESS_MAX_INFLIGHT requests are running in this worker, or the
+1-minute load average per CPU is above AGIES_COMPRESS_MAX_LOAD.  Sending a
+larger response is cheaper than queueing every other request behind it.
+"""
+import gzip
+import os
+import threading
+import time
+import zlib
+
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+MIN_SIZE = int(os.environ.get('AGIES_COMPRESS_MIN_SIZE', 1024))
+MAX_BUFFERED = int(os.environ.get('AGIES_COMPRESS_MAX_BUFFERED', 4 * 1024 * 1024))
+MAX_INFLIGHT = int(os.environ.get('AGIES_COMPRESS_MAX_INFLIGHT', 16))
+MAX_LOAD = float(os.environ.get('AGIES_COMPRESS_MAX_LOAD', 1.5))
+GZIP_LEVEL = int(os.environ.get('AGIES_GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('AGIES_BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/json', 'application/javascript', 'application/xml',
+    'application/manifest+json', 'image/svg+xml', 'text/event-stream',
+])
+
+_lock = threading.Lock()
+_inflight = 0
+_load_checked = 0.0
+_overloaded = False
+
+
+def supported_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(accept_encoding):
+    # Picks the best supported encoding by q-value; ties prefer brotli
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        fields = part.strip().split(';')
+        name = fields[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+
+    best, best_q = None, 0.0
+    for encoding in supported_encodings():
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def is_compressible(mimetype):
+    return bool(mimetype) and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def stream(chunks, encoding):
+    # Compresses an iterable chunk by chunk, flushing after each one
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            out = compressor.process(chunk) + compressor.flush()
+            if out:
+                yield out
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for chunk in chunks:
+            out = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield compressor.flush()
+
+
+def saturated():
+    global _load_checked, _overloaded
+    if _inflight > MAX_INFLIGHT:
+        return True
+    now = time.monotonic()
+    if now - _load_checked > 1.0:
+        _load_checked = now
+        try:
+            _overloaded = os.getloadavg()[0] / (os.cpu_count() or 1) > MAX_LOAD
+        except OSError:
+            _overloaded = False
+    return _overloaded
+
+
+def _track_start():
+    global _inflight
+    with _lock:
+        _inflight += 1
+    g.compression_tracked = True
+
+
+def _track_end(exc=None):
+    global _inflight
+    if g.pop('compression_tracked', False):
+        with _lock:
+            _inflight -= 1
+
+
+def _tag_etag(response, encoding):
+    # A compressed representation needs its own validator
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag('%s-%s' % (etag, encoding), weak=weak)
+
+
+def _compress_response(response):
+    if response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    if 'Content-Encoding' in response.headers or request.method == 'HEAD':
+        return response
+    if not is_compressible(response.mimetype) or request.headers.get('Range'):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    length = response.content_length
+    if length is not None and length < MIN_SIZE:
+        return response
+    if saturated():
+        return response
+
+    if response.is_streamed and (length is None or length > MAX_BUFFERED):
+        response.direct_passthrough = False
+        response.response = stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+
+    response.headers['Content-Encoding'] = encoding
+    _tag_etag(response, encoding)
+    return response
+
+
+def init_app(app):
+    app.before_request(_track_start)
+    app.teardown_request(_track_end)
+    app.after_request(_compress_response)
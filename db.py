@@ -0,0 +1,173 @@
+"""Instrumented SQLite connections.
+
+get_db() in app.py opens connections with InstrumentedConnection.  Cursors
+created from it time every execute and fetch call, count the rows fetched and
+report each finished statement to the registered statement hooks (metrics,
+slow-query log).  Per-request totals are accumulated on the RequestStats
+object that is current for the running request, if any.  Connections that
+run statements on a thread of their own (asgi.py's aiosqlite pool) cannot see
+the request's context, so the request using one binds its stats to it as
+request_stats.
+"""
+import contextvars
+import sqlite3
+import time
+
+# Called as hook(sql, params, elapsed_seconds, rows, connection) once a
+# statement has been executed and its results consumed
+statement_hooks = []
+
+_current_stats = contextvars.ContextVar('agies_request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('db_time', 'db_queries', 'rows', 'bcrypt_time', 'endpoint')
+
+    def __init__(self, endpoint=None):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.rows = 0
+        self.bcrypt_time = 0.0
+        self.endpoint = endpoint
+
+
+def begin_request(endpoint=None):
+    stats = RequestStats(endpoint)
+    token = _current_stats.set(stats)
+    return stats, token
+
+
+def end_request(token):
+    _current_stats.reset(token)
+
+
+def current_stats():
+    return _current_stats.get()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    def __init__(self, connection):
+        super().__init__(connection)
+        self._sql = None
+        self._params = None
+        self._elapsed = 0.0
+        self._rows = 0
+
+    def _stats(self):
+        stats = _current_stats.get()
+        if stats is None:
+            stats = self.connection.request_stats
+        return stats
+
+    def _account(self, elapsed, rows=0):
+        self._elapsed += elapsed
+        self._rows += rows
+        stats = self._stats()
+        if stats is not None:
+            stats.db_time += elapsed
+            stats.rows += rows
+
+    def _finish(self):
+        sql = self._sql
+        if sql is None:
+            return
+        self._sql = None
+        for hook in statement_hooks:
+            hook(sql, self._params, self._elapsed, self._rows, self.connection)
+
+    def _start(self, sql, params):
+        self._finish()
+        self._sql = sql
+        self._params = params
+        self._elapsed = 0.0
+        self._rows = 0
+        stats = self._stats()
+        if stats is not None:
+            stats.db_queries += 1
+
+    def execute(self, sql, params=()):
+        self._start(sql, params)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._account(time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_params):
+        self._start(sql, None)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_params)
+        finally:
+            self._account(time.perf_counter() - start)
+            self._finish()
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._account(time.perf_counter() - start, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._account(time.perf_counter() - start, len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._account(time.perf_counter() - start, len(rows))
+        self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+        # Long-lived pooled connections would otherwise keep every cursor
+        try:
+            self.connection._cursors.remove(self)
+        except ValueError:
+            pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Stats of the request using a pooled connection, see the module docstring
+    request_stats = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cursors = []
+
+    def cursor(self, factory=InstrumentedCursor):
+        cursor = super().cursor(factory)
+        self._cursors.append(cursor)
+        return cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def close(self):
+        # Statements whose results were only partly fetched end here
+        for cursor in self._cursors:
+            cursor._finish()
+        self._cursors = []
+        super().close()
+
+
+# Run on every new connection, outside the instrumentation (see walarchive.py)
+connect_pragmas = []
+
+
+def connect(database, **kwargs):
+    conn = sqlite3.connect(database, factory=InstrumentedConnection, **kwargs)
+    for pragma in connect_pragmas:
+        sqlite3.Cursor(conn).execute(pragma).close()
+    return conn
@@ -0,0 +1,186 @@
+"""Keyed password fingerprints for reuse detection.
+
+Each stored password gets an HMAC-SHA256 fingerprint computed with a server
+side key and the owning user's id.  Equal secrets belonging to the same user
+produce equal fingerprints, so reuse checks are lookups on the
+(user_id, fingerprint) index and never need the plaintext.  Without the key a
+fingerprint cannot be used to test password guesses.
+
+The key comes from AGIES_FINGERPRINT_KEY (hex) or is generated once into
+AGIES_FINGERPRINT_KEY_FILE.  A relative path is resolved against the working
+directory the first time it is needed and then kept, so a later chdir cannot
+make the process mint a fresh key.  A missing key file is only generated while no fingerprints are stored;
+otherwise startup fails instead of silently breaking reuse detection.
+Changing the key invalidates every stored fingerprint; run
+backfill_fingerprints(c, recompute=True) afterwards.
+rotate_key() replaces the key file; other processes notice the new file
+within KEY_RECHECK seconds, so a recompute has to start KEY_SWITCH_DELAY
+seconds after the rotation to catch everything written with the old key.
+"""
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from migrations import add_column
+
+# Hex characters kept from the digest (128 bits)
+FINGERPRINT_LENGTH = 32
+
+# Seconds between checks for a key file replaced by rotate_key()
+KEY_RECHECK = 5
+
+# Seconds after rotate_key() by which every process fingerprints with the new
+# key: one recheck interval plus slack for requests already in flight
+KEY_SWITCH_DELAY = KEY_RECHECK + 1
+
+_key = None
+_key_mtime = None
+_key_checked = 0.0
+_key_path = None
+
+
+def key_file():
+    global _key_path
+    if _key_path is None:
+        _key_path = os.path.abspath(os.environ.get('AGIES_FINGERPRINT_KEY_FILE', 'agies.fingerprint.key'))
+    return _key_path
+
+
+def _load_key():
+    env_key = os.environ.get('AGIES_FINGERPRINT_KEY')
+    if env_key:
+        return bytes.fromhex(env_key)
+
+    # O_EXCL so that concurrently starting workers agree on a single key
+    try:
+        fd = os.open(key_file(), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(key_file()) as f:
+            return bytes.fromhex(f.read().strip())
+    key = secrets.token_bytes(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key.hex())
+    return key
+
+
+def _key_file_mtime():
+    try:
+        return os.stat(key_file()).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_key():
+    global _key, _key_mtime, _key_checked
+    if _key is not None and not os.environ.get('AGIES_FINGERPRINT_KEY'):
+        now = time.monotonic()
+        if now - _key_checked > KEY_RECHECK:
+            _key_checked = now
+            # A vanished file keeps the current key rather than minting one
+            if _key_file_mtime() not in (_key_mtime, None):
+                _key = None
+    if _key is None:
+        _key = _load_key()
+        _key_mtime = _key_file_mtime()
+        _key_checked = time.monotonic()
+    return _key
+
+
+def rotate_key():
+    # Installs a fresh key file; stored fingerprints must be recomputed
+    global _key, _key_mtime
+    if os.environ.get('AGIES_FINGERPRINT_KEY'):
+        raise RuntimeError('AGIES_FINGERPRINT_KEY is set; rotate the key in the environment instead')
+    key = secrets.token_bytes(32)
+    tmp = '%s.%d.tmp' % (key_file(), os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(key.hex())
+    os.replace(tmp, key_file())
+    _key, _key_mtime = key, _key_file_mtime()
+    return key
+
+
+def fingerprint(user_id, password):
+    message = ('%s\x00%s' % (user_id, password)).encode('utf-8')
+    return hmac.new(get_key(), message, hashlib.sha256).hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def init_fingerprint_schema(c):
+    # passwords.user_id duplicates vaults.user_id so the reuse index does not
+    # need a join
+    add_column(c, 'passwords', 'user_id', 'TEXT')
+    add_column(c, 'passwords', 'fingerprint', 'TEXT')
+    if not os.environ.get('AGIES_FINGERPRINT_KEY') and _key_file_mtime() is None:
+        c.execute('SELECT 1 FROM passwords WHERE fingerprint IS NOT NULL LIMIT 1')
+        if c.fetchone():
+            raise RuntimeError('%s is missing but the database holds fingerprints made with it; '
+                               'restore the key file or set AGIES_FINGERPRINT_KEY' % key_file())
+    c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_passwords_user_fingerprint
+        ON passwords (user_id, fingerprint)
+    ''')
+    backfill_fingerprints(c)
+
+
+def backfill_fingerprints(c, recompute=False):
+    # Honeytoken items never get fingerprints so they cannot count as reuse
+    where = 'WHERE p.is_honeytoken = 0'
+    if not recompute:
+        where += ' AND (p.fingerprint IS NULL OR p.user_id IS NULL)'
+    c.execute('''
+        SELECT p.id, v.user_id, p.password FROM passwords p
+        JOIN vaults v ON p.vault_id = v.id
+    ''' + where)
+    rows = c.fetchall()
+    for password_id, user_id, password in rows:
+        c.execute('UPDATE passwords SET user_id = ?, fingerprint = ? WHERE id = ?',
+                  (user_id, fingerprint(user_id, password), password_id))
+    return len(rows)
+
+
+def reuse_count(c, user_id, fp, exclude_id=None):
+    # Number of the user's items (other than exclude_id) holding this secret
+    c.execute('''
+        SELECT COUNT(*) FROM passwords
+        WHERE user_id = ? AND fingerprint = ? AND id != ?
+    ''', (user_id, fp, exclude_id or ''))
+    return c.fetchone()[0]
+
+
+def reuse_snapshot(c, user_id, fp):
+    # Items per vault currently holding this secret
+    c.execute('''
+        SELECT vault_id, COUNT(*) FROM passwords
+        WHERE user_id = ? AND fingerprint = ?
+        GROUP BY vault_id
+    ''', (user_id, fp))
+    return dict((row[0], row[1]) for row in c.fetchall())
+
+
+def reuse_report(c, user_id):
+    # Groups of items sharing a secret, largest first
+    c.execute('''
+        SELECT fingerprint, COUNT(*) AS n FROM passwords
+        WHERE user_id = ? AND fingerprint IS NOT NULL
+        GROUP BY fingerprint HAVING n > 1
+        ORDER BY n DESC
+    ''', (user_id,))
+    counts = c.fetchall()
+    if not counts:
+        return []
+
+    groups = dict((row[0], []) for row in counts)
+    for fp in groups:
+        c.execute('''
+            SELECT id, vault_id, title, username, url FROM passwords
+            WHERE user_id = ? AND fingerprint = ?
+        ''', (user_id, fp))
+        groups[fp] = [
+            {"id": row[0], "vault_id": row[1], "title": row[2], "username": row[3], "url": row[4]}
+            for row in c.fetchall()
+        ]
+
+    return [{"count": n, "items": groups[fp]} for fp, n in counts]
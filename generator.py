@@ -0,0 +1,200 @@
+"""Server-side password and passphrase generation from named policies.
+
+Randomness comes from os.urandom, drawn in one bulk buffer per batch instead
+of one call per character.  Bytes are mapped onto the alphabet or wordlist by
+rejection sampling so every symbol is equally likely.  Wordlists are read
+once per process and kept in memory.
+"""
+import functools
+import math
+import os
+import string
+
+WORDLIST_DIR = os.environ.get('AGIES_WORDLIST_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wordlists'))
+
+MAX_COUNT = 1000
+MAX_LENGTH = 256
+MAX_WORDS = 20
+
+CHARACTER_CLASSES = {
+    'lower': string.ascii_lowercase,
+    'upper': string.ascii_uppercase,
+    'digits': string.digits,
+    'symbols': '!@#$%^&*()-_=+[]{};:,.<>/?~',
+}
+
+AMBIGUOUS = 'Il1O0o|`\'"'
+
+POLICIES = {
+    'default': {
+        'kind': 'password', 'length': 20,
+        'classes': ['lower', 'upper', 'digits', 'symbols'], 'exclude': '',
+    },
+    'strong': {
+        'kind': 'password', 'length': 32,
+        'classes': ['lower', 'upper', 'digits', 'symbols'], 'exclude': '',
+    },
+    'alphanumeric': {
+        'kind': 'password', 'length': 20,
+        'classes': ['lower', 'upper', 'digits'], 'exclude': '',
+    },
+    'readable': {
+        'kind': 'password', 'length': 16,
+        'classes': ['lower', 'upper', 'digits'], 'exclude': AMBIGUOUS,
+    },
+    'pin': {
+        'kind': 'password', 'length': 6,
+        'classes': ['digits'], 'exclude': '',
+    },
+    'passphrase': {
+        'kind': 'passphrase', 'words': 5, 'wordlist': 'common',
+        'separator': '-', 'capitalize': False,
+    },
+    'passphrase-strong': {
+        'kind': 'passphrase', 'words': 7, 'wordlist': 'common',
+        'separator': '-', 'capitalize': True,
+    },
+}
+
+# Fields a request may override on top of its named policy
+OVERRIDABLE = ('length', 'classes', 'exclude', 'words', 'wordlist', 'separator', 'capitalize')
+
+# What each override has to be, as checked by _check_override()
+OVERRIDE_TYPES = {
+    'length': 'an integer',
+    'classes': 'a list of class names',
+    'exclude': 'a string',
+    'words': 'an integer',
+    'wordlist': 'a string',
+    'separator': 'a string',
+    'capitalize': 'a boolean',
+}
+
+
+@functools.lru_cache(maxsize=8)
+def load_wordlist(name):
+    # Names map to files in WORDLIST_DIR; the path is not taken from clients
+    if not name or os.sep in name or name.startswith('.'):
+        raise ValueError('Unknown wordlist: %s' % name)
+    path = os.path.join(WORDLIST_DIR, name + '.txt')
+    if not os.path.isfile(path):
+        raise ValueError('Unknown wordlist: %s' % name)
+    with open(path, encoding='utf-8') as f:
+        words = tuple(sorted(set(line.strip() for line in f if line.strip())))
+    if len(words) < 2:
+        raise ValueError('Wordlist %s is empty' % name)
+    return words
+
+
+def _uniform_indices(n, count):
+    # count independent uniform integers in [0, n) from bulk urandom draws;
+    # values that would bias the modulo are rejected and redrawn
+    width = 1 if n <= 256 else 2 if n <= 65536 else 4
+    space = 256 ** width
+    limit = space - space % n
+    # Ask for enough bytes up front that a second draw is rarely needed
+    accept = limit / space
+    indices = []
+    while len(indices) < count:
+        missing = count - len(indices)
+        buf = os.urandom(width * (int(missing / accept * 1.1) + 16))
+        for offset in range(0, len(buf), width):
+            value = int.from_bytes(buf[offset:offset + width], 'big')
+            if value < limit:
+                indices.append(value % n)
+                if len(indices) == count:
+                    break
+    return indices
+
+
+def _check_override(key, value):
+    # Returns the value to use; anything of the wrong type is a ValueError
+    # like every other invalid setting, never an error further down
+    expected = OVERRIDE_TYPES[key]
+    if expected == 'an integer':
+        # Numeric strings are accepted as before
+        if isinstance(value, str) and value.strip().isdigit():
+            return int(value)
+        valid = isinstance(value, int) and not isinstance(value, bool)
+    elif expected == 'a list of class names':
+        valid = isinstance(value, list) and all(isinstance(cls, str) for cls in value)
+    elif expected == 'a boolean':
+        valid = isinstance(value, bool)
+    else:
+        valid = isinstance(value, str)
+    if not valid:
+        raise ValueError('%s must be %s' % (key, expected))
+    return value
+
+
+def resolve_policy(name, overrides=None):
+    if not isinstance(name, str) or name not in POLICIES:
+        raise ValueError('Unknown policy: %s' % name)
+    policy = dict(POLICIES[name])
+    for key in OVERRIDABLE:
+        if overrides and overrides.get(key) is not None:
+            policy[key] = _check_override(key, overrides[key])
+    return policy
+
+
+def _alphabet(policy):
+    classes = policy['classes']
+    if not classes or any(cls not in CHARACTER_CLASSES for cls in classes):
+        raise ValueError('classes must be a non-empty subset of %s' % ', '.join(CHARACTER_CLASSES))
+    exclude = set(policy.get('exclude') or '')
+    groups = [''.join(ch for ch in CHARACTER_CLASSES[cls] if ch not in exclude) for cls in classes]
+    if not all(groups):
+        raise ValueError('Exclusions remove every character of a required class')
+    return ''.join(groups), groups
+
+
+def _generate_passwords(policy, count):
+    length = int(policy['length'])
+    alphabet, groups = _alphabet(policy)
+    if not len(groups) <= length <= MAX_LENGTH:
+        raise ValueError('length must be between %d and %d' % (len(groups), MAX_LENGTH))
+
+    n = len(alphabet)
+    passwords = []
+    while len(passwords) < count:
+        # One draw for every password still missing; candidates that lack a
+        # required class are discarded, which keeps the output uniform over
+        # all valid passwords
+        missing = count - len(passwords)
+        indices = _uniform_indices(n, missing * length)
+        for start in range(0, len(indices), length):
+            candidate = ''.join(alphabet[i] for i in indices[start:start + length])
+            if all(any(ch in group for ch in candidate) for group in groups):
+                passwords.append(candidate)
+    return passwords, length * math.log2(n)
+
+
+def _generate_passphrases(policy, count):
+    words = int(policy['words'])
+    if not 2 <= words <= MAX_WORDS:
+        raise ValueError('words must be between 2 and %d' % MAX_WORDS)
+    wordlist = load_wordlist(policy['wordlist'])
+    separator = policy.get('separator', '-')
+    capitalize = policy.get('capitalize', False)
+
+    indices = _uniform_indices(len(wordlist), count * words)
+    phrases = []
+    for start in range(0, len(indices), words):
+        chosen = [wordlist[i] for i in indices[start:start + words]]
+        if capitalize:
+            chosen = [word.capitalize() for word in chosen]
+        phrases.append(separator.join(chosen))
+    return phrases, words * math.log2(len(wordlist))
+
+
+def generate(name, count=1, overrides=None):
+    # Returns (secrets, entropy bits per secret, resolved policy)
+    if not 1 <= count <= MAX_COUNT:
+        raise ValueError('count must be between 1 and %d' % MAX_COUNT)
+    policy = resolve_policy(name, overrides)
+    if policy['kind'] == 'passphrase':
+        results, bits = _generate_passphrases(policy, count)
+    else:
+        results, bits = _generate_passwords(policy, count)
+    return results, bits, policy
@@ -0,0 +1,308 @@
+"""Honeytoken items and decoy vaults with a cheap in-process tripwire.
+
+Every user gets a decoy vault filled with convincing fake credentials (the same
+decoy data sets as src/services/honeytoken-service.ts).  The ids of decoy
+vaults and honeytoken items are registered in the honeytokens table and loaded
+into a per-process Bloom filter backed by an exact set.  Read and write paths
+call check() with the id being accessed; for ordinary ids the Bloom filter
+answers "no" after three bit probes, so the tripwire stays well under a
+microsecond.  Alerts are handed to a background writer thread and never touch
+the database on the request path.
+
+Decoys are kept out of the owner's vault listing, exports and health
+reports, so ordinary use of the account never touches them; the tripwire
+fires when their ids are used anyway, e.g. after being read from a copy of
+the database.  Callers who cannot see a decoy get the same 404 as for an
+unknown id, and the owner's updates and deletes answer like real ones
+without changing anything.
+
+Tokens created by other worker processes are picked up by a refresher thread
+every AGIES_HONEYTOKEN_REFRESH seconds.  start() must run in each worker
+process (gunicorn without --preload imports app.py per worker).
+"""
+import logging
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+
+import db
+import ids
+import sharing
+import vault_tree
+from migrations import add_column
+
+REFRESH_INTERVAL = float(os.environ.get('AGIES_HONEYTOKEN_REFRESH', 5))
+
+logger = logging.getLogger(__name__)
+
+DECOY_VAULTS = [
+    ('Old Accounts', '🗂️', [
+        ('Gmail', 'fake@gmail.com', 'password123', 'https://mail.google.com'),
+        ('Facebook', 'fakeuser', 'welcome123', 'https://facebook.com'),
+        ('Instagram', 'fake_insta', 'insta2024!', 'https://instagram.com'),
+    ]),
+    ('Work Accounts', '💼', [
+        ('Corporate Email', 'employee@company.com', 'CorpAccess2024!', 'https://mail.company.com'),
+        ('Slack', 'employee', 'slack_token_123', 'https://slack.com'),
+        ('Jira', 'employee', 'jira_access_2024', 'https://jira.company.com'),
+        ('AWS Console', 'fake_aws_user', 'aws_access_key_123', 'https://aws.amazon.com'),
+    ]),
+    ('Banking', '🏦', [
+        ('Banking', 'account_holder', 'bank_access_2024', 'https://bank.com'),
+        ('PayPal', 'fake_paypal', 'paypal_secure_123', 'https://paypal.com'),
+        ('Credit Card Portal', 'card_holder', 'card_portal_2024', 'https://creditcard.com'),
+    ]),
+    ('Admin Credentials', '🛡️', [
+        ('Root Access', 'root', 'MasterRoot2024!', 'https://system.admin.com'),
+        ('Database Admin', 'db_admin', 'DBMasterKey2024$', 'https://database.admin.com'),
+        ('API Gateway', 'api_admin', 'GatewayAccess2024#', 'https://api.admin.com'),
+        ('SSH Access', 'admin', 'SSHMasterKey2024!', 'ssh://admin.system.com'),
+    ]),
+]
+
+
+class BloomFilter:
+    # Three probes derived from a single hash() call (double hashing).
+    # hash() is salted per process, which is fine for a per-process filter.
+    BITS_PER_ITEM = 16
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.size = capacity * self.BITS_PER_ITEM
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def add(self, key):
+        h = hash(key)
+        a = h & 0xffffffff
+        b = (h >> 32) | 1
+        for i in range(3):
+            j = (a + i * b) % self.size
+            self.bits[j >> 3] |= 1 << (j & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        h = hash(key)
+        size = self.size
+        bits = self.bits
+        a = h & 0xffffffff
+        j = a % size
+        if not bits[j >> 3] & (1 << (j & 7)):
+            return False
+        b = (h >> 32) | 1
+        j = (a + b) % size
+        if not bits[j >> 3] & (1 << (j & 7)):
+            return False
+        j = (a + 2 * b) % size
+        return bool(bits[j >> 3] & (1 << (j & 7)))
+
+
+class Tripwire:
+    def __init__(self):
+        self.bloom = BloomFilter()
+        self.exact = set()
+        self.lock = threading.Lock()
+
+    def add(self, token_id):
+        with self.lock:
+            if token_id in self.exact:
+                return
+            self.exact.add(token_id)
+            if self.bloom.count >= self.bloom.capacity:
+                # Rebuild at double capacity and swap in atomically
+                bloom = BloomFilter(self.bloom.capacity * 2)
+                for existing in self.exact:
+                    bloom.add(existing)
+                self.bloom = bloom
+            else:
+                self.bloom.add(token_id)
+
+    def __contains__(self, token_id):
+        return token_id in self.bloom and token_id in self.exact
+
+
+_tripwire = Tripwire()
+_alerts = queue.Queue()
+_database = None
+_last_rowid = 0
+_started = False
+
+
+def init_honeytoken_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS honeytokens (
+            id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            vault_id BLOB NOT NULL,
+            target_id BLOB NOT NULL,
+            token_type TEXT NOT NULL,
+            trigger_count INTEGER DEFAULT 0,
+            last_triggered TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_honeytokens_user ON honeytokens (user_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_honeytokens_target ON honeytokens (target_id)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS honeytoken_alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            honeytoken_id TEXT,
+            user_id TEXT,
+            target_id BLOB NOT NULL,
+            access_type TEXT NOT NULL,
+            ip_address TEXT,
+            user_agent TEXT,
+            created_at TIMESTAMP NOT NULL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_honeytoken_alerts_user ON honeytoken_alerts (user_id, created_at)')
+
+    # Decoy rows are kept out of health counters and reuse fingerprints
+    add_column(c, 'vaults', 'is_decoy', 'INTEGER DEFAULT 0')
+    add_column(c, 'passwords', 'is_honeytoken', 'INTEGER DEFAULT 0')
+
+
+def seed_user(c, user_id):
+    # Creates the user's decoy vault unless one exists; returns its id
+    c.execute('SELECT id FROM vaults WHERE user_id = ? AND is_decoy = 1', (user_id,))
+    row = c.fetchone()
+    if row:
+        return row[0]
+
+    name, icon, items = secrets.choice(DECOY_VAULTS)
+    vault_id = ids.new_id()
+    c.execute('''
+        INSERT INTO vaults (id, user_id, name, description, icon, password_count, is_decoy)
+        VALUES (?, ?, ?, ?, ?, ?, 1)
+    ''', (vault_id, user_id, name, '', icon, len(items)))
+    vault_tree.add_vault(c, vault_id)
+    sharing.add_owner(c, user_id, vault_id)
+    tokens = [(str(uuid.uuid4()), user_id, vault_id, vault_id, 'decoy_vault')]
+
+    for title, username, password, url in items:
+        password_id = ids.new_id()
+        c.execute('''
+            INSERT INTO passwords (id, vault_id, user_id, title, username, password, url, notes,
+                                   is_honeytoken)
+            VALUES (?, ?, ?, ?, ?, ?, ?, '', 1)
+        ''', (password_id, vault_id, user_id, title, username, password, url))
+        tokens.append((str(uuid.uuid4()), user_id, vault_id, password_id, 'password'))
+
+    c.executemany('''
+        INSERT INTO honeytokens (id, user_id, vault_id, target_id, token_type)
+        VALUES (?, ?, ?, ?, ?)
+    ''', tokens)
+
+    # Arm this process immediately; other workers pick it up on refresh
+    for token in tokens:
+        _tripwire.add(token[3])
+    return vault_id
+
+
+def forget_vault(c, vault_id):
+    c.execute('DELETE FROM honeytokens WHERE vault_id = ?', (vault_id,))
+
+
+def check(target_id, access_type, user_id=None, ip_address=None, user_agent=None):
+    # Hot path: returns True (and queues an alert) only for honeytoken ids
+    if target_id not in _tripwire:
+        return False
+    _alerts.put((target_id, access_type, user_id, ip_address, user_agent,
+                 time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())))
+    return True
+
+
+def is_honeytoken(target_id):
+    return target_id in _tripwire
+
+
+def get_alerts(c, user_id, limit=100):
+    c.execute('''
+        SELECT target_id, access_type, ip_address, user_agent, created_at
+        FROM honeytoken_alerts WHERE user_id = ?
+        ORDER BY created_at DESC LIMIT ?
+    ''', (user_id, limit))
+    return [
+        {"target_id": row[0], "access_type": row[1], "ip_address": row[2],
+         "user_agent": row[3], "created_at": row[4]}
+        for row in c.fetchall()
+    ]
+
+
+def _load_new_tokens(conn):
+    global _last_rowid
+    rows = conn.execute('SELECT rowid, target_id FROM honeytokens WHERE rowid > ? ORDER BY rowid',
+                        (_last_rowid,)).fetchall()
+    for rowid, target_id in rows:
+        _tripwire.add(target_id)
+        _last_rowid = rowid
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(REFRESH_INTERVAL)
+        try:
+            conn = sqlite3.connect(_database)
+            try:
+                _load_new_tokens(conn)
+            finally:
+                conn.close()
+        except Exception:
+            logger.exception('Honeytoken refresh failed')
+
+
+def _write_alerts(conn, batch):
+    for target_id, access_type, user_id, ip_address, user_agent, created_at in batch:
+        row = conn.execute('SELECT id, user_id FROM honeytokens WHERE target_id = ?',
+                           (target_id,)).fetchone()
+        honeytoken_id, owner_id = row if row else (None, user_id)
+        conn.execute('''
+            INSERT INTO honeytoken_alerts (honeytoken_id, user_id, target_id, access_type,
+                                           ip_address, user_agent, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (honeytoken_id, owner_id, target_id, access_type, ip_address, user_agent, created_at))
+        conn.execute('''
+            UPDATE honeytokens SET trigger_count = trigger_count + 1, last_triggered = ?
+            WHERE id = ?
+        ''', (created_at, honeytoken_id))
+        logger.warning('Honeytoken %s tripped by %s (%s from %s)',
+                       ids.to_str(target_id), user_id, access_type, ip_address)
+    conn.commit()
+
+
+def _alert_loop():
+    while True:
+        batch = [_alerts.get()]
+        while True:
+            try:
+                batch.append(_alerts.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            conn = db.connect(_database)
+            try:
+                _write_alerts(conn, batch)
+            finally:
+                conn.close()
+        except Exception:
+            logger.exception('Failed to record %d honeytoken alerts', len(batch))
+
+
+def start(database):
+    # Loads every known token and starts the alert writer and refresher
+    global _database, _started
+    _database = database
+    conn = sqlite3.connect(database)
+    try:
+        _load_new_tokens(conn)
+    finally:
+        conn.close()
+
+    if not _started:
+        _started = True
+        threading.Thread(target=_alert_loop, name='honeytoken-alerts', daemon=True).start()
+        threading.Thread(target=_refresh_loop, name='honeytoken-refresh', daemon=True).start()
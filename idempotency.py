@@ -0,0 +1,158 @@
+"""Idempotency-Key support for POST endpoints that create things.
+
+A client that retries a request with the same Idempotency-Key header gets
+the stored response of the first attempt back (with Idempotent-Replayed:
+true) instead of the request running again: no second insert, no second
+bcrypt hash.  Keys are scoped to the X-User-ID of the caller (register has
+no user, so its keys share one anonymous scope) and to the endpoint.
+
+    * a retry while the first attempt is still running gets 409
+    * reusing a key for a different request body gets 422
+    * 5xx responses are not stored, so the retry runs again
+
+Stored responses expire after AGIES_IDEMPOTENCY_TTL seconds and the table
+is trimmed to AGIES_IDEMPOTENCY_MAX_KEYS rows, oldest first.  The response
+is stored after the endpoint has committed; a crash between the two lets
+one retry through.
+"""
+import functools
+import hashlib
+import os
+import time
+
+from flask import current_app, jsonify, request
+
+import db
+
+TTL = int(os.environ.get('AGIES_IDEMPOTENCY_TTL', 24 * 3600))
+MAX_KEYS = int(os.environ.get('AGIES_IDEMPOTENCY_MAX_KEYS', 100000))
+# Abandoned claims (worker killed mid-request) are released after this long
+CLAIM_TIMEOUT = int(os.environ.get('AGIES_IDEMPOTENCY_CLAIM_TIMEOUT', 60))
+PRUNE_INTERVAL = 60
+MAX_KEY_LENGTH = 255
+
+_database = None
+_last_prune = 0.0
+
+
+def init_idempotency_schema(c):
+    # status is NULL while the first request holding the key is running
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status INTEGER,
+            content_type TEXT,
+            body BLOB,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (scope, endpoint, key)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at)')
+
+
+def start(database):
+    global _database
+    _database = database
+
+
+def _request_hash():
+    digest = hashlib.sha256()
+    digest.update(request.method.encode('utf-8') + b'\x00')
+    digest.update(request.path.encode('utf-8') + b'\x00')
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def _prune(conn, now):
+    global _last_prune
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    conn.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - TTL,))
+    conn.execute('''
+        DELETE FROM idempotency_keys WHERE rowid IN (
+            SELECT rowid FROM idempotency_keys ORDER BY created_at DESC LIMIT -1 OFFSET ?
+        )
+    ''', (MAX_KEYS,))
+
+
+def _claim(conn, scope, endpoint, key, request_hash, now):
+    # Returns None when the key is ours to run, else the stored row
+    conn.execute('''
+        DELETE FROM idempotency_keys
+        WHERE scope = ? AND endpoint = ? AND key = ?
+          AND (created_at < ? OR (status IS NULL AND created_at < ?))
+    ''', (scope, endpoint, key, now - TTL, now - CLAIM_TIMEOUT))
+    cursor = conn.execute('''
+        INSERT OR IGNORE INTO idempotency_keys (scope, endpoint, key, request_hash, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (scope, endpoint, key, request_hash, now))
+    if cursor.rowcount == 1:
+        return None
+    cursor = conn.execute('''
+        SELECT request_hash, status, content_type, body FROM idempotency_keys
+        WHERE scope = ? AND endpoint = ? AND key = ?
+    ''', (scope, endpoint, key))
+    return cursor.fetchone()
+
+
+def _replay(app, row, request_hash):
+    stored_hash, status, content_type, body = row
+    if stored_hash != request_hash:
+        return jsonify({"error": "Idempotency-Key was already used for a different request"}), 422
+    if status is None:
+        return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409
+    response = app.response_class(body, status=status, content_type=content_type)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    # Wraps a view; requests without an Idempotency-Key run unchanged
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({"error": "Idempotency-Key is too long"}), 400
+
+        app = current_app._get_current_object()
+        scope = request.headers.get('X-User-ID', '')
+        endpoint = request.endpoint
+        request_hash = _request_hash()
+        now = time.time()
+
+        conn = db.connect(_database, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = _claim(conn, scope, endpoint, key, request_hash, now)
+            _prune(conn, now)
+            conn.execute('COMMIT')
+            if row is not None:
+                return _replay(app, row, request_hash)
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except Exception:
+                conn.execute('DELETE FROM idempotency_keys WHERE scope = ? AND endpoint = ? AND key = ?',
+                             (scope, endpoint, key))
+                raise
+
+            if response.status_code >= 500 or response.is_streamed:
+                conn.execute('DELETE FROM idempotency_keys WHERE scope = ? AND endpoint = ? AND key = ?',
+                             (scope, endpoint, key))
+            else:
+                conn.execute('''
+                    UPDATE idempotency_keys SET status = ?, content_type = ?, body = ?
+                    WHERE scope = ? AND endpoint = ? AND key = ?
+                ''', (response.status_code, response.content_type, response.get_data(),
+                      scope, endpoint, key))
+            return response
+        finally:
+            conn.close()
+
+    return wrapper
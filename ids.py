@@ -0,0 +1,141 @@
+"""Time-ordered binary ids for vaults and passwords.
+
+Vault and password ids are UUIDv7 (RFC 9562): a 48-bit Unix millisecond
+timestamp, a 12-bit counter that keeps ids minted in the same millisecond in
+order, and 62 random bits.  They are stored as 16-byte BLOBs, so new rows are
+appended at the right-hand edge of the primary key B-trees instead of landing
+on a random page, and every index, join and ACL lookup compares 16 bytes
+instead of a 36-character string.
+
+Handlers pass the bytes around untouched; conversion happens at the API
+boundary only:
+
+    path parameters     the 'id' URL converter (<id:vault_id>)
+    bodies and queries  parse()
+    JSON responses      serialization's default hook calls to_str()
+
+Malformed ids parse to INVALID, which matches no row, so they fail the same
+way unknown ids do.  Users, jobs and honeytoken registry ids stay TEXT.
+
+migrate() rewrites databases created with TEXT uuid4 ids in place (the same
+UUIDs, as bytes) and records that in PRAGMA user_version; it runs from
+init_db() and is a no-op afterwards.  Columns keep their declared type on
+migrated databases, which SQLite does not enforce for BLOBs.
+"""
+import secrets
+import threading
+import time
+import uuid
+
+from werkzeug.routing import BaseConverter
+
+from migrations import table_exists
+
+# Never a valid id: matches no row but is not falsy like b''
+INVALID = b'\x00'
+
+# PRAGMA user_version once TEXT ids have been converted
+BINARY_IDS_VERSION = 1
+
+# Columns that hold vault or password ids, with a row filter where the
+# column mixes them with other ids
+ID_COLUMNS = (
+    ('vaults', 'id', None),
+    ('vaults', 'parent_vault_id', None),
+    ('passwords', 'id', None),
+    ('passwords', 'vault_id', None),
+    ('honeytokens', 'vault_id', None),
+    ('honeytokens', 'target_id', None),
+    ('honeytoken_alerts', 'target_id', None),
+    ('health_counters', 'scope_id', "scope = 'vault'"),
+    ('health_age_buckets', 'scope_id', "scope = 'vault'"),
+    ('item_tags', 'password_id', None),
+    ('vault_tree', 'ancestor_id', None),
+    ('vault_tree', 'descendant_id', None),
+    ('vault_shares', 'vault_id', None),
+    ('vault_acl', 'vault_id', None),
+    ('password_history', 'password_id', None),
+    ('change_events', 'vault_id', None),
+    ('change_events', 'password_id', None),
+)
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+
+def new_id():
+    global _last_ms, _counter
+    with _lock:
+        ms = time.time_ns() // 1000000
+        if ms > _last_ms:
+            # Start low in the counter space so a burst has room to grow
+            _last_ms = ms
+            _counter = secrets.randbits(10)
+        else:
+            # Same millisecond (or the clock stepped back): count on, and
+            # borrow the next millisecond once the counter is used up
+            _counter += 1
+            if _counter > 0xfff:
+                _last_ms += 1
+                _counter = 0
+        ms, counter = _last_ms, _counter
+    value = (ms << 80) | (0x7 << 76) | (counter << 64) | (0x2 << 62) | secrets.randbits(62)
+    return value.to_bytes(16, 'big')
+
+
+def parse(value):
+    # API string -> 16 bytes; None and '' mean no id, anything malformed
+    # is INVALID
+    if value is None or value == '':
+        return None
+    try:
+        return uuid.UUID(value).bytes
+    except (AttributeError, TypeError, ValueError):
+        return INVALID
+
+
+def to_str(value):
+    # 16 bytes -> canonical UUID string
+    h = bytes(value).hex()
+    if len(h) != 32:
+        return h
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+class IdConverter(BaseConverter):
+    # Accepts any path segment so malformed ids reach the view and get its
+    # usual 404 instead of falling through to the static file route
+    def to_python(self, value):
+        return parse(value)
+
+    def to_url(self, value):
+        return to_str(value) if isinstance(value, bytes) else super().to_url(value)
+
+
+def _text_to_bytes(value):
+    # SQL helper for migrate(); values that are not UUIDs are left alone
+    try:
+        return uuid.UUID(value).bytes
+    except (AttributeError, TypeError, ValueError):
+        return value
+
+
+def migrate(c):
+    # Returns the number of values converted; call at the end of init_db()
+    # inside its transaction, once every table exists
+    c.execute('PRAGMA user_version')
+    if c.fetchone()[0] >= BINARY_IDS_VERSION:
+        return 0
+    c.connection.create_function('agies_id_bytes', 1, _text_to_bytes, deterministic=True)
+    converted = 0
+    for table, column, condition in ID_COLUMNS:
+        if not table_exists(c, table):
+            continue
+        c.execute('''
+            UPDATE %s SET %s = agies_id_bytes(%s)
+            WHERE typeof(%s) = 'text' %s
+        ''' % (table, column, column, column, ('AND ' + condition) if condition else ''))
+        converted += c.rowcount
+    c.execute('PRAGMA user_version = %d' % BINARY_IDS_VERSION)
+    return converted
@@ -0,0 +1,329 @@
+"""SQLite-backed background jobs.
+
+Work that is too slow for a request (deleting very large vaults, exports,
+health reconciliation, fingerprint key rotation) is queued in the jobs table
+and picked up by AGIES_JOB_WORKERS threads in every app process.  A job is
+claimed inside BEGIN IMMEDIATE, so each job runs in exactly one worker even
+with several gunicorn processes sharing the database.
+
+Handlers are registered with @handler(job_type) and called as
+handler(job, conn).  They report progress through job.progress().  While a
+handler runs, a heartbeat thread renews the job's lease on its own
+connection every HEARTBEAT seconds, whether or not the handler reports
+progress; a running job whose lease is older than AGIES_JOB_LEASE seconds is
+assumed lost with its worker and is retried.  A worker whose job was taken
+over that way can no longer change the job's state or result.
+
+Housekeeping that has to run regularly but must not slow down requests is
+registered with @periodic(interval) and called as fn(conn) from the workers,
+at most once per interval per process, with an autocommit connection.
+Failures are retried with exponential backoff up to max_attempts.  Finished
+jobs and their result files are removed after AGIES_JOB_RETENTION seconds.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import db
+from vault_health import utc_timestamp
+
+WORKERS = int(os.environ.get('AGIES_JOB_WORKERS', 2))
+POLL_INTERVAL = float(os.environ.get('AGIES_JOB_POLL', 1.0))
+LEASE = int(os.environ.get('AGIES_JOB_LEASE', 300))
+RETENTION = int(os.environ.get('AGIES_JOB_RETENTION', 7 * 24 * 3600))
+RESULT_DIR = os.environ.get('AGIES_JOB_DIR', 'jobs')
+BACKOFF = 5
+# Seconds between lease renewals, well inside the lease
+HEARTBEAT = LEASE / 3.0
+PRUNE_INTERVAL = 600
+
+HANDLERS = {}
+# [fn, interval, last run] entries registered with @periodic
+PERIODIC = []
+
+logger = logging.getLogger('agies.jobs')
+
+_database = None
+_wakeup = threading.Event()
+_started = False
+_last_prune = 0.0
+_periodic_lock = threading.Lock()
+
+
+def init_jobs_schema(c):
+    # run_after and locked_at are epoch seconds so they can be compared in SQL
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            job_type TEXT NOT NULL,
+            user_id TEXT,
+            payload TEXT,
+            status TEXT NOT NULL DEFAULT 'queued',
+            priority INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 3,
+            progress REAL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            run_after REAL NOT NULL,
+            locked_by TEXT,
+            locked_at REAL,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority DESC, run_after)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, created_at)')
+
+
+def handler(job_type):
+    def register(fn):
+        HANDLERS[job_type] = fn
+        return fn
+    return register
+
+
+def periodic(interval):
+    def register(fn):
+        PERIODIC.append([fn, interval, 0.0])
+        return fn
+    return register
+
+
+def enqueue(c, job_type, payload=None, user_id=None, priority=0, max_attempts=3):
+    # Runs in the caller's transaction; workers see the job once it commits
+    if job_type not in HANDLERS:
+        raise ValueError('Unknown job type: %s' % job_type)
+    job_id = str(uuid.uuid4())
+    now = utc_timestamp()
+    c.execute('''
+        INSERT INTO jobs (id, job_type, user_id, payload, priority, max_attempts,
+                          run_after, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (job_id, job_type, user_id, json.dumps(payload or {}), priority, max_attempts,
+          time.time(), now, now))
+    _wakeup.set()
+    return job_id
+
+
+def get_job(c, job_id):
+    c.execute('''
+        SELECT id, job_type, user_id, status, priority, attempts, max_attempts, progress,
+               message, result, error, created_at, updated_at
+        FROM jobs WHERE id = ?
+    ''', (job_id,))
+    row = c.fetchone()
+    if row is None:
+        return None
+    job = dict(zip([column[0] for column in c.description], row))
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+def result_path(job_id):
+    return os.path.join(RESULT_DIR, '%s.json' % job_id)
+
+
+class Job:
+    def __init__(self, row, worker_id):
+        self.id, self.job_type, self.user_id, payload, self.attempts = row
+        self.payload = json.loads(payload or '{}')
+        self.worker_id = worker_id
+
+    def progress(self, fraction, message=None):
+        # Separate connection so progress is visible while the handler's
+        # own transaction is still open
+        conn = db.connect(_database, timeout=30)
+        try:
+            conn.execute('''
+                UPDATE jobs SET progress = ?, message = COALESCE(?, message),
+                                locked_at = ?, updated_at = ?
+                WHERE id = ? AND locked_by = ?
+            ''', (min(max(fraction, 0.0), 1.0), message, time.time(), utc_timestamp(),
+                  self.id, self.worker_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def renew_lease(self):
+        conn = db.connect(_database, timeout=30)
+        try:
+            conn.execute('''
+                UPDATE jobs SET locked_at = ?
+                WHERE id = ? AND locked_by = ? AND status = 'running'
+            ''', (time.time(), self.id, self.worker_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+
+class Heartbeat:
+    # Keeps a job's lease alive from a helper thread while its handler runs
+    def __init__(self, job):
+        self.job = job
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='job-heartbeat', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(HEARTBEAT):
+            try:
+                self.job.renew_lease()
+            except Exception:
+                logger.exception('Failed to renew the lease of job %s', self.job.id)
+
+
+def _claim(conn, worker_id):
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Jobs whose worker stopped renewing the lease
+        conn.execute('''
+            UPDATE jobs
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                error = 'Worker lost while running the job', locked_by = NULL, updated_at = ?
+            WHERE status = 'running' AND locked_at < ?
+        ''', (utc_timestamp(), now - LEASE))
+        row = conn.execute('''
+            SELECT id, job_type, user_id, payload, attempts FROM jobs
+            WHERE status = 'queued' AND run_after <= ?
+            ORDER BY priority DESC, run_after
+            LIMIT 1
+        ''', (now,)).fetchone()
+        if row is not None:
+            conn.execute('''
+                UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?,
+                                locked_at = ?, updated_at = ?
+                WHERE id = ?
+            ''', (worker_id, now, utc_timestamp(), row[0]))
+            row = row[:4] + (row[4] + 1,)
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return Job(row, worker_id) if row is not None else None
+
+
+def _finish(conn, job, result=None, error=None):
+    # Only while this worker still holds the job; a reclaimed job belongs to
+    # whichever worker claimed it next
+    now = utc_timestamp()
+    if error is None:
+        updated = conn.execute('''
+            UPDATE jobs SET status = 'succeeded', progress = 1, result = ?, error = NULL,
+                            locked_by = NULL, updated_at = ?
+            WHERE id = ? AND locked_by = ?
+        ''', (json.dumps(result) if result is not None else None, now, job.id, job.worker_id))
+    else:
+        updated = conn.execute('''
+            UPDATE jobs
+            SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                run_after = ?, error = ?, locked_by = NULL, updated_at = ?
+            WHERE id = ? AND locked_by = ?
+        ''', (time.time() + BACKOFF * 2 ** (job.attempts - 1), error, now, job.id, job.worker_id))
+    if updated.rowcount == 0:
+        logger.warning('Job %s was taken over by another worker; dropping attempt %d',
+                       job.id, job.attempts)
+
+
+def _prune(conn):
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - RETENTION))
+    expired = [row[0] for row in conn.execute('''
+        SELECT id FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at < ?
+    ''', (cutoff,))]
+    for job_id in expired:
+        try:
+            os.remove(result_path(job_id))
+        except OSError:
+            pass
+        conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+
+
+def _run_periodic(conn):
+    # One worker at a time; the others go on claiming jobs
+    if not _periodic_lock.acquire(blocking=False):
+        return
+    try:
+        for task in PERIODIC:
+            fn, interval, last_run = task
+            now = time.time()
+            if now - last_run < interval:
+                continue
+            task[2] = now
+            try:
+                fn(conn)
+            except Exception:
+                logger.exception('Periodic task %s failed', fn.__name__)
+    finally:
+        _periodic_lock.release()
+
+
+def run_one(worker_id):
+    # Claims and runs at most one job; returns False when the queue is empty
+    conn = db.connect(_database, isolation_level=None, timeout=30)
+    try:
+        _prune(conn)
+        _run_periodic(conn)
+        job = _claim(conn, worker_id)
+        if job is None:
+            return False
+
+        work = db.connect(_database, timeout=30)
+        work.row_factory = sqlite3.Row
+        heartbeat = Heartbeat(job)
+        heartbeat.start()
+        try:
+            result = HANDLERS[job.job_type](job, work)
+            work.commit()
+        except Exception as e:
+            work.rollback()
+            logger.exception('Job %s (%s) failed on attempt %d', job.id, job.job_type, job.attempts)
+            _finish(conn, job, error=str(e) or e.__class__.__name__)
+        else:
+            _finish(conn, job, result=result)
+        finally:
+            heartbeat.stop()
+            work.close()
+        return True
+    finally:
+        conn.close()
+
+
+def _worker_loop(worker_id):
+    while True:
+        try:
+            if run_one(worker_id):
+                continue
+        except Exception:
+            logger.exception('Job worker %s crashed while claiming', worker_id)
+        _wakeup.wait(POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start(database):
+    global _database, _started
+    _database = database
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    if _started:
+        return
+    _started = True
+    for i in range(WORKERS):
+        worker_id = '%d-%d' % (os.getpid(), i)
+        threading.Thread(target=_worker_loop, args=(worker_id,), name='job-worker-%d' % i,
+                         daemon=True).start()
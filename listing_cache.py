@@ -0,0 +1,214 @@
+"""Read-through cache for vault and item listings.
+
+get_vaults and get_passwords store their encoded JSON bodies under keys that
+carry the user's cache version:
+
+    agies:list:<user_id>:<version>:vaults
+    agies:list:<user_id>:<version>:vault:<vault_id as hex>
+
+The version lives in users.cache_version and every endpoint that changes a
+user's vaults or items bumps it inside its own transaction (bump()).  Readers
+look the version up by primary key first, so a commit is visible to the next
+read in every worker, and entries for old versions are never read again and
+simply age out of the LRU.
+
+Backends (AGIES_CACHE_BACKEND):
+
+    local  per-process LRU bounded by AGIES_CACHE_MAX_ENTRIES and
+           AGIES_CACHE_MAX_BYTES (default)
+    redis  any Redis-protocol server at AGIES_CACHE_URL shared by all workers,
+           entries expire after AGIES_CACHE_TTL; needs the redis package,
+           without it the local backend is used and a warning logged
+    off    no caching
+
+Cache failures never fail a request; a broken backend behaves as a miss.
+Hits, misses, stores and evictions are exported through /metrics.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+import metrics
+from migrations import add_column
+
+BACKEND = os.environ.get('AGIES_CACHE_BACKEND', 'local')
+CACHE_URL = os.environ.get('AGIES_CACHE_URL', 'redis://localhost:6379/0')
+MAX_ENTRIES = int(os.environ.get('AGIES_CACHE_MAX_ENTRIES', 10000))
+MAX_BYTES = int(os.environ.get('AGIES_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+TTL = int(os.environ.get('AGIES_CACHE_TTL', 300))
+
+# Rough per-entry bookkeeping cost on top of key and body
+ENTRY_OVERHEAD = 120
+
+logger = logging.getLogger('agies.cache')
+
+
+def _event(name, amount=1):
+    metrics.inc('agies_cache_events_total', amount, event=name)
+
+
+class LocalBackend:
+    name = 'local'
+    blocking = False
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        return body
+
+    def put(self, key, body):
+        size = len(key) + len(body) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return 0
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(key) + len(old) + ENTRY_OVERHEAD
+            self.entries[key] = body
+            self.bytes += size
+            while self.bytes > self.max_bytes or len(self.entries) > self.max_entries:
+                old_key, old_body = self.entries.popitem(last=False)
+                self.bytes -= len(old_key) + len(old_body) + ENTRY_OVERHEAD
+                evicted += 1
+            self.evictions += evicted
+        return evicted
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class RedisBackend:
+    # LRU and the memory budget are the server's (maxmemory-policy allkeys-lru)
+    name = 'redis'
+    blocking = True
+
+    def __init__(self, url=CACHE_URL, ttl=TTL, client=None):
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+        self.client = client
+        self.ttl = ttl
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        try:
+            body = self.client.get(key)
+        except Exception:
+            logger.warning('cache get failed', exc_info=True)
+            body = None
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def put(self, key, body):
+        try:
+            self.client.set(key, body, ex=self.ttl)
+        except Exception:
+            logger.warning('cache put failed', exc_info=True)
+        return 0
+
+    def clear(self):
+        for key in self.client.scan_iter('agies:list:*'):
+            self.client.delete(key)
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses, 'ttl': self.ttl}
+        try:
+            info = self.client.info()
+            stats.update(evictions=info.get('evicted_keys'), bytes=info.get('used_memory'),
+                         max_bytes=info.get('maxmemory'), policy=info.get('maxmemory_policy'))
+        except Exception:
+            stats['error'] = 'server unavailable'
+        return stats
+
+
+def make_backend(name=BACKEND):
+    if name == 'off':
+        return None
+    if name == 'redis':
+        try:
+            return RedisBackend()
+        except ImportError:
+            # Optional dependency, see requirements.txt
+            logger.warning('AGIES_CACHE_BACKEND=redis needs the redis package; using the local cache')
+    return LocalBackend()
+
+
+backend = make_backend()
+
+
+def init_cache_schema(c):
+    add_column(c, 'users', 'cache_version', 'INTEGER DEFAULT 0')
+
+
+def bump(c, *user_ids):
+    # Call inside the transaction that changes the users' listings
+    for user_id in user_ids:
+        c.execute('UPDATE users SET cache_version = cache_version + 1 WHERE id = ?', (user_id,))
+
+
+def bump_all(c):
+    c.execute('UPDATE users SET cache_version = cache_version + 1')
+
+
+def user_version(c, user_id):
+    c.execute('SELECT cache_version FROM users WHERE id = ?', (user_id,))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def key(user_id, version, name):
+    return 'agies:list:%s:%d:%s' % (user_id, version, name)
+
+
+def get(user_id, version, name):
+    # Returns the cached body or None; unknown users are never cached
+    if backend is None or version is None:
+        return None
+    body = backend.get(key(user_id, version, name))
+    _event('hit' if body is not None else 'miss')
+    return body
+
+
+def put(user_id, version, name, body):
+    if backend is None or version is None:
+        return
+    evicted = backend.put(key(user_id, version, name), body)
+    _event('store')
+    if evicted:
+        _event('eviction', evicted)
+
+
+def stats():
+    if backend is None:
+        return {'backend': 'off'}
+    result = backend.stats()
+    result['backend'] = backend.name
+    lookups = result['hits'] + result['misses']
+    result['hit_ratio'] = round(float(result['hits']) / lookups, 4) if lookups else None
+    return result
@@ -0,0 +1,259 @@
+"""Request instrumentation exported in the Prometheus text format.
+
+Every Flask request records its endpoint, method and status together with
+latency, time spent in SQLite, rows fetched, bcrypt time and response size.
+Each worker process keeps its own registry and writes a snapshot to
+AGIES_METRICS_DIR every AGIES_METRICS_FLUSH seconds; /metrics merges the
+snapshots of all workers so a scrape sees the whole gunicorn process group.
+Snapshots of workers that have exited are folded into archive.json so their
+counters keep counting after a restart.
+"""
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+import db
+
+METRICS_DIR = os.environ.get('AGIES_METRICS_DIR') or os.path.join(
+    tempfile.gettempdir(), 'agies-metrics-%d' % os.getppid())
+FLUSH_INTERVAL = float(os.environ.get('AGIES_METRICS_FLUSH', 5))
+# When set, /metrics requires "Authorization: Bearer <token>"
+TOKEN = os.environ.get('AGIES_METRICS_TOKEN', '')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BCRYPT_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 1.0, 2.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+COUNTERS = {
+    'agies_http_requests_total': 'HTTP requests by endpoint, method and status.',
+    'agies_db_queries_total': 'SQL statements executed, by endpoint.',
+    'agies_cache_events_total': 'Listing cache hits, misses, stores and evictions.',
+    'agies_audit_events_total': 'Security events written to or dropped by the audit log.',
+    'agies_change_stream_events_total': 'Change streams opened and closed, events pushed and resyncs sent.',
+}
+HISTOGRAMS = {
+    'agies_http_request_duration_seconds': ('Request latency.', LATENCY_BUCKETS),
+    'agies_db_time_seconds': ('Time spent in SQLite per request.', LATENCY_BUCKETS),
+    'agies_bcrypt_seconds': ('Time spent in bcrypt per call.', BCRYPT_BUCKETS),
+    'agies_rows_returned': ('Rows fetched from SQLite per request.', ROW_BUCKETS),
+    'agies_response_bytes': ('Response body size as sent.', BYTE_BUCKETS),
+}
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+                    for key in sorted(labels))
+
+
+class Registry:
+    # counters: name -> labels -> value
+    # histograms: name -> labels -> [bucket counts..., sum, count]
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict((name, {}) for name in COUNTERS)
+        self.histograms = dict((name, {}) for name in HISTOGRAMS)
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            series = self.counters[name]
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        with self.lock:
+            series = self.histograms[name]
+            state = series.get(labels)
+            if state is None:
+                state = series[labels] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict((name, dict(series)) for name, series in self.counters.items()),
+                'histograms': dict((name, dict((k, list(v)) for k, v in series.items()))
+                                   for name, series in self.histograms.items()),
+            }
+
+
+def merge(target, snapshot):
+    for name, series in snapshot.get('counters', {}).items():
+        merged = target['counters'].setdefault(name, {})
+        for labels, value in series.items():
+            merged[labels] = merged.get(labels, 0) + value
+    for name, series in snapshot.get('histograms', {}).items():
+        merged = target['histograms'].setdefault(name, {})
+        for labels, state in series.items():
+            if labels in merged:
+                merged[labels] = [a + b for a, b in zip(merged[labels], state)]
+            else:
+                merged[labels] = list(state)
+    return target
+
+
+def render(snapshot):
+    lines = []
+    for name, help_text in COUNTERS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for labels, value in sorted(snapshot['counters'].get(name, {}).items()):
+            lines.append('%s{%s} %s' % (name, labels, value))
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s histogram' % name)
+        for labels, state in sorted(snapshot['histograms'].get(name, {}).items()):
+            prefix = labels + ',' if labels else ''
+            for bound, count in zip(buckets, state):
+                lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, float(bound), count))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (name, prefix, state[-1]))
+            lines.append('%s_sum{%s} %s' % (name, labels, state[-2]))
+            lines.append('%s_count{%s} %d' % (name, labels, state[-1]))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def inc(name, amount=1, **labels):
+    registry.inc(name, _labels(**labels), amount)
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, 'worker-%d.json' % pid)
+
+
+def _write_json(path, data):
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def flush():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _write_json(_snapshot_path(os.getpid()), registry.snapshot())
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def collect():
+    # Merges this worker, every other live worker and the archive of
+    # exited workers; the lock keeps two scrapes from archiving twice
+    flush()
+    merged = {'counters': {}, 'histograms': {}}
+    with open(os.path.join(METRICS_DIR, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(METRICS_DIR, 'archive.json')
+        archive = {'counters': {}, 'histograms': {}}
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                archive = json.load(f)
+        archived = False
+
+        for name in os.listdir(METRICS_DIR):
+            if not (name.startswith('worker-') and name.endswith('.json')):
+                continue
+            path = os.path.join(METRICS_DIR, name)
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if _pid_alive(int(name[len('worker-'):-len('.json')])):
+                merge(merged, snapshot)
+            else:
+                merge(archive, snapshot)
+                os.remove(path)
+                archived = True
+
+        if archived:
+            _write_json(archive_path, archive)
+        merge(merged, archive)
+    return merged
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+@contextmanager
+def time_bcrypt(operation):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        registry.observe('agies_bcrypt_seconds', _labels(operation=operation), elapsed)
+        stats = db.current_stats()
+        if stats is not None:
+            stats.bcrypt_time += elapsed
+
+
+def record_request(endpoint, method, status, elapsed, stats=None, response_bytes=None):
+    registry.inc('agies_http_requests_total', _labels(endpoint=endpoint, method=method, status=status))
+    registry.observe('agies_http_request_duration_seconds', _labels(endpoint=endpoint, method=method), elapsed)
+    labels = _labels(endpoint=endpoint)
+    if stats is not None:
+        registry.inc('agies_db_queries_total', labels, stats.db_queries)
+        registry.observe('agies_db_time_seconds', labels, stats.db_time)
+        registry.observe('agies_rows_returned', labels, stats.rows)
+    if response_bytes is not None:
+        registry.observe('agies_response_bytes', labels, response_bytes)
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_stats, g.metrics_token = db.begin_request()
+
+
+def _after_request(response):
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        record_request(request.endpoint or 'unmatched', request.method, response.status_code,
+                       time.perf_counter() - start, g.metrics_stats, response.content_length)
+    return response
+
+
+def _teardown_request(exc=None):
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        db.end_request(token)
+
+
+_started = False
+
+
+def init_app(app):
+    # Register before other after_request hooks (e.g. compression): Flask
+    # runs them in reverse, so this one sees the final response size
+    global _started
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if not _started:
+        _started = True
+        threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
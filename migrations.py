@@ -0,0 +1,23 @@
+"""Small helpers for evolving the SQLite schema in place.
+
+init_db() only runs CREATE TABLE IF NOT EXISTS, so columns added after a
+database was first created have to be patched in explicitly.
+"""
+
+
+def table_exists(c, table):
+    c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    return c.fetchone() is not None
+
+
+def column_names(c, table):
+    c.execute('PRAGMA table_info(%s)' % table)
+    return [row[1] for row in c.fetchall()]
+
+
+def add_column(c, table, column, decl):
+    # Returns True when the column was missing and has been added
+    if column in column_names(c, table):
+        return False
+    c.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, decl))
+    return True
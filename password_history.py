@@ -0,0 +1,102 @@
+"""Capped, delta-encoded revision history for password items.
+
+The passwords row always holds the current version; earlier versions live in
+a separate table so the hot row stays the same size however often an item
+changes:
+
+    password_history (password_id, revision) -> changed_at, changed_by, delta
+
+Each revision stores a reverse delta: only the fields the update changed,
+with the values they had before it.  Walking the revisions newest first from
+the current row rebuilds every earlier version, so the oldest revisions can
+be dropped without touching the rest.  Deltas are JSON, zlib-compressed when
+that makes them smaller (the first byte says which).  At most
+AGIES_HISTORY_MAX_REVISIONS revisions are kept per item; record() trims the
+oldest in the same transaction as the update.  History is read only by the
+history endpoint and goes away with its item.
+"""
+import json
+import os
+import zlib
+
+MAX_REVISIONS = int(os.environ.get('AGIES_HISTORY_MAX_REVISIONS', 20))
+
+# Fields whose earlier values are kept
+FIELDS = ('title', 'username', 'password', 'url', 'notes', 'category', 'tags')
+
+_RAW = b'j'
+_ZLIB = b'z'
+
+
+def init_history_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS password_history (
+            password_id BLOB NOT NULL,
+            revision INTEGER NOT NULL,
+            changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            changed_by TEXT,
+            delta BLOB NOT NULL,
+            PRIMARY KEY (password_id, revision)
+        )
+    ''')
+
+
+def encode_delta(delta):
+    raw = json.dumps(delta, separators=(',', ':')).encode('utf-8')
+    packed = zlib.compress(raw, 9)
+    if len(packed) < len(raw):
+        return _ZLIB + packed
+    return _RAW + raw
+
+
+def decode_delta(blob):
+    blob = bytes(blob)
+    if blob[:1] == _ZLIB:
+        return json.loads(zlib.decompress(blob[1:]))
+    return json.loads(blob[1:])
+
+
+def record(c, password_id, changed_by, old, new):
+    # old and new map FIELDS to values (tags as stored, i.e. JSON text);
+    # returns the new revision number, or None when nothing changed
+    delta = dict((field, old[field]) for field in FIELDS if old[field] != new[field])
+    if not delta:
+        return None
+    c.execute('SELECT MAX(revision) FROM password_history WHERE password_id = ?', (password_id,))
+    revision = (c.fetchone()[0] or 0) + 1
+    c.execute('''
+        INSERT INTO password_history (password_id, revision, changed_by, delta)
+        VALUES (?, ?, ?, ?)
+    ''', (password_id, revision, changed_by, encode_delta(delta)))
+    c.execute('DELETE FROM password_history WHERE password_id = ? AND revision <= ?',
+              (password_id, revision - MAX_REVISIONS))
+    return revision
+
+
+def revisions(c, password_id, current, limit=None):
+    # Earlier versions newest first, each rebuilt from current (a mapping
+    # of FIELDS) by applying the deltas in order
+    c.execute('''
+        SELECT revision, changed_at, changed_by, delta FROM password_history
+        WHERE password_id = ? ORDER BY revision DESC LIMIT ?
+    ''', (password_id, -1 if limit is None else limit))
+    state = dict((field, current[field]) for field in FIELDS)
+    result = []
+    for revision, changed_at, changed_by, blob in c.fetchall():
+        delta = decode_delta(blob)
+        state.update(delta)
+        version = dict(state)
+        version['tags'] = json.loads(version['tags']) if version['tags'] else []
+        version.update({
+            "revision": revision,
+            "replaced_at": changed_at,
+            "replaced_by": changed_by,
+            "changed_fields": sorted(delta)
+        })
+        result.append(version)
+    return result
+
+
+def items_removed(c, password_ids):
+    c.executemany('DELETE FROM password_history WHERE password_id = ?',
+                  [(password_id,) for password_id in password_ids])
@@ -0,0 +1,194 @@
+"""Opt-in per-request profiling.
+
+Nothing is installed unless AGIES_PROFILING is on; with it off the app runs
+without any extra hooks.  When on, a request is profiled if
+
+  * it carries X-Agies-Profile (cprofile, sample and/or memory, comma
+    separated) together with a valid admin key, or
+  * it is picked at random with probability AGIES_PROFILE_SAMPLE_RATE,
+    optionally only for the users listed in AGIES_PROFILE_USERS, using the
+    modes in AGIES_PROFILE_MODES.
+
+Results are written to AGIES_PROFILE_DIR:
+
+  <id>.pstats      cProfile output, open with pstats or snakeviz
+  <id>.collapsed   stack samples in collapsed format for flamegraph.pl/speedscope
+  <id>.tracemalloc snapshot loadable with tracemalloc.Snapshot.load()
+  <id>.alloc.txt   top allocation sites during the request
+
+The id is returned to the caller in the X-Agies-Profile-Id header.  At most
+one request per process is profiled at a time; concurrent candidates are
+served normally.  Under asgi.py, native routes make the same decision with
+select_modes() and hand only the requests that were picked to the Flask app,
+passing the modes in the WSGI environ (ENVIRON_KEY) so Flask does not roll
+the sample dice a second time.
+"""
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+from flask import g, request
+
+ENABLED = os.environ.get('AGIES_PROFILING', '').lower() in ('1', 'true', 'on', 'yes')
+PROFILE_DIR = os.environ.get('AGIES_PROFILE_DIR', 'profiles')
+SAMPLE_RATE = float(os.environ.get('AGIES_PROFILE_SAMPLE_RATE', 0))
+SAMPLE_MODES = os.environ.get('AGIES_PROFILE_MODES', 'cprofile')
+SAMPLE_USERS = frozenset(u for u in os.environ.get('AGIES_PROFILE_USERS', '').split(',') if u)
+SAMPLE_INTERVAL = float(os.environ.get('AGIES_PROFILE_INTERVAL', 0.005))
+TOP_ALLOCATIONS = 50
+
+MODES = ('cprofile', 'sample', 'memory')
+
+# WSGI environ key holding modes chosen before the request reached Flask
+ENVIRON_KEY = 'agies.profile_modes'
+
+_busy = threading.Lock()
+
+
+class StackSampler:
+    # Samples one thread's stack from a helper thread every interval
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(self.stacks.items()))
+
+
+class Session:
+    def __init__(self, modes):
+        self.id = '%s-%d-%s' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid(), uuid.uuid4().hex[:8])
+        self.modes = modes
+        self.profiler = None
+        self.sampler = None
+        self.started_tracemalloc = False
+        self.baseline = None
+
+    def start(self):
+        if 'memory' in self.modes:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+                self.started_tracemalloc = True
+            self.baseline = tracemalloc.take_snapshot()
+        if 'sample' in self.modes:
+            self.sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+            self.sampler.start()
+        if 'cprofile' in self.modes:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.sampler is not None:
+            self.sampler.stop()
+        snapshot = None
+        if self.baseline is not None:
+            snapshot = tracemalloc.take_snapshot()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+        return snapshot
+
+    def write(self, snapshot, description):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.id)
+        if self.profiler is not None:
+            self.profiler.dump_stats(base + '.pstats')
+        if self.sampler is not None:
+            with open(base + '.collapsed', 'w') as f:
+                f.write(self.sampler.collapsed())
+        if snapshot is not None:
+            snapshot.dump(base + '.tracemalloc')
+            with open(base + '.alloc.txt', 'w') as f:
+                f.write('# %s\n' % description)
+                for stat in snapshot.compare_to(self.baseline, 'traceback')[:TOP_ALLOCATIONS]:
+                    f.write('%s\n' % stat)
+                    for line in stat.traceback.format(limit=8):
+                        f.write('    %s\n' % line)
+
+
+def parse_modes(value):
+    modes = tuple(m for m in (part.strip().lower() for part in value.split(',')) if m in MODES)
+    return modes
+
+
+def select_modes(header, user_id, authorized):
+    # Modes to profile a request with, () for none; authorized says whether
+    # the X-Agies-Profile header came with a valid admin key
+    if not ENABLED:
+        return ()
+    if header and authorized:
+        return parse_modes(header)
+    if SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+        if not SAMPLE_USERS or user_id in SAMPLE_USERS:
+            return parse_modes(SAMPLE_MODES)
+    return ()
+
+
+def _requested_modes(authorize):
+    if ENVIRON_KEY in request.environ:
+        return request.environ[ENVIRON_KEY]
+    header = request.headers.get('X-Agies-Profile')
+    return select_modes(header, request.headers.get('X-User-ID'), bool(header) and authorize())
+
+
+def init_app(app, authorize):
+    # authorize() decides whether the X-Agies-Profile header may be honoured
+    if not ENABLED:
+        return
+
+    def start_profile():
+        modes = _requested_modes(authorize)
+        if not modes or not _busy.acquire(blocking=False):
+            return
+        session = Session(modes)
+        g.profile_session = session
+        session.start()
+
+    def tag_response(response):
+        session = g.get('profile_session')
+        if session is not None:
+            response.headers['X-Agies-Profile-Id'] = session.id
+        return response
+
+    def finish_profile(exc=None):
+        session = g.pop('profile_session', None)
+        if session is None:
+            return
+        try:
+            snapshot = session.stop()
+            session.write(snapshot, '%s %s' % (request.method, request.path))
+        finally:
+            _busy.release()
+
+    app.before_request(start_profile)
+    app.after_request(tag_response)
+    app.teardown_request(finish_profile)
@@ -0,0 +1,92 @@
+"""JSON encoding for API responses.
+
+orjson is used when it is installed and the stdlib encoder otherwise; both
+produce compact output with sorted keys, like Flask's default provider.
+Query results are encoded straight from cursor rows: column names are sorted
+once per query and each row becomes a dict built by zip() in C, instead of
+going through sqlite3.Row -> dict(row) -> sort_keys for every row.  Binary
+vault and password ids (bytes) are written as UUID strings (see ids.py).
+"""
+import json
+import operator
+
+from flask.json.provider import DefaultJSONProvider
+
+import ids
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment
+    orjson = None
+
+
+def default(obj):
+    if isinstance(obj, bytes):
+        return ids.to_str(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+if orjson is not None:
+    _ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=_ORJSON_OPTIONS)
+
+    def _dumps_presorted(obj):
+        # Keys are already in sorted order; skip orjson's own sort
+        return orjson.dumps(obj, default=default)
+else:
+    _encoder = json.JSONEncoder(ensure_ascii=True, sort_keys=True, separators=(',', ':'),
+                                default=default)
+    _presorted_encoder = json.JSONEncoder(ensure_ascii=True, separators=(',', ':'), default=default)
+    loads = json.loads
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode('utf-8')
+
+    def _dumps_presorted(obj):
+        return _presorted_encoder.encode(obj).encode('utf-8')
+
+
+def encode_rows(description, rows, json_columns=()):
+    # description is cursor.description; rows may be tuples or sqlite3.Row.
+    # json_columns hold JSON text and are embedded as values, not strings
+    columns = [column[0] for column in description]
+    order = sorted(range(len(columns)), key=columns.__getitem__)
+    keys = [columns[i] for i in order]
+    if len(order) == 1:
+        pick = lambda row: (row[order[0]],)
+    else:
+        pick = operator.itemgetter(*order)
+    items = [dict(zip(keys, pick(row))) for row in rows]
+    for name in json_columns:
+        for item in items:
+            if item[name] is not None:
+                item[name] = loads(item[name])
+    return _dumps_presorted(items)
+
+
+class JSONProvider(DefaultJSONProvider):
+    # Installed as app.json so every jsonify() call goes through dumps()
+    default = staticmethod(default)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b'\n', mimetype=self.mimetype)
+
+
+def body_response(app, body, status=200):
+    # body is JSON produced by dumps() or encode_rows()
+    return app.response_class(body + b'\n', status=status, mimetype='application/json')
+
+
+def rows_response(app, cursor, status=200):
+    # Encodes everything left on an executed cursor as a JSON array
+    return body_response(app, encode_rows(cursor.description, cursor.fetchall()), status)
@@ -0,0 +1,204 @@
+"""Vault sharing and the materialized per-user permission index.
+
+vault_shares records what an owner (or a member allowed to re-share) granted
+to another user.  vault_acl holds the effective permissions of every user on
+every vault they can see, owners included:
+
+    vault_acl (user_id, vault_id) -> owner_id, is_owner, can_write,
+                                      can_delete, can_share
+
+A row means the user can read the vault.  A share on a vault also covers
+every vault nested below it (vault_tree.py); where several shares reach the
+same vault the user gets the union of their flags.
+
+"All vaults I can see" is a range scan of the primary key and authorizing a
+request is one primary key lookup; the vault_id index answers "who can see
+this vault" for cache invalidation.  The index is updated in the same
+transaction as the change that affects it: vault_added() when a vault is
+created, grant() and revoke() for shares, refresh() after a subtree moves,
+vault_removed() when a vault goes away.  Only the rows of the affected
+subtree (and user) are recomputed.  rebuild_acl() recomputes everything
+from vaults and vault_shares and runs with the reconcile_health job.
+
+Revoking a member's share does not revoke the shares that member granted;
+the owner can see and remove those separately.
+"""
+from migrations import table_exists
+
+PERMISSIONS = ('can_write', 'can_delete', 'can_share')
+
+
+def init_sharing_schema(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS vault_shares (
+            vault_id BLOB NOT NULL,
+            user_id TEXT NOT NULL,
+            granted_by TEXT NOT NULL,
+            can_write INTEGER DEFAULT 0,
+            can_delete INTEGER DEFAULT 0,
+            can_share INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (vault_id, user_id)
+        )
+    ''')
+
+    # Databases created before sharing existed get owner rows for every vault
+    backfill = not table_exists(c, 'vault_acl')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS vault_acl (
+            user_id TEXT NOT NULL,
+            vault_id BLOB NOT NULL,
+            owner_id TEXT NOT NULL,
+            is_owner INTEGER DEFAULT 0,
+            can_write INTEGER DEFAULT 0,
+            can_delete INTEGER DEFAULT 0,
+            can_share INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, vault_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_vault_acl_vault ON vault_acl (vault_id)')
+    if backfill:
+        rebuild_acl(c)
+
+
+def add_owner(c, user_id, vault_id):
+    c.execute('''
+        INSERT OR REPLACE INTO vault_acl (user_id, vault_id, owner_id, is_owner,
+                                          can_write, can_delete, can_share)
+        VALUES (?, ?, ?, 1, 1, 1, 1)
+    ''', (user_id, vault_id, user_id))
+
+
+def vault_added(c, owner_id, vault_id):
+    # Call after vault_tree.add_vault(); picks up shares on the new vault's ancestors
+    add_owner(c, owner_id, vault_id)
+    refresh(c, vault_id)
+
+
+def refresh(c, root_id, user_id=None):
+    # Recomputes the shared (non-owner) rows for the subtree under root_id,
+    # for one user or for everyone
+    acl_filter = share_filter = ''
+    params = [root_id]
+    if user_id is not None:
+        acl_filter, share_filter = 'AND user_id = ?', 'AND s.user_id = ?'
+        params.append(user_id)
+    c.execute('''
+        DELETE FROM vault_acl
+        WHERE is_owner = 0
+          AND vault_id IN (SELECT descendant_id FROM vault_tree WHERE ancestor_id = ?)
+          %s
+    ''' % acl_filter, params)
+    c.execute('''
+        INSERT INTO vault_acl (user_id, vault_id, owner_id, is_owner, can_write, can_delete, can_share)
+        SELECT s.user_id, t.descendant_id, v.user_id, 0,
+               MAX(s.can_write), MAX(s.can_delete), MAX(s.can_share)
+        FROM vault_tree sub
+        JOIN vault_tree t ON t.descendant_id = sub.descendant_id
+        JOIN vault_shares s ON s.vault_id = t.ancestor_id
+        JOIN vaults v ON v.id = t.descendant_id
+        WHERE sub.ancestor_id = ? AND s.user_id != v.user_id %s
+        GROUP BY s.user_id, t.descendant_id
+    ''' % share_filter, params)
+
+
+def access(c, user_id, vault_id):
+    # The caller's effective permissions on the vault, or None
+    c.execute('''
+        SELECT owner_id, is_owner, can_write, can_delete, can_share
+        FROM vault_acl WHERE user_id = ? AND vault_id = ?
+    ''', (user_id, vault_id))
+    row = c.fetchone()
+    if row is None:
+        return None
+    return dict(zip(('owner_id', 'is_owner') + PERMISSIONS, row))
+
+
+def members(c, vault_id):
+    # Everyone who can see the vault, owner included
+    c.execute('SELECT user_id FROM vault_acl WHERE vault_id = ?', (vault_id,))
+    return [row[0] for row in c.fetchall()]
+
+
+def subtree_members(c, root_id):
+    # Everyone who can see any vault under root_id
+    c.execute('''
+        SELECT DISTINCT a.user_id FROM vault_tree t
+        JOIN vault_acl a ON a.vault_id = t.descendant_id
+        WHERE t.ancestor_id = ?
+    ''', (root_id,))
+    return [row[0] for row in c.fetchall()]
+
+
+def grant(c, vault_id, user_id, granted_by, permissions):
+    # Creates or replaces the share; returns True when it is new
+    flags = [1 if permissions.get(name) else 0 for name in PERMISSIONS]
+    c.execute('SELECT 1 FROM vault_shares WHERE vault_id = ? AND user_id = ?', (vault_id, user_id))
+    created = c.fetchone() is None
+    if created:
+        c.execute('''
+            INSERT INTO vault_shares (vault_id, user_id, granted_by, can_write, can_delete, can_share)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [vault_id, user_id, granted_by] + flags)
+    else:
+        c.execute('''
+            UPDATE vault_shares
+            SET granted_by = ?, can_write = ?, can_delete = ?, can_share = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE vault_id = ? AND user_id = ?
+        ''', [granted_by] + flags + [vault_id, user_id])
+    refresh(c, vault_id, user_id)
+    return created
+
+
+def granted_by(c, vault_id, user_id):
+    # Who granted the user's share, or None when the vault is not shared with them
+    c.execute('SELECT granted_by FROM vault_shares WHERE vault_id = ? AND user_id = ?',
+              (vault_id, user_id))
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def revoke(c, vault_id, user_id):
+    # Shares the user holds on vaults above or below this one still apply
+    c.execute('DELETE FROM vault_shares WHERE vault_id = ? AND user_id = ?', (vault_id, user_id))
+    refresh(c, vault_id, user_id)
+
+
+def list_shares(c, vault_id):
+    c.execute('''
+        SELECT s.user_id, u.email, s.granted_by, s.can_write, s.can_delete, s.can_share,
+               s.created_at, s.updated_at
+        FROM vault_shares s
+        LEFT JOIN users u ON u.id = s.user_id
+        WHERE s.vault_id = ?
+        ORDER BY s.created_at
+    ''', (vault_id,))
+    return [dict(zip([column[0] for column in c.description], row)) for row in c.fetchall()]
+
+
+def vault_removed(c, vault_id):
+    # Returns the users who could see the vault so their caches can be bumped
+    users = members(c, vault_id)
+    c.execute('DELETE FROM vault_shares WHERE vault_id = ?', (vault_id,))
+    c.execute('DELETE FROM vault_acl WHERE vault_id = ?', (vault_id,))
+    return users
+
+
+def rebuild_acl(c):
+    c.execute('DELETE FROM vault_acl')
+    c.execute('''
+        INSERT INTO vault_acl (user_id, vault_id, owner_id, is_owner, can_write, can_delete, can_share)
+        SELECT user_id, id, user_id, 1, 1, 1, 1 FROM vaults
+    ''')
+    c.execute('''
+        INSERT OR IGNORE INTO vault_acl (user_id, vault_id, owner_id, is_owner,
+                                         can_write, can_delete, can_share)
+        SELECT s.user_id, t.descendant_id, v.user_id, 0,
+               MAX(s.can_write), MAX(s.can_delete), MAX(s.can_share)
+        FROM vault_shares s
+        JOIN vault_tree t ON t.ancestor_id = s.vault_id
+        JOIN vaults v ON v.id = t.descendant_id
+        GROUP BY s.user_id, t.descendant_id
+    ''')
@@ -0,0 +1,189 @@
+"""Slow-query log for statements run through get_db().
+
+Statements that take at least AGIES_SLOW_QUERY_MS milliseconds (execute plus
+fetching the results) are appended as JSON lines to AGIES_SLOW_QUERY_LOG
+together with the endpoint that ran them, the number of rows returned and
+their EXPLAIN QUERY PLAN.  Parameters never reach the log: each one is
+replaced by its type and length.  The plan of each distinct statement is
+captured once per process.
+
+The log is shared by all workers.  Summarize it with
+
+    python slowlog.py [--top N] [logfile]
+
+or GET /api/admin/slow-queries with the admin key.
+"""
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import db
+
+THRESHOLD_MS = float(os.environ.get('AGIES_SLOW_QUERY_MS', 100))
+LOG_PATH = os.environ.get('AGIES_SLOW_QUERY_LOG', 'agies.slow.log')
+MAX_LOG_BYTES = int(os.environ.get('AGIES_SLOW_QUERY_LOG_MAX', 16 * 1024 * 1024))
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+logger = logging.getLogger('agies.slowlog')
+
+_plans = {}
+_lock = threading.Lock()
+
+
+def normalize(sql):
+    return ' '.join(sql.split())
+
+
+def redact(params):
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return dict((key, redact_value(value)) for key, value in params.items())
+    return [redact_value(value) for value in params]
+
+
+def redact_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return '<%s>' % type(value).__name__
+    return '<%s:%d>' % (type(value).__name__, len(value))
+
+
+def explain(connection, sql, params):
+    # Runs on a plain cursor so the EXPLAIN itself is not instrumented
+    if not sql.lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    cursor = sqlite3.Connection.cursor(connection)
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ())
+        return [row[3] for row in cursor.fetchall()]
+    except sqlite3.Error:
+        return None
+    finally:
+        cursor.close()
+
+
+def _endpoint(connection):
+    # Native ASGI routes run their statements on a pooled connection's own
+    # thread, outside any Flask request; they bind their stats to it instead
+    stats = getattr(connection, 'request_stats', None)
+    if stats is not None:
+        return stats.endpoint
+    try:
+        from flask import has_request_context, request
+    except ImportError:  # pragma: no cover - used outside the app
+        return None
+    return request.endpoint if has_request_context() else None
+
+
+def _append(entry):
+    line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+    with _lock:
+        try:
+            if os.path.getsize(LOG_PATH) > MAX_LOG_BYTES:
+                os.replace(LOG_PATH, LOG_PATH + '.1')
+        except OSError:
+            pass
+        # One O_APPEND write per entry keeps lines from different workers whole
+        fd = os.open(LOG_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+def on_statement(sql, params, elapsed, rows, connection):
+    if elapsed * 1000 < THRESHOLD_MS:
+        return
+    query = normalize(sql)
+    plan = _plans.get(query)
+    if plan is None:
+        plan = _plans[query] = explain(connection, sql, params) or []
+
+    entry = {
+        'ts': time.time(),
+        'ms': round(elapsed * 1000, 3),
+        'sql': query,
+        'params': redact(params),
+        'rows': rows,
+        'endpoint': _endpoint(connection),
+        'plan': plan,
+        'full_scans': [step for step in plan if step.startswith('SCAN')],
+    }
+    logger.warning('slow query (%.1f ms, %d rows): %s', entry['ms'], rows, query)
+    try:
+        _append(entry)
+    except OSError:
+        logger.exception('could not write slow-query log')
+
+
+def summarize(path=None, top=20):
+    # Groups log entries by statement, ordered by total time spent
+    stats = {}
+    for name in (path or LOG_PATH) + '.1', path or LOG_PATH:
+        try:
+            f = open(name)
+        except OSError:
+            continue
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                item = stats.get(entry['sql'])
+                if item is None:
+                    item = stats[entry['sql']] = {
+                        'sql': entry['sql'], 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                        'rows': 0, 'endpoints': [], 'plan': entry.get('plan', []),
+                        'full_scans': entry.get('full_scans', []), 'last_seen': 0,
+                    }
+                item['count'] += 1
+                item['total_ms'] += entry['ms']
+                item['max_ms'] = max(item['max_ms'], entry['ms'])
+                item['rows'] += entry.get('rows', 0)
+                item['last_seen'] = max(item['last_seen'], entry['ts'])
+                if entry.get('endpoint') and entry['endpoint'] not in item['endpoints']:
+                    item['endpoints'].append(entry['endpoint'])
+
+    offenders = sorted(stats.values(), key=lambda item: item['total_ms'], reverse=True)[:top]
+    for item in offenders:
+        item['total_ms'] = round(item['total_ms'], 3)
+        item['avg_ms'] = round(item['total_ms'] / item['count'], 3)
+    return offenders
+
+
+def install():
+    if on_statement not in db.statement_hooks:
+        db.statement_hooks.append(on_statement)
+
+
+def main(argv):
+    top = 20
+    path = None
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '--top':
+            top = int(args.pop(0))
+        else:
+            path = arg
+
+    for item in summarize(path, top):
+        print('%10.1f ms total  %6d calls  %8.1f ms avg  %8.1f ms max  %s' % (
+            item['total_ms'], item['count'], item['avg_ms'], item['max_ms'],
+            ', '.join(item['endpoints']) or '-'))
+        print('    ' + item['sql'])
+        for step in item['plan']:
+            print('      ' + step)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,175 @@
+"""Static asset serving from an in-memory index of public/.
+
+public/ is scanned once at startup.  Every file gets a content hash that is
+used as its ETag and to build a fingerprinted alias (js/app.js ->
+js/app.3f2a9c1d.js).  Fingerprinted URLs never change content, so they are
+served with a one-year immutable Cache-Control; plain URLs must revalidate and
+are answered with 304 when the ETag matches.
+
+Files up to AGIES_STATIC_MAX_FILE bytes are held in memory together with
+gzip (and brotli, if available) variants compressed once at startup, within
+a total budget of AGIES_STATIC_MEMORY_BUDGET bytes.  Serving them is a dict
+lookup with no filesystem access; larger files fall back to send_file.
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import threading
+from email.utils import formatdate
+
+from flask import request, send_file
+
+import compression
+
+PUBLIC_DIR = os.environ.get('AGIES_PUBLIC_DIR',
+                            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public'))
+MAX_FILE = int(os.environ.get('AGIES_STATIC_MAX_FILE', 256 * 1024))
+MEMORY_BUDGET = int(os.environ.get('AGIES_STATIC_MEMORY_BUDGET', 32 * 1024 * 1024))
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'public, max-age=0, must-revalidate'
+
+
+class Asset:
+    __slots__ = ('path', 'filename', 'mimetype', 'etag', 'fingerprinted', 'size',
+                 'last_modified', 'variants')
+
+    def __init__(self, path, filename, data):
+        self.path = path
+        self.filename = filename
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        if self.mimetype.startswith('text/') or self.mimetype == 'application/javascript':
+            self.mimetype += '; charset=utf-8'
+        digest = hashlib.sha256(data).hexdigest()
+        self.etag = digest[:16]
+        root, ext = posixpath.splitext(path)
+        self.fingerprinted = '%s.%s%s' % (root, digest[:8], ext)
+        self.size = len(data)
+        self.last_modified = formatdate(os.stat(filename).st_mtime, usegmt=True)
+        # encoding -> body; empty when the file is served from disk
+        self.variants = {}
+
+
+class AssetIndex:
+    def __init__(self, root):
+        self.root = root
+        self.assets = {}
+        self.aliases = {}
+        self.memory_used = 0
+        self.lock = threading.Lock()
+
+    def scan(self):
+        assets, aliases, used = {}, {}, 0
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for name in filenames:
+                if name.startswith('.'):
+                    continue
+                filename = os.path.join(dirpath, name)
+                path = os.path.relpath(filename, self.root).replace(os.sep, '/')
+                with open(filename, 'rb') as f:
+                    data = f.read()
+                asset = Asset(path, filename, data)
+                if asset.size <= MAX_FILE and used + asset.size <= MEMORY_BUDGET:
+                    used += self._load_variants(asset, data)
+                assets[path] = asset
+                aliases[asset.fingerprinted] = path
+
+        with self.lock:
+            self.assets, self.aliases, self.memory_used = assets, aliases, used
+
+    def _load_variants(self, asset, data):
+        asset.variants[None] = data
+        used = len(data)
+        if compression.is_compressible(asset.mimetype.split(';')[0]) and len(data) >= compression.MIN_SIZE:
+            for encoding in compression.supported_encodings():
+                compressed = compression.compress(data, encoding)
+                if len(compressed) < len(data):
+                    asset.variants[encoding] = compressed
+                    used += len(compressed)
+        return used
+
+    def lookup(self, path):
+        # Returns (asset, is_fingerprinted_url)
+        asset = self.assets.get(path)
+        if asset is not None:
+            return asset, False
+        logical = self.aliases.get(path)
+        if logical is not None:
+            return self.assets[logical], True
+        return None, False
+
+    def url_for(self, path):
+        asset = self.assets.get(path)
+        return '/' + (asset.fingerprinted if asset else path)
+
+    def manifest(self):
+        return dict((path, asset.fingerprinted) for path, asset in self.assets.items())
+
+
+index = AssetIndex(PUBLIC_DIR)
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate.strip('"').split('-')[0] == etag:
+            return True
+    return False
+
+
+def plan(asset, fingerprinted, method, if_none_match, accept_encoding):
+    # Framework-independent answer: (status, headers, body or None for disk)
+    cache_control = IMMUTABLE if fingerprinted else REVALIDATE
+    headers = [('Cache-Control', cache_control), ('Vary', 'Accept-Encoding'),
+               ('Last-Modified', asset.last_modified)]
+
+    encoding = None
+    if len(asset.variants) > 1:
+        encoding = compression.negotiate(accept_encoding)
+        if encoding not in asset.variants:
+            encoding = None
+    etag = asset.etag if encoding is None else '%s-%s' % (asset.etag, encoding)
+    headers.append(('ETag', '"%s"' % etag))
+
+    if _etag_matches(if_none_match, asset.etag):
+        return 304, headers, b''
+
+    if not asset.variants:
+        return 200, headers, None
+
+    body = asset.variants[encoding]
+    headers.append(('Content-Type', asset.mimetype))
+    headers.append(('Content-Length', str(len(body))))
+    if encoding:
+        headers.append(('Content-Encoding', encoding))
+    return 200, headers, b'' if method == 'HEAD' else body
+
+
+def serve(app, path):
+    asset, fingerprinted = index.lookup(path)
+    if asset is None:
+        return None
+
+    status, headers, body = plan(asset, fingerprinted, request.method,
+                                 request.headers.get('If-None-Match'),
+                                 request.headers.get('Accept-Encoding'))
+    if body is None:
+        # Too large for the in-memory cache; stream it from disk
+        response = send_file(asset.filename, mimetype=asset.mimetype, etag=asset.etag,
+                             max_age=31536000 if fingerprinted else 0, conditional=True)
+        response.headers['Cache-Control'] = IMMUTABLE if fingerprinted else REVALIDATE
+        return response
+
+    response = app.response_class(body, status=status)
+    response.headers.clear()
+    for name, value in headers:
+        response.headers[name] = value
+    return response
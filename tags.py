@@ -0,0 +1,215 @@
+"""Item tags and categories with an inverted index and facet counts.
+
+passwords.tags (a JSON array) and passwords.category are the source of
+truth.  Two tables derived from them are kept in step by the writer's
+transaction:
+
+    item_tags    (user_id, tag, password_id)            inverted index
+    facet_counts (user_id, facet, value) -> item_count  facet is 'tag' or 'category'
+
+The items carrying a tag are a range scan of item_tags' primary key.
+Filtering by several tags walks the rarest one and probes the others by
+primary key, so a filter costs about the size of its smallest tag rather
+than the number of items; tag and category counts are read straight from
+facet_counts.  Both tables are scoped to the item's owner, like
+fingerprints and health counters.  rebuild_tags() recomputes them and runs
+with the reconcile_health job.
+"""
+import json
+
+from migrations import add_column, table_exists
+
+MAX_TAGS = 20
+MAX_LENGTH = 40
+
+ITEM_COLUMNS = '''
+    p.id, p.vault_id, p.title, p.username, p.password, p.url, p.notes, p.category,
+    COALESCE(p.tags, '[]') as tags, p.strength_score, p.password_changed_at,
+    p.created_at, p.updated_at
+'''
+
+
+def init_tags_schema(c):
+    add_column(c, 'passwords', 'category', 'TEXT')
+    add_column(c, 'passwords', 'tags', 'TEXT')
+
+    backfill = not table_exists(c, 'item_tags')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS item_tags (
+            user_id TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            password_id BLOB NOT NULL,
+            PRIMARY KEY (user_id, tag, password_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS facet_counts (
+            user_id TEXT NOT NULL,
+            facet TEXT NOT NULL,
+            value TEXT NOT NULL,
+            item_count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, facet, value)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_passwords_user_category ON passwords (user_id, category)')
+    if backfill:
+        rebuild_tags(c)
+
+
+def normalize_tags(value):
+    # Lower-cased, whitespace-collapsed and de-duplicated; raises ValueError
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError('Tags must be a list of strings')
+    tags = []
+    for tag in value:
+        if not isinstance(tag, str):
+            raise ValueError('Tags must be a list of strings')
+        tag = ' '.join(tag.split()).lower()
+        if not tag or tag in tags:
+            continue
+        if len(tag) > MAX_LENGTH:
+            raise ValueError('Tags are limited to %d characters' % MAX_LENGTH)
+        tags.append(tag)
+    if len(tags) > MAX_TAGS:
+        raise ValueError('Items can have at most %d tags' % MAX_TAGS)
+    return tags
+
+
+def normalize_category(value):
+    # None and blank strings mean no category; raises ValueError
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise ValueError('Category must be a string')
+    value = ' '.join(value.split())
+    if len(value) > MAX_LENGTH:
+        raise ValueError('Categories are limited to %d characters' % MAX_LENGTH)
+    return value or None
+
+
+def encode(tags):
+    return json.dumps(tags) if tags else None
+
+
+def decode(text):
+    return json.loads(text) if text else []
+
+
+def _bump(c, user_id, facet, value, delta):
+    c.execute('INSERT OR IGNORE INTO facet_counts (user_id, facet, value) VALUES (?, ?, ?)',
+              (user_id, facet, value))
+    c.execute('''
+        UPDATE facet_counts SET item_count = item_count + ?
+        WHERE user_id = ? AND facet = ? AND value = ?
+    ''', (delta, user_id, facet, value))
+    if delta < 0:
+        c.execute('''
+            DELETE FROM facet_counts
+            WHERE user_id = ? AND facet = ? AND value = ? AND item_count <= 0
+        ''', (user_id, facet, value))
+
+
+def item_added(c, user_id, password_id, tags, category):
+    c.executemany('INSERT OR IGNORE INTO item_tags (user_id, tag, password_id) VALUES (?, ?, ?)',
+                  [(user_id, tag, password_id) for tag in tags])
+    for tag in tags:
+        _bump(c, user_id, 'tag', tag, 1)
+    if category:
+        _bump(c, user_id, 'category', category, 1)
+
+
+def item_updated(c, user_id, password_id, old_tags, old_category, tags, category):
+    removed = [tag for tag in old_tags if tag not in tags]
+    added = [tag for tag in tags if tag not in old_tags]
+    c.executemany('DELETE FROM item_tags WHERE user_id = ? AND tag = ? AND password_id = ?',
+                  [(user_id, tag, password_id) for tag in removed])
+    for tag in removed:
+        _bump(c, user_id, 'tag', tag, -1)
+    item_added(c, user_id, password_id, added, None)
+    if old_category != category:
+        if old_category:
+            _bump(c, user_id, 'category', old_category, -1)
+        if category:
+            _bump(c, user_id, 'category', category, 1)
+
+
+def items_removed(c, user_id, items):
+    # items are password rows (id, tags, category) fetched before the delete
+    counts = {}
+    index_rows = []
+    for item in items:
+        for tag in decode(item['tags']):
+            index_rows.append((user_id, tag, item['id']))
+            counts[('tag', tag)] = counts.get(('tag', tag), 0) + 1
+        if item['category']:
+            key = ('category', item['category'])
+            counts[key] = counts.get(key, 0) + 1
+    c.executemany('DELETE FROM item_tags WHERE user_id = ? AND tag = ? AND password_id = ?', index_rows)
+    for (facet, value), removed in counts.items():
+        _bump(c, user_id, facet, value, -removed)
+
+
+def facets(c, user_id):
+    c.execute('''
+        SELECT facet, value, item_count FROM facet_counts
+        WHERE user_id = ? ORDER BY item_count DESC, value
+    ''', (user_id,))
+    result = {"tags": [], "categories": []}
+    for facet, value, count in c.fetchall():
+        if facet == 'tag':
+            result['tags'].append({"tag": value, "count": count})
+        else:
+            result['categories'].append({"category": value, "count": count})
+    return result
+
+
+def filter_items(c, user_id, tags, category=None):
+    # Executes the query on c and returns False when nothing can match
+    if not tags:
+        c.execute('''
+            SELECT %s FROM passwords p
+            WHERE p.user_id = ? AND p.category = ?
+            ORDER BY p.created_at DESC
+        ''' % ITEM_COLUMNS, (user_id, category))
+        return True
+
+    placeholders = ', '.join('?' * len(tags))
+    c.execute('''
+        SELECT value, item_count FROM facet_counts
+        WHERE user_id = ? AND facet = 'tag' AND value IN (%s)
+    ''' % placeholders, [user_id] + tags)
+    counts = dict((row[0], row[1]) for row in c.fetchall())
+    if len(counts) < len(tags):
+        return False
+
+    # Walk the rarest tag, probe the rest
+    tags = sorted(tags, key=counts.get)
+    conditions = ['t.user_id = ?', 't.tag = ?']
+    params = [user_id, tags[0]]
+    for tag in tags[1:]:
+        conditions.append('EXISTS (SELECT 1 FROM item_tags o WHERE o.user_id = t.user_id '
+                          'AND o.tag = ? AND o.password_id = t.password_id)')
+        params.append(tag)
+    if category:
+        conditions.append('p.category = ?')
+        params.append(category)
+    c.execute('''
+        SELECT %s FROM item_tags t JOIN passwords p ON p.id = t.password_id
+        WHERE %s
+        ORDER BY p.created_at DESC
+    ''' % (ITEM_COLUMNS, ' AND '.join(conditions)), params)
+    return True
+
+
+def rebuild_tags(c):
+    c.execute('DELETE FROM item_tags')
+    c.execute('DELETE FROM facet_counts')
+    c.execute('''
+        SELECT p.id, v.user_id, p.tags, p.category
+        FROM passwords p JOIN vaults v ON p.vault_id = v.id
+        WHERE p.tags IS NOT NULL OR p.category IS NOT NULL
+    ''')
+    for password_id, user_id, tags, category in c.fetchall():
+        item_added(c, user_id, password_id, decode(tags), category)
@@ -0,0 +1,38 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+# Test modules import app modules at collection and those resolve their
+# paths at import, so the scratch directory is set up before anything else;
+# registered first, its removal runs after the app's own exit hooks
+WORKDIR = tempfile.mkdtemp(prefix='agies-tests-')
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.environ.setdefault('AGIES_METRICS_DIR', os.path.join(WORKDIR, 'metrics'))
+os.environ.setdefault('AGIES_AUDIT_DIR', os.path.join(WORKDIR, 'audit'))
+os.environ.setdefault('AGIES_FINGERPRINT_KEY_FILE', os.path.join(WORKDIR, 'agies.fingerprint.key'))
+
+
+@pytest.fixture(scope='session')
+def client():
+    # app.py opens agies.db relative to the working directory at import time
+    os.chdir(WORKDIR)
+    import app
+    return app.app.test_client()
+
+
+@pytest.fixture
+def register(client):
+    def register():
+        email = 'user-%s@example.com' % uuid.uuid4().hex
+        data = client.post('/api/auth/register', json={'email': email, 'password': 'pw-123456!'}).get_json()
+        return data['user_id'], data['default_vault_id']
+    return register
@@ -0,0 +1,121 @@
+import asyncio
+
+import pytest
+
+import profiling
+
+
+@pytest.fixture
+def asgi(client):
+    import asgi
+    return asgi
+
+
+def serve(asgi, requests):
+    # Runs (method, path, headers, body) requests through the ASGI app on
+    # one event loop and returns the messages sent for each
+    async def call(method, path, headers, body):
+        if body:
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': b'',
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers.items()],
+            'client': ('127.0.0.1', 5000), 'server': ('testserver', 80),
+        }
+        received = []
+
+        async def receive():
+            # The client hangs up once the request has been read
+            if received:
+                return {'type': 'http.disconnect'}
+            received.append(True)
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi.application(scope, receive, send)
+        return sent
+
+    async def run():
+        try:
+            return [await call(*request) for request in requests]
+        finally:
+            await asgi._db.close()
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def handed_to_flask(asgi, monkeypatch):
+    calls = []
+    call_wsgi = asgi._call_wsgi
+
+    async def recording_call_wsgi(scope, body, send, extra_environ=None):
+        calls.append((scope['path'], extra_environ))
+        return await call_wsgi(scope, body, send, extra_environ)
+
+    monkeypatch.setattr(asgi, '_call_wsgi', recording_call_wsgi)
+    monkeypatch.setattr(profiling, 'ENABLED', True)
+    monkeypatch.setenv('AGIES_ADMIN_KEY', 'admin-secret')
+    return calls
+
+
+def test_unauthorized_profile_header_stays_native(asgi, register, handed_to_flask):
+    user_id, _ = register()
+    for admin_key in (None, 'wrong'):
+        headers = {'X-User-ID': user_id, 'X-Agies-Profile': 'cprofile'}
+        if admin_key:
+            headers['X-Admin-Key'] = admin_key
+        [sent] = serve(asgi, [('GET', '/api/vaults', headers, b'')])
+        assert sent[0]['status'] == 200
+    assert handed_to_flask == []
+
+
+def test_authorized_profile_request_goes_to_flask_with_its_modes(asgi, register, handed_to_flask):
+    user_id, _ = register()
+    headers = {'X-User-ID': user_id, 'X-Agies-Profile': 'cprofile', 'X-Admin-Key': 'admin-secret'}
+    [sent] = serve(asgi, [('GET', '/api/vaults', headers, b'')])
+    assert sent[0]['status'] == 200
+    assert handed_to_flask == [('/api/vaults', {profiling.ENVIRON_KEY: ('cprofile',)})]
+
+
+def test_change_stream_is_never_handed_over(asgi, register, handed_to_flask):
+    user_id, _ = register()
+    headers = {'X-User-ID': user_id, 'X-Agies-Profile': 'cprofile', 'X-Admin-Key': 'admin-secret'}
+    [sent] = serve(asgi, [('GET', '/api/changes/stream', headers, b'')])
+    assert (b'content-type', b'text/event-stream') in sent[0]['headers']
+    assert handed_to_flask == []
+
+
+def test_unpicked_samples_stay_native(asgi, register, handed_to_flask, monkeypatch):
+    user_id, _ = register()
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 0.5)
+    monkeypatch.setattr(profiling.random, 'random', lambda: 0.9)
+    serve(asgi, [('GET', '/api/vaults', {'X-User-ID': user_id}, b'')])
+    assert handed_to_flask == []
+
+
+def test_flask_uses_the_modes_chosen_by_asgi(client, monkeypatch):
+    monkeypatch.setattr(profiling, 'ENABLED', True)
+    monkeypatch.setattr(profiling, 'SAMPLE_RATE', 1.0)
+    app = client.application
+    with app.test_request_context('/api/vaults', environ_overrides={profiling.ENVIRON_KEY: ()}):
+        assert profiling._requested_modes(lambda: True) == ()
+    with app.test_request_context('/api/vaults'):
+        assert profiling._requested_modes(lambda: True) == ('cprofile',)
+
+
+def test_proxied_json_route_is_sent_as_one_body(asgi, register):
+    user_id, vault_id = register()
+    path = '/api/vaults/%s/passwords' % vault_id
+    item = b'{"title": "Mail", "username": "me", "password": "pw-1234567!"}'
+    [sent] = serve(asgi, [('POST', path, {'X-User-ID': user_id, 'Content-Type': 'application/json'}, item)])
+
+    assert sent[0]['type'] == 'http.response.start' and sent[0]['status'] == 201
+    bodies = [message for message in sent if message['type'] == 'http.response.body']
+    assert len(bodies) == 1 and not bodies[0].get('more_body')
+    assert b'"id"' in bodies[0]['body']
@@ -0,0 +1,38 @@
+import queue
+import sqlite3
+import uuid
+
+import pytest
+
+import audit
+
+
+@pytest.fixture
+def events(client, monkeypatch):
+    # A queue of our own, so the app's writer thread does not race flush()
+    monkeypatch.setattr(audit, '_events', queue.Queue())
+    return audit._events
+
+
+def test_flush_after_chdir_writes_to_the_audit_dir(events, tmp_path, monkeypatch):
+    user_id = str(uuid.uuid4())
+    audit.record('auth.login', user_id, 200)
+    monkeypatch.chdir(tmp_path)
+
+    audit.flush()
+
+    assert [event['user_id'] for event in audit.query(user_id=user_id)] == [user_id]
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_flush_logs_write_errors_instead_of_raising(events, monkeypatch, caplog):
+    def fail(connections, batch):
+        raise sqlite3.OperationalError('unable to open database file')
+
+    monkeypatch.setattr(audit, '_write', fail)
+    audit.record('auth.login', 'someone', 200)
+
+    audit.flush()
+
+    assert events.empty()
+    assert 'Failed to write 1 audit events' in caplog.text
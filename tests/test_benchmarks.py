@@ -0,0 +1,31 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_run_end_to_end_leaves_nothing_behind(tmp_path):
+    cwd = tmp_path / 'cwd'
+    scratch = tmp_path / 'tmp'
+    cwd.mkdir()
+    scratch.mkdir()
+    env = dict(os.environ, TMPDIR=str(scratch))
+    for name in ('AGIES_METRICS_DIR', 'AGIES_AUDIT_DIR', 'AGIES_FINGERPRINT_KEY_FILE'):
+        env.pop(name, None)
+
+    process = subprocess.run(
+        [sys.executable, os.path.join(REPO, 'benchmarks', 'run.py'), '--sizes', '1,100',
+         '--requests', '40', '--warmup', '5', '--output', 'results.json'],
+        cwd=str(cwd), env=env, capture_output=True, text=True, timeout=300)
+
+    assert process.returncode == 0, process.stderr
+    assert 'Traceback' not in process.stderr
+    with open(str(cwd / 'results.json')) as f:
+        results = json.load(f)
+    assert sorted(results['scenarios']) == ['1', '100']
+    for scenario in results['scenarios'].values():
+        assert all(op['errors'] == 0 for op in scenario['ops'].values())
+    assert os.listdir(str(cwd)) == ['results.json']
+    assert os.listdir(str(scratch)) == []
@@ -0,0 +1,49 @@
+import sqlite3
+import time
+
+import pytest
+
+import changes
+import jobs
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    changes.init_changes_schema(conn.cursor())
+    yield conn
+    conn.close()
+
+
+def add_events(conn, count, age):
+    created_at = time.time() - age
+    conn.executemany('INSERT INTO change_events (user_id, event, created_at) VALUES (?, ?, ?)',
+                     [('user', changes.ITEM_UPDATED, created_at)] * count)
+
+
+def test_prune_removes_expired_events_in_batches(conn, monkeypatch):
+    monkeypatch.setattr(changes, 'PRUNE_BATCH', 100)
+    add_events(conn, 250, changes.RETENTION + 60)
+    add_events(conn, 3, 0)
+    statements = []
+    conn.set_trace_callback(statements.append)
+
+    assert changes.prune(conn) == 250
+    assert conn.execute('SELECT COUNT(*) FROM change_events').fetchone()[0] == 3
+    assert len([sql for sql in statements if sql.startswith('DELETE')]) == 3
+
+
+def test_publish_leaves_expired_events_to_prune(conn):
+    add_events(conn, 5, changes.RETENTION + 60)
+    changes.publish(conn.cursor(), ['user'], changes.ITEM_CREATED)
+    assert conn.execute('SELECT COUNT(*) FROM change_events').fetchone()[0] == 6
+
+
+def test_job_workers_run_periodic_tasks_once_per_interval(conn, monkeypatch):
+    calls = []
+    monkeypatch.setattr(jobs, 'PERIODIC', [])
+    jobs.periodic(3600)(calls.append)
+
+    jobs._run_periodic(conn)
+    jobs._run_periodic(conn)
+    assert calls == [conn]
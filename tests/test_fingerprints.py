@@ -0,0 +1,36 @@
+import os
+import sqlite3
+
+import pytest
+
+import fingerprints
+
+
+@pytest.fixture
+def key_dir(tmp_path, monkeypatch):
+    monkeypatch.delenv('AGIES_FINGERPRINT_KEY', raising=False)
+    monkeypatch.setenv('AGIES_FINGERPRINT_KEY_FILE', 'test.key')
+    for name in ('_key', '_key_mtime', '_key_path'):
+        monkeypatch.setattr(fingerprints, name, None)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_key_file_stays_put_after_chdir(key_dir, tmp_path_factory, monkeypatch):
+    key = fingerprints.get_key()
+    monkeypatch.chdir(tmp_path_factory.mktemp('elsewhere'))
+    monkeypatch.setattr(fingerprints, '_key', None)
+
+    assert fingerprints.key_file() == str(key_dir / 'test.key')
+    assert fingerprints.get_key() == key
+    assert not os.path.exists('test.key')
+
+
+def test_missing_key_with_stored_fingerprints_refuses_to_start(key_dir):
+    c = sqlite3.connect(':memory:').cursor()
+    c.execute('CREATE TABLE passwords (id TEXT, vault_id TEXT, password TEXT, fingerprint TEXT)')
+    c.execute("INSERT INTO passwords VALUES ('item', 'vault', 'secret', 'abc')")
+
+    with pytest.raises(RuntimeError):
+        fingerprints.init_fingerprint_schema(c)
+    assert not (key_dir / 'test.key').exists()
@@ -0,0 +1,44 @@
+import pytest
+
+import generator
+
+
+@pytest.mark.parametrize('overrides', [
+    {'separator': 5},
+    {'wordlist': ['common']},
+    {'wordlist': 7},
+    {'capitalize': 'yes'},
+    {'words': [5]},
+    {'words': True},
+])
+def test_bad_passphrase_overrides_are_rejected(overrides):
+    with pytest.raises(ValueError):
+        generator.generate('passphrase', 1, overrides)
+
+
+@pytest.mark.parametrize('overrides', [
+    {'length': 'long'},
+    {'length': 20.5},
+    {'classes': 'lower'},
+    {'classes': [1, 2]},
+    {'exclude': ['a']},
+])
+def test_bad_password_overrides_are_rejected(overrides):
+    with pytest.raises(ValueError):
+        generator.generate('default', 1, overrides)
+
+
+def test_valid_overrides_still_apply():
+    passwords, _, policy = generator.generate('default', 3, {'length': '12', 'classes': ['digits']})
+    assert policy['length'] == 12
+    assert all(len(password) == 12 and password.isdigit() for password in passwords)
+
+
+def test_api_answers_bad_overrides_with_400(client, register):
+    user_id, _ = register()
+    headers = {'X-User-ID': user_id}
+    for body in ({'policy': 'passphrase', 'separator': 5}, {'policy': 'passphrase', 'wordlist': {}},
+                 {'policy': ['default']}, [1, 2]):
+        response = client.post('/api/generator', json=body, headers=headers)
+        assert response.status_code == 400, body
+        assert 'error' in response.get_json()
@@ -0,0 +1,57 @@
+import sqlite3
+
+import ids
+
+
+def decoy(user_id):
+    conn = sqlite3.connect('agies.db')
+    try:
+        vault_id = conn.execute('SELECT id FROM vaults WHERE user_id = ? AND is_decoy = 1',
+                                (user_id,)).fetchone()[0]
+        item_id = conn.execute('SELECT id FROM passwords WHERE vault_id = ? LIMIT 1',
+                               (vault_id,)).fetchone()[0]
+    finally:
+        conn.close()
+    return ids.to_str(vault_id), ids.to_str(item_id)
+
+
+def test_decoys_are_not_listed(client, register):
+    user_id, default_vault_id = register()
+    decoy_vault_id, _ = decoy(user_id)
+    listed = [vault['id'] for vault in client.get('/api/vaults', headers={'X-User-ID': user_id}).get_json()]
+    assert listed == [default_vault_id]
+    assert decoy_vault_id not in listed
+
+
+def test_other_users_get_a_plain_miss(client, register):
+    owner_id, _ = register()
+    other_id, _ = register()
+    _, item_id = decoy(owner_id)
+    headers = {'X-User-ID': other_id}
+    body = {'title': 't', 'username': 'u', 'password': 'p'}
+    unknown = ids.to_str(ids.new_id())
+
+    for method, path, kwargs in (
+            ('put', '/api/passwords/%s', {'json': body}),
+            ('delete', '/api/passwords/%s', {}),
+            ('get', '/api/passwords/%s/history', {})):
+        decoy_response = getattr(client, method)(path % item_id, headers=headers, **kwargs)
+        miss = getattr(client, method)(path % unknown, headers=headers, **kwargs)
+        assert decoy_response.status_code == miss.status_code == 404
+        assert decoy_response.get_json() == miss.get_json()
+
+
+def test_owner_changes_leave_decoys_alone(client, register):
+    owner_id, _ = register()
+    decoy_vault_id, item_id = decoy(owner_id)
+    headers = {'X-User-ID': owner_id}
+    before = client.get('/api/vaults/%s/passwords' % decoy_vault_id, headers=headers).get_json()
+
+    response = client.put('/api/passwords/%s' % item_id, headers=headers,
+                          json={'title': 'changed', 'username': 'u', 'password': 'p'})
+    assert response.status_code == 200
+    assert set(response.get_json()) == {'message', 'category', 'tags', 'strength_score', 'reused_in'}
+    assert client.delete('/api/passwords/%s' % item_id, headers=headers).status_code == 200
+
+    after = client.get('/api/vaults/%s/passwords' % decoy_vault_id, headers=headers).get_json()
+    assert after == before
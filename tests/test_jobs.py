@@ -0,0 +1,54 @@
+import time
+import uuid
+
+import pytest
+
+import db
+import jobs
+
+
+@pytest.fixture
+def conn(client):
+    conn = db.connect(jobs._database, isolation_level=None, timeout=30)
+    yield conn
+    conn.close()
+
+
+def running_job(conn, worker_id, locked_at=None):
+    job_id = str(uuid.uuid4())
+    conn.execute('''
+        INSERT INTO jobs (id, job_type, status, attempts, run_after, locked_by, locked_at)
+        VALUES (?, 'test', 'running', 1, 0, ?, ?)
+    ''', (job_id, worker_id, locked_at or time.time()))
+    return jobs.Job((job_id, 'test', None, '{}', 1), worker_id)
+
+
+def job_row(conn, job):
+    return conn.execute('SELECT status, locked_by, result FROM jobs WHERE id = ?', (job.id,)).fetchone()
+
+
+def test_heartbeat_keeps_a_silent_job_leased(conn, monkeypatch):
+    monkeypatch.setattr(jobs, 'LEASE', 1)
+    monkeypatch.setattr(jobs, 'HEARTBEAT', 0.2)
+    job = running_job(conn, 'worker-a')
+    heartbeat = jobs.Heartbeat(job)
+    heartbeat.start()
+    try:
+        time.sleep(2)
+        jobs._claim(conn, 'worker-b')
+    finally:
+        heartbeat.stop()
+    assert job_row(conn, job)[:2] == ('running', 'worker-a')
+
+
+def test_finish_leaves_a_reclaimed_job_alone(conn):
+    job = running_job(conn, 'worker-b')
+    stale = jobs.Job((job.id, 'test', None, '{}', 1), 'worker-a')
+
+    jobs._finish(conn, stale, result={"done": True})
+    assert job_row(conn, job) == ('running', 'worker-b', None)
+    jobs._finish(conn, stale, error='boom')
+    assert job_row(conn, job) == ('running', 'worker-b', None)
+
+    jobs._finish(conn, job, result={"done": True})
+    assert job_row(conn, job) == ('succeeded', None, '{"done": true}')
@@ -0,0 +1,41 @@
+import random
+
+from benchmarks import replay
+
+VAULT = '01a15247-6ed7-72b7-812d-0722cd26b9df'
+ITEM = '01a15247-6ed8-7001-9a3c-5b7e1f20c4d2'
+
+
+def make_world():
+    world = replay.World(client=None)
+    world.users['u1'] = {'id': 'real-user', 'email': 'u1@replay.local', 'default_vault': VAULT}
+    world.vaults['v1'] = VAULT
+    world.items['p1'] = ITEM
+    return world
+
+
+def test_id_route_is_substituted():
+    record = {'e': 'update_password', 'm': 'PUT', 's': 200, 'u': 'u1',
+              'r': '/api/vaults/<id:vault_id>/passwords/<id:password_id>',
+              'a': {'vault_id': 'v1', 'password_id': 'p1'}, 'b': {'title': 5}}
+    method, path, body, headers = replay.build_request(make_world(), record, random.Random(1))
+    assert method == 'PUT'
+    assert path == '/api/vaults/%s/passwords/%s' % (VAULT, ITEM)
+    assert headers == {'X-User-ID': 'real-user'}
+    assert len(body['title']) == 5
+
+
+def test_plain_and_string_routes_are_substituted():
+    world = make_world()
+    for rule in ('/api/vaults/<vault_id>', '/api/vaults/<string:vault_id>'):
+        record = {'e': 'get_vault', 'm': 'GET', 's': 200, 'u': 'u1', 'r': rule,
+                  'a': {'vault_id': 'v1'}}
+        assert replay.build_request(world, record, random.Random(1))[1] == '/api/vaults/' + VAULT
+
+
+def test_similar_keys_are_not_confused():
+    record = {'e': 'x', 'm': 'GET', 's': 200, 'u': 'u1',
+              'r': '/api/<id:vault_id>/<id:parent_vault_id>',
+              'a': {'vault_id': 'v1', 'parent_vault_id': 'unknown'}}
+    path = replay.build_request(make_world(), record, random.Random(1))[1]
+    assert path == '/api/%s/unknown' % VAULT
@@ -0,0 +1,56 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import vault_health
+
+
+@pytest.fixture
+def cursor():
+    conn = sqlite3.connect(':memory:')
+    c = conn.cursor()
+    c.execute('CREATE TABLE vaults (id TEXT PRIMARY KEY, user_id TEXT)')
+    c.execute('''
+        CREATE TABLE passwords (
+            id TEXT PRIMARY KEY, vault_id TEXT, user_id TEXT, password TEXT, fingerprint TEXT,
+            is_honeytoken INTEGER DEFAULT 0, created_at TIMESTAMP, updated_at TIMESTAMP
+        )
+    ''')
+    vault_health.init_health_schema(c)
+    yield c
+    conn.close()
+
+
+def days_ago(days):
+    moment = datetime.now(timezone.utc) - timedelta(days=days)
+    return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def test_old_count_follows_the_cutoff_day(cursor):
+    limit = vault_health.OLD_PASSWORD_DAYS
+    vault_health.item_added(cursor, 'user', 'vault', 'fp-old', 90, days_ago(limit + 1))
+    vault_health.item_added(cursor, 'user', 'vault', 'fp-new', 90, days_ago(limit - 1))
+
+    for scope, scope_id in (('user', 'user'), ('vault', 'vault')):
+        report = vault_health.health_report(cursor, scope, scope_id)
+        assert report['total_items'] == 2
+        assert report['old'] == 1
+
+
+def test_month_buckets_are_rebuilt_as_days(cursor):
+    cursor.execute("INSERT INTO vaults VALUES ('vault', 'user')")
+    cursor.execute('''
+        INSERT INTO passwords (id, vault_id, user_id, password, fingerprint, created_at)
+        VALUES ('item', 'vault', 'user', 'correct horse', 'fp', ?)
+    ''', (days_ago(vault_health.OLD_PASSWORD_DAYS + 1),))
+    cursor.execute('''
+        INSERT INTO health_age_buckets (scope, scope_id, bucket, item_count)
+        VALUES ('user', 'user', '2020-01', 1)
+    ''')
+
+    vault_health.init_health_schema(cursor)
+
+    cursor.execute('SELECT bucket FROM health_age_buckets')
+    assert all(len(row[0]) == 10 for row in cursor.fetchall())
+    assert vault_health.health_report(cursor, 'user', 'user')['old'] == 1
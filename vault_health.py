@@ -0,0 +1,273 @@
+"""Password strength scoring and incrementally maintained vault health counters.
+
+Every write path (add, update, delete, vault delete) reports its change here so
+that the per-vault and per-user counters stay current.  Reading a health report
+is then a primary-key lookup instead of a rescan of every stored password.
+
+Counters live in two tables keyed by (scope, scope_id) where scope is 'vault'
+or 'user':
+
+* health_counters    - item, weak and reused counts plus a strength total
+* health_age_buckets - item counts per day of the last secret change, so
+                       "old" items can be counted without touching passwords
+"""
+import math
+import os
+import string
+from datetime import datetime, timedelta, timezone
+
+from fingerprints import reuse_snapshot
+from migrations import add_column, table_exists
+
+WEAK_SCORE = int(os.environ.get('AGIES_WEAK_SCORE', 50))
+OLD_PASSWORD_DAYS = int(os.environ.get('AGIES_OLD_PASSWORD_DAYS', 180))
+
+# Bits of entropy that map to a perfect score
+_FULL_SCORE_BITS = 80.0
+
+_COMMON_PASSWORDS = frozenset([
+    '123456', '123456789', '12345678', '12345', '1234567', '1234567890',
+    'password', 'password1', 'password123', 'passw0rd', 'qwerty', 'qwerty123',
+    'qwertyuiop', 'abc123', '111111', '000000', '123123', '654321', '666666',
+    '121212', 'iloveyou', 'admin', 'admin123', 'welcome', 'welcome1',
+    'letmein', 'monkey', 'dragon', 'football', 'baseball', 'sunshine',
+    'princess', 'master', 'shadow', 'superman', 'trustno1', 'login',
+    'starwars', 'whatever', 'zaq12wsx', '1q2w3e4r', '1qaz2wsx', 'asdfgh',
+    'asdfghjkl', 'changeme', 'secret', 'test', 'test123', 'guest', 'root',
+])
+
+
+def score_password(password):
+    # Entropy estimate on a 0-100 scale: character pool size times an
+    # effective length that discounts repeats and keyboard/alphabet runs
+    if not password:
+        return 0
+    if password.lower() in _COMMON_PASSWORDS:
+        return 0
+
+    pool = 0
+    if any(ch in string.ascii_lowercase for ch in password):
+        pool += 26
+    if any(ch in string.ascii_uppercase for ch in password):
+        pool += 26
+    if any(ch in string.digits for ch in password):
+        pool += 10
+    if any(ch in string.punctuation or ch == ' ' for ch in password):
+        pool += 33
+    if any(ord(ch) > 127 for ch in password):
+        pool += 100
+
+    effective_length = 1.0
+    for prev, ch in zip(password, password[1:]):
+        if ch == prev or abs(ord(ch) - ord(prev)) == 1:
+            effective_length += 0.5
+        else:
+            effective_length += 1.0
+
+    bits = effective_length * math.log2(max(pool, 2))
+    return int(min(100, round(bits * 100 / _FULL_SCORE_BITS)))
+
+
+def is_weak(score):
+    return score < WEAK_SCORE
+
+
+def utc_timestamp():
+    # Same textual format SQLite uses for CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _age_bucket(changed_at):
+    # YYYY-MM-DD, so the OLD_PASSWORD_DAYS cutoff is exact to the day
+    return (changed_at or utc_timestamp())[:10]
+
+
+def init_health_schema(c):
+    needs_rebuild = not table_exists(c, 'health_counters')
+
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS health_counters (
+            scope TEXT NOT NULL,
+            scope_id TEXT NOT NULL,
+            item_count INTEGER DEFAULT 0,
+            weak_count INTEGER DEFAULT 0,
+            reused_count INTEGER DEFAULT 0,
+            strength_total INTEGER DEFAULT 0,
+            PRIMARY KEY (scope, scope_id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS health_age_buckets (
+            scope TEXT NOT NULL,
+            scope_id TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            item_count INTEGER DEFAULT 0,
+            PRIMARY KEY (scope, scope_id, bucket)
+        )
+    ''')
+
+    add_column(c, 'passwords', 'strength_score', 'INTEGER')
+    add_column(c, 'passwords', 'password_changed_at', 'TIMESTAMP')
+
+    # Databases from before day buckets still hold YYYY-MM buckets
+    if not needs_rebuild:
+        c.execute('SELECT 1 FROM health_age_buckets WHERE length(bucket) = 7 LIMIT 1')
+        needs_rebuild = c.fetchone() is not None
+
+    if needs_rebuild:
+        rebuild_health(c)
+
+
+def _bump(c, scope, scope_id, items=0, weak=0, reused=0, strength=0):
+    c.execute('INSERT OR IGNORE INTO health_counters (scope, scope_id) VALUES (?, ?)',
+              (scope, scope_id))
+    c.execute('''
+        UPDATE health_counters
+        SET item_count = item_count + ?, weak_count = weak_count + ?,
+            reused_count = reused_count + ?, strength_total = strength_total + ?
+        WHERE scope = ? AND scope_id = ?
+    ''', (items, weak, reused, strength, scope, scope_id))
+
+
+def _bump_age(c, scope, scope_id, bucket, delta):
+    c.execute('INSERT OR IGNORE INTO health_age_buckets (scope, scope_id, bucket) VALUES (?, ?, ?)',
+              (scope, scope_id, bucket))
+    c.execute('''
+        UPDATE health_age_buckets SET item_count = item_count + ?
+        WHERE scope = ? AND scope_id = ? AND bucket = ?
+    ''', (delta, scope, scope_id, bucket))
+
+
+def _count_item(c, user_id, vault_id, strength, changed_at, sign, count_vault=True):
+    weak = sign if is_weak(strength) else 0
+    bucket = _age_bucket(changed_at)
+    scopes = [('user', user_id)]
+    if count_vault:
+        scopes.append(('vault', vault_id))
+    for scope, scope_id in scopes:
+        _bump(c, scope, scope_id, items=sign, weak=weak, strength=sign * strength)
+        _bump_age(c, scope, scope_id, bucket, sign)
+
+
+def _reused_per_vault(snapshot):
+    # A secret only counts as reused once two or more items hold it
+    if sum(snapshot.values()) < 2:
+        return {}
+    return snapshot
+
+
+def _apply_reuse(c, user_id, before, after, skip_vault=None):
+    # skip_vault is a vault whose counter rows are about to be dropped
+    before = _reused_per_vault(before)
+    after = _reused_per_vault(after)
+    total = 0
+    for vault_id in set(before) | set(after):
+        delta = after.get(vault_id, 0) - before.get(vault_id, 0)
+        if delta and vault_id != skip_vault:
+            _bump(c, 'vault', vault_id, reused=delta)
+        total += delta
+    if total:
+        _bump(c, 'user', user_id, reused=total)
+
+
+def item_added(c, user_id, vault_id, fingerprint, strength, changed_at):
+    # Call after the INSERT so the new row is part of the reuse snapshot
+    _count_item(c, user_id, vault_id, strength, changed_at, 1)
+    after = reuse_snapshot(c, user_id, fingerprint)
+    before = dict(after)
+    before[vault_id] = before.get(vault_id, 0) - 1
+    _apply_reuse(c, user_id, before, after)
+
+
+def item_removed(c, user_id, vault_id, fingerprint, strength, changed_at):
+    # Call after the DELETE (or after the secret was overwritten)
+    _count_item(c, user_id, vault_id, strength or 0, changed_at, -1)
+    after = reuse_snapshot(c, user_id, fingerprint)
+    before = dict(after)
+    before[vault_id] = before.get(vault_id, 0) + 1
+    _apply_reuse(c, user_id, before, after)
+
+
+def item_updated(c, user_id, vault_id, old, fingerprint, strength, changed_at):
+    # old is the row as it was before the UPDATE; a no-op when the secret
+    # did not change because score, age and reuse all stay the same
+    if old['fingerprint'] == fingerprint:
+        return
+    item_removed(c, user_id, vault_id, old['fingerprint'], old['strength_score'],
+                 old['password_changed_at'])
+    item_added(c, user_id, vault_id, fingerprint, strength, changed_at)
+
+
+def vault_removed(c, user_id, vault_id, items):
+    # items are the vault's password rows fetched before they were deleted
+    secrets = {}
+    for item in items:
+        _count_item(c, user_id, vault_id, item['strength_score'] or 0,
+                    item['password_changed_at'], -1, count_vault=False)
+        secrets[item['fingerprint']] = secrets.get(item['fingerprint'], 0) + 1
+
+    for fingerprint, removed in secrets.items():
+        after = reuse_snapshot(c, user_id, fingerprint)
+        before = dict(after)
+        before[vault_id] = before.get(vault_id, 0) + removed
+        _apply_reuse(c, user_id, before, after, skip_vault=vault_id)
+
+    c.execute("DELETE FROM health_counters WHERE scope = 'vault' AND scope_id = ?", (vault_id,))
+    c.execute("DELETE FROM health_age_buckets WHERE scope = 'vault' AND scope_id = ?", (vault_id,))
+
+
+def rebuild_health(c):
+    # Full recomputation; used to backfill existing databases and to
+    # reconcile counters if they are ever suspected to have drifted
+    c.execute('DELETE FROM health_counters')
+    c.execute('DELETE FROM health_age_buckets')
+
+    c.execute('''
+        SELECT p.id, p.vault_id, v.user_id, p.password, p.fingerprint, p.strength_score,
+               COALESCE(p.password_changed_at, p.updated_at, p.created_at)
+        FROM passwords p JOIN vaults v ON p.vault_id = v.id
+        WHERE p.is_honeytoken = 0
+    ''')
+    rows = c.fetchall()
+
+    holders = {}
+    for password_id, vault_id, user_id, password, fingerprint, strength, changed_at in rows:
+        if strength is None:
+            strength = score_password(password)
+        c.execute('UPDATE passwords SET strength_score = ?, password_changed_at = ? WHERE id = ?',
+                  (strength, changed_at, password_id))
+        _count_item(c, user_id, vault_id, strength, changed_at, 1)
+        holders.setdefault((user_id, fingerprint), []).append(vault_id)
+
+    for (user_id, _), vault_ids in holders.items():
+        if len(vault_ids) < 2:
+            continue
+        for vault_id in vault_ids:
+            _bump(c, 'vault', vault_id, reused=1)
+        _bump(c, 'user', user_id, reused=len(vault_ids))
+
+
+def health_report(c, scope, scope_id):
+    c.execute('''
+        SELECT item_count, weak_count, reused_count, strength_total
+        FROM health_counters WHERE scope = ? AND scope_id = ?
+    ''', (scope, scope_id))
+    row = c.fetchone()
+    items, weak, reused, strength_total = row if row else (0, 0, 0, 0)
+
+    cutoff = datetime.now(timezone.utc) - timedelta(days=OLD_PASSWORD_DAYS)
+    c.execute('''
+        SELECT COALESCE(SUM(item_count), 0) FROM health_age_buckets
+        WHERE scope = ? AND scope_id = ? AND bucket < ?
+    ''', (scope, scope_id, cutoff.strftime('%Y-%m-%d')))
+    old = c.fetchone()[0]
+
+    return {
+        "total_items": items,
+        "weak": weak,
+        "old": old,
+        "reused": reused,
+        "average_strength": round(strength_total / items) if items else 0,
+        "weak_below_score": WEAK_SCORE,
+        "old_after_days": OLD_PASSWORD_DAYS
+    }
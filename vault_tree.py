@@ -0,0 +1,133 @@
+"""Nested vaults backed by a closure table.
+
+vaults.parent_vault_id is the source of truth.  vault_tree holds one row per
+(ancestor, descendant) pair, every vault paired with itself at depth 0:
+
+    vault_tree (ancestor_id, descendant_id) -> depth
+
+A subtree is a range scan of the primary key and the ancestors of a vault
+are a scan of the descendant index.  Recursive item counts sum the stored
+vaults.password_count over a subtree, so listing a deep tree never runs a
+recursive query.  add_vault(), move() and remove_vault() keep the table in
+step inside the caller's transaction; rebuild_tree() recomputes it from
+parent_vault_id and runs with the reconcile_health job.
+
+Every vault in a tree belongs to the owner of its root, and access to a
+vault extends to everything below it (see sharing.py).
+"""
+import os
+
+from migrations import add_column, table_exists
+
+# Levels below a root vault, root included
+MAX_DEPTH = int(os.environ.get('AGIES_VAULT_MAX_DEPTH', 16))
+
+# Guards rebuild_tree() against a parent_vault_id cycle written by hand
+REBUILD_DEPTH_LIMIT = 1000
+
+
+def init_tree_schema(c):
+    add_column(c, 'vaults', 'parent_vault_id', 'BLOB')
+
+    backfill = not table_exists(c, 'vault_tree')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS vault_tree (
+            ancestor_id BLOB NOT NULL,
+            descendant_id BLOB NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_vault_tree_descendant ON vault_tree (descendant_id, depth)')
+    if backfill:
+        rebuild_tree(c)
+
+
+def add_vault(c, vault_id, parent_id=None):
+    c.execute('INSERT INTO vault_tree (ancestor_id, descendant_id, depth) VALUES (?, ?, 0)',
+              (vault_id, vault_id))
+    if parent_id:
+        c.execute('''
+            INSERT INTO vault_tree (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, ?, depth + 1 FROM vault_tree WHERE descendant_id = ?
+        ''', (vault_id, parent_id))
+
+
+def depth(c, vault_id):
+    # 0 for a root vault
+    c.execute('SELECT MAX(depth) FROM vault_tree WHERE descendant_id = ?', (vault_id,))
+    return c.fetchone()[0] or 0
+
+
+def height(c, vault_id):
+    # 0 for a vault without children
+    c.execute('SELECT MAX(depth) FROM vault_tree WHERE ancestor_id = ?', (vault_id,))
+    return c.fetchone()[0] or 0
+
+
+def subtree(c, vault_id):
+    # The vault and everything below it, deepest first
+    c.execute('''
+        SELECT descendant_id FROM vault_tree WHERE ancestor_id = ? ORDER BY depth DESC
+    ''', (vault_id,))
+    return [row[0] for row in c.fetchall()]
+
+
+def is_descendant(c, vault_id, ancestor_id):
+    # True for the vault itself too
+    c.execute('SELECT 1 FROM vault_tree WHERE ancestor_id = ? AND descendant_id = ?',
+              (ancestor_id, vault_id))
+    return c.fetchone() is not None
+
+
+def total_items(c, vault_id):
+    c.execute('''
+        SELECT COALESCE(SUM(v.password_count), 0)
+        FROM vault_tree t JOIN vaults v ON v.id = t.descendant_id
+        WHERE t.ancestor_id = ?
+    ''', (vault_id,))
+    return c.fetchone()[0]
+
+
+def move(c, vault_id, parent_id):
+    # Detaches the subtree from its old ancestors and hangs it below
+    # parent_id (None makes it a root); the caller rules out cycles
+    c.execute('''
+        DELETE FROM vault_tree
+        WHERE descendant_id IN (SELECT descendant_id FROM vault_tree WHERE ancestor_id = ?)
+          AND ancestor_id NOT IN (SELECT descendant_id FROM vault_tree WHERE ancestor_id = ?)
+    ''', (vault_id, vault_id))
+    if parent_id:
+        c.execute('''
+            INSERT INTO vault_tree (ancestor_id, descendant_id, depth)
+            SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+            FROM vault_tree a, vault_tree d
+            WHERE a.descendant_id = ? AND d.ancestor_id = ?
+        ''', (parent_id, vault_id))
+    c.execute('UPDATE vaults SET parent_vault_id = ? WHERE id = ?', (parent_id, vault_id))
+
+
+def remove_vault(c, vault_id):
+    # Remove descendants first; their rows reference this vault as ancestor
+    c.execute('DELETE FROM vault_tree WHERE descendant_id = ? OR ancestor_id = ?', (vault_id, vault_id))
+
+
+def rebuild_tree(c):
+    # Recursive counts read the stored per-vault counts, so resync them too
+    c.execute('''
+        UPDATE vaults SET password_count = (
+            SELECT COUNT(*) FROM passwords WHERE passwords.vault_id = vaults.id
+        )
+    ''')
+    c.execute('DELETE FROM vault_tree')
+    c.execute('''
+        WITH RECURSIVE tree (ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM vaults
+            UNION ALL
+            SELECT t.ancestor_id, v.id, t.depth + 1
+            FROM tree t JOIN vaults v ON v.parent_vault_id = t.descendant_id
+            WHERE t.depth < ?
+        )
+        INSERT OR IGNORE INTO vault_tree (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, descendant_id, depth FROM tree
+    ''', (REBUILD_DEPTH_LIMIT,))
@@ -0,0 +1,463 @@
+"""Continuous WAL archiving and point-in-time recovery.
+
+With AGIES_WAL_ARCHIVE=1 the database runs in WAL mode and an archiver
+thread copies committed WAL frames into AGIES_WAL_ARCHIVE_DIR every
+AGIES_WAL_ARCHIVE_INTERVAL seconds.  Commits do not wait for it: it
+reads the WAL file and the header of its shared-memory index (-shm), which
+writers keep up to date anyway.  A lock file elects one archiver among the
+gunicorn workers.
+
+    <dir>/<generation>/base.bak         snapshot the generation starts from
+    <dir>/<generation>/generation.json  when it was taken and its WAL position
+    <dir>/<generation>/NNNNNNNN.seg     the frames archived by one poll
+    <dir>/<generation>/index.jsonl      one line per segment
+
+Snapshots and segments use the backup.py file format.  They are compressed,
+and encrypted when AGIES_BACKUP_KEY is set.
+
+Frames must be copied before the WAL restarts and overwrites them.  Two
+rules make that so:
+
+- The archiver is the only checkpointer.  Connections opened through
+  db.connect() turn automatic checkpoints off, so every writer has to use
+  it.
+- The archiver checkpoints only while it holds a read transaction whose
+  snapshot it has finished copying.
+
+Under those rules the WAL can only be fully backfilled, and so restarted,
+once everything in it is archived.  A steady stream of commits can keep the
+WAL from ever being fully backfilled.  When that happens and the WAL grows
+past four times AGIES_WAL_CHECKPOINT_BYTES, the archiver holds the write
+lock while it archives the last few frames and checkpoints.  This is the
+only time a commit can wait for it.  If the WAL restarts at any other time
+(another tool checkpointed it) frames may have been missed.  The archiver
+then starts a new generation from a fresh snapshot.  It also starts a new
+generation when it starts up, and every AGIES_WAL_SNAPSHOT_INTERVAL seconds
+so that a recovery never replays more than that.  Only the newest
+AGIES_WAL_ARCHIVE_GENERATIONS generations are kept.
+
+Recovery points are the archiver's polls.  Restoring to a timestamp replays
+every transaction archived at or before it onto the snapshot of the newest
+generation that started before it:
+
+    python walarchive.py list
+    python walarchive.py restore OUTPUT [--to 2026-10-19T12:00:00Z]
+"""
+import argparse
+import fcntl
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import backup
+import db
+
+ENABLED = os.environ.get('AGIES_WAL_ARCHIVE', '0') in ('1', 'true', 'on')
+ARCHIVE_DIR = os.environ.get('AGIES_WAL_ARCHIVE_DIR', 'wal-archive')
+INTERVAL = float(os.environ.get('AGIES_WAL_ARCHIVE_INTERVAL', 1.0))
+CHECKPOINT_BYTES = int(os.environ.get('AGIES_WAL_CHECKPOINT_BYTES', 2 * 1024 * 1024))
+SNAPSHOT_INTERVAL = int(os.environ.get('AGIES_WAL_SNAPSHOT_INTERVAL', 24 * 3600))
+GENERATIONS = int(os.environ.get('AGIES_WAL_ARCHIVE_GENERATIONS', 2))
+LOCK_RETRY = 30
+
+WAL_HEADER = 32
+FRAME_HEADER = 24
+INDEX_HEADER = 48
+
+logger = logging.getLogger('agies.walarchive')
+
+_started = False
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class Discontinuity(Exception):
+    # Frames may have been checkpointed away before they were archived
+    pass
+
+
+def read_index_header(shm_path):
+    # mxFrame, page size and salt from the WAL-index header; writers keep
+    # two copies that agree once an update is complete
+    for _ in range(1000):
+        with open(shm_path, 'rb') as f:
+            data = f.read(2 * INDEX_HEADER)
+        if len(data) < 2 * INDEX_HEADER:
+            raise ArchiveError('%s has no WAL-index header' % shm_path)
+        if data[:INDEX_HEADER] == data[INDEX_HEADER:] and data[12]:
+            page_size, mx_frame = struct.unpack('=HI', data[14:20])
+            return {
+                "page_size": 65536 if page_size == 1 else page_size,
+                "mx_frame": mx_frame,
+                "salt": data[32:40]
+            }
+        time.sleep(0.001)
+    raise ArchiveError('WAL-index header of %s kept changing' % shm_path)
+
+
+def _write_packed(source, path, key):
+    partial = path + '.partial'
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as out:
+        backup.pack(source, out, True, key)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(partial, path)
+
+
+def _timestamp(epoch):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(epoch))
+
+
+class Archiver:
+    def __init__(self, database):
+        self.database = database
+        self.wal_path = database + '-wal'
+        self.shm_path = database + '-shm'
+        self.key = backup.encryption_key()
+        self.reader = sqlite3.connect(database, isolation_level=None, timeout=30)
+        self.checkpointer = sqlite3.connect(database, isolation_level=None, timeout=30)
+        self.writer = sqlite3.connect(database, isolation_level=None, timeout=30)
+        for conn in (self.reader, self.checkpointer, self.writer):
+            conn.execute('PRAGMA wal_autocheckpoint=0')
+        mode = self.reader.execute('PRAGMA journal_mode').fetchone()[0]
+        if mode != 'wal':
+            raise ArchiveError('%s is in %s mode, not WAL' % (database, mode))
+        self.reading = False
+        self.generation = None
+        self.generation_started = 0.0
+        self.salt = None
+        self.position = 0
+        self.seq = 0
+        self.restart_expected = False
+
+    def close(self):
+        self.reader.close()
+        self.checkpointer.close()
+        self.writer.close()
+
+    def _pin(self):
+        # Starts a read transaction and returns the WAL-index header of its
+        # snapshot; while it is open the WAL cannot be backfilled past it
+        for _ in range(100):
+            if self.reading:
+                self.reader.execute('COMMIT')
+                self.reading = False
+            before = read_index_header(self.shm_path)
+            self.reader.execute('BEGIN')
+            self.reader.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            self.reading = True
+            after = read_index_header(self.shm_path)
+            if before == after:
+                return after
+            time.sleep(0.001)
+        raise ArchiveError('Could not pin a WAL snapshot')
+
+    def new_generation(self):
+        header = self._pin()
+        started = time.time()
+        name = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started))
+        path = os.path.join(ARCHIVE_DIR, name)
+        if os.path.exists(path):
+            path = '%s-%d' % (path, os.getpid())
+        os.makedirs(path)
+
+        # One step, so the copy is exactly the pinned snapshot
+        fd, copy_path = tempfile.mkstemp(prefix='.base-', dir=path)
+        os.close(fd)
+        try:
+            dest = sqlite3.connect(copy_path)
+            try:
+                self.reader.backup(dest)
+            finally:
+                dest.close()
+            with open(copy_path, 'rb') as source:
+                _write_packed(source, os.path.join(path, 'base.bak'), self.key)
+        finally:
+            os.remove(copy_path)
+        with open(os.path.join(path, 'generation.json'), 'w') as f:
+            json.dump({
+                "created_at": _timestamp(started),
+                "page_size": self.reader.execute('PRAGMA page_size').fetchone()[0],
+                "salt": header['salt'].hex(),
+                "frame": header['mx_frame']
+            }, f)
+
+        self.generation = path
+        self.generation_started = started
+        self.salt = header['salt']
+        self.position = header['mx_frame']
+        self.seq = 0
+        self.restart_expected = False
+        _prune()
+        logger.info('Started WAL archive generation %s at frame %d', path, self.position)
+
+    def _archive(self, header):
+        page_size = header['page_size']
+        frame_size = FRAME_HEADER + page_size
+        count = header['mx_frame'] - self.position
+        with open(self.wal_path, 'rb') as f:
+            f.seek(WAL_HEADER + self.position * frame_size)
+            frames = f.read(count * frame_size)
+        if len(frames) < count * frame_size:
+            raise Discontinuity('WAL is shorter than its index says')
+        for i in range(count):
+            if frames[i * frame_size + 8:i * frame_size + 16] != self.salt:
+                raise Discontinuity('WAL was restarted while it was being archived')
+
+        self.seq += 1
+        name = '%08d.seg' % self.seq
+        _write_packed(io.BytesIO(frames), os.path.join(self.generation, name), self.key)
+        with open(os.path.join(self.generation, 'index.jsonl'), 'a') as f:
+            f.write(json.dumps({
+                "seq": self.seq,
+                "file": name,
+                "first_frame": self.position,
+                "frames": count,
+                "page_size": page_size,
+                "archived_at": time.time()
+            }) + '\n')
+        self.position = header['mx_frame']
+        self.restart_expected = False
+
+    def _sync(self):
+        # Archives everything up to a freshly pinned snapshot
+        header = self._pin()
+        if header['salt'] != self.salt:
+            # Nothing can be lost if nothing had been written under the old salt
+            if not self.restart_expected and self.position:
+                raise Discontinuity('WAL was restarted by another checkpointer')
+            self.salt = header['salt']
+            self.position = 0
+            self.restart_expected = False
+        if header['mx_frame'] < self.position:
+            raise Discontinuity('WAL shrank without a restart')
+        if header['mx_frame'] > self.position:
+            self._archive(header)
+        return header
+
+    def _checkpoint(self):
+        # Everything up to the pinned snapshot is archived, so a checkpoint
+        # (which cannot go past the snapshot) never backfills unarchived frames
+        busy, log, done = self.checkpointer.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        if not busy and log == done == self.position:
+            self.restart_expected = True
+            # A snapshot of a fully backfilled WAL reads the database file
+            # alone and no longer keeps writers from restarting the WAL
+            self._pin()
+        return self.restart_expected
+
+    def poll(self):
+        header = self._sync()
+        wal_bytes = self.position * (FRAME_HEADER + header['page_size'])
+        if wal_bytes < CHECKPOINT_BYTES or self._checkpoint():
+            return
+
+        # Under a steady stream of commits the WAL is never fully backfilled
+        # up to the snapshot, so it would grow without bound; hold the write
+        # lock for as long as it takes to archive the last frames and
+        # checkpoint
+        if wal_bytes >= 4 * CHECKPOINT_BYTES:
+            self.writer.execute('BEGIN IMMEDIATE')
+            try:
+                self._sync()
+                self._checkpoint()
+            finally:
+                self.writer.execute('ROLLBACK')
+
+    def run(self):
+        self.new_generation()
+        while True:
+            time.sleep(INTERVAL)
+            try:
+                self.poll()
+            except Discontinuity as e:
+                logger.warning('%s; starting a new generation', e)
+                self.new_generation()
+                continue
+            if time.time() - self.generation_started >= SNAPSHOT_INTERVAL:
+                self.new_generation()
+
+
+def _prune():
+    for generation in generations()[GENERATIONS:]:
+        shutil.rmtree(generation['path'], ignore_errors=True)
+        logger.info('Removed WAL archive generation %s', generation['path'])
+
+
+def _segments(path):
+    try:
+        with open(os.path.join(path, 'index.jsonl')) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def generations():
+    # Newest first
+    try:
+        names = os.listdir(ARCHIVE_DIR)
+    except OSError:
+        return []
+    result = []
+    for name in sorted(names, reverse=True):
+        path = os.path.join(ARCHIVE_DIR, name)
+        try:
+            with open(os.path.join(path, 'generation.json')) as f:
+                generation = json.load(f)
+        except (OSError, ValueError):
+            continue
+        segments = _segments(path)
+        generation['path'] = path
+        generation['segments'] = len(segments)
+        generation['archived_until'] = (_timestamp(segments[-1]['archived_at']) if segments
+                                        else generation['created_at'])
+        result.append(generation)
+    return result
+
+
+def _parse_time(value):
+    moment = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+def restore(output, target=None):
+    # Rebuilds the database as of target (epoch seconds; None for the
+    # latest archived state) into output, which must not exist
+    if os.path.exists(output):
+        raise ArchiveError('%s already exists' % output)
+    candidates = [generation for generation in generations()
+                  if target is None or _parse_time(generation['created_at']) <= target]
+    if not candidates:
+        raise ArchiveError('No archive generation starts at or before the requested time')
+    generation = candidates[0]
+
+    fd, work = tempfile.mkstemp(prefix='.restore-', dir=os.path.dirname(os.path.abspath(output)))
+    applied = 0
+    restored_to = generation['created_at']
+    try:
+        with os.fdopen(fd, 'r+b') as f:
+            backup.unpack(os.path.join(generation['path'], 'base.bak'), f)
+            for segment in _segments(generation['path']):
+                if target is not None and segment['archived_at'] > target:
+                    break
+                frames = io.BytesIO()
+                backup.unpack(os.path.join(generation['path'], segment['file']), frames)
+                _apply(f, frames.getvalue(), segment['page_size'])
+                applied += 1
+                restored_to = _timestamp(segment['archived_at'])
+
+        conn = sqlite3.connect(work)
+        try:
+            conn.execute('PRAGMA journal_mode=DELETE')
+            result = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+        finally:
+            conn.close()
+        if result != ['ok']:
+            raise ArchiveError('Restored database failed its integrity check: %s' % '; '.join(result[:5]))
+        os.replace(work, output)
+    except Exception:
+        if os.path.exists(work):
+            os.remove(work)
+        raise
+    return {"generation": os.path.basename(generation['path']), "segments": applied,
+            "restored_to": restored_to}
+
+
+def _apply(f, frames, page_size):
+    # Writes each transaction's pages once its commit frame is reached
+    frame_size = FRAME_HEADER + page_size
+    pending = {}
+    for offset in range(0, len(frames), frame_size):
+        page_number, commit_size = struct.unpack('>II', frames[offset:offset + 8])
+        pending[page_number] = frames[offset + FRAME_HEADER:offset + frame_size]
+        if commit_size:
+            for page_number, page in pending.items():
+                f.seek((page_number - 1) * page_size)
+                f.write(page)
+            f.truncate(commit_size * page_size)
+            pending = {}
+
+
+def _archive_loop(database):
+    while True:
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        lock = open(os.path.join(ARCHIVE_DIR, '.lock'), 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Another worker is archiving
+            lock.close()
+            time.sleep(LOCK_RETRY)
+            continue
+        archiver = None
+        try:
+            archiver = Archiver(database)
+            archiver.run()
+        except Exception:
+            logger.exception('WAL archiver stopped')
+        finally:
+            if archiver:
+                archiver.close()
+            lock.close()
+        time.sleep(LOCK_RETRY)
+
+
+def init_wal(c):
+    # Called from init_db(); WAL mode is persistent
+    if ENABLED:
+        c.execute('PRAGMA journal_mode=WAL')
+
+
+def start(database):
+    global _started
+    if not ENABLED or _started:
+        return
+    _started = True
+    if 'PRAGMA wal_autocheckpoint=0' not in db.connect_pragmas:
+        db.connect_pragmas.append('PRAGMA wal_autocheckpoint=0')
+    threading.Thread(target=_archive_loop, args=(database,), name='wal-archiver',
+                     daemon=True).start()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Point-in-time recovery from the WAL archive.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='list archive generations, newest first')
+    restore_parser = commands.add_parser('restore', help='rebuild the database into OUTPUT')
+    restore_parser.add_argument('output')
+    restore_parser.add_argument('--to', help='ISO 8601 timestamp (default: latest)')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'list':
+            for generation in generations():
+                print('%s  %s .. %s  %d segments' % (
+                    generation['path'], generation['created_at'], generation['archived_until'],
+                    generation['segments']))
+        else:
+            target = _parse_time(args.to) if args.to else None
+            summary = restore(args.output, target)
+            print('Restored %s as of %s (generation %s, %d segments)' % (
+                args.output, summary['restored_to'], summary['generation'], summary['segments']))
+    except (ArchiveError, backup.BackupError, ValueError) as e:
+        print('error: %s' % e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))